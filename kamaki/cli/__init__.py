@@ -45,8 +45,9 @@ from kamaki.cli.utils import (
 from kamaki.cli.errors import CLIError, CLICmdSpecError
 from kamaki.cli import logger
 from kamaki.clients.astakos import CachedAstakosClient
-from kamaki.clients import ClientError, KamakiSSLError
-from kamaki.clients.utils import https, escape_ctrl_chars
+from kamaki.clients import ClientError, KamakiSSLError, Client
+from kamaki.clients.utils import https, escape_ctrl_chars, stats
+from kamaki.clients.utils.cache import FileCache
 
 
 _debug = False
@@ -214,6 +215,53 @@ def _check_config_version(cnf):
                     'For automatic conversion, rerun and say Y'])
 
 
+def _set_timeouts(_cnf):
+    """Socket timeouts for all clients, in seconds (0 for no limit)"""
+    for term, attr in (
+            ('connection_timeout', 'CONNECTION_TIMEOUT'),
+            ('read_timeout', 'READ_TIMEOUT')):
+        value = _cnf.get('global', term)
+        try:
+            setattr(Client, attr, float(value) or None)
+        except (TypeError, ValueError):
+            kloger.warning('Invalid %s value: %s (ignored)' % (term, value))
+
+
+def _set_response_cache(_cnf):
+    """Cache GET responses in the response_cache directory, if set"""
+    cache_path = _cnf.get('global', 'response_cache')
+    if not cache_path:
+        return
+    try:
+        limit = int(_cnf.get('global', 'response_cache_limit'))
+        Client.RESPONSE_CACHE = FileCache(cache_path, limit)
+    except (ValueError, TypeError, OSError) as e:
+        kloger.warning('Response cache is disabled: %s' % e)
+
+
+def _init_trace(_cnf):
+    """Log a sample of the requests as JSON lines in the trace_file, if set
+
+    :returns: (TraceCollector or None)
+    """
+    trace_file = _cnf.get('global', 'trace_file')
+    if not trace_file:
+        return None
+    rate = _cnf.get('global', 'trace_sample_rate')
+    try:
+        rate = float(rate)
+    except (TypeError, ValueError):
+        rate = 1.0
+        kloger.warning('Invalid trace_sample_rate value: %s (ignored)' % (
+            _cnf.get('global', 'trace_sample_rate')))
+    tracelog = logger.add_file_logger(
+        'kamaki.clients.trace', logging.INFO, trace_file, fmt='%(message)s')
+    tracelog.propagate = False
+    tracer = stats.TraceCollector(tracelog, rate)
+    stats.add_collector(tracer)
+    return tracer
+
+
 def _init_session(arguments, is_non_api=False):
     """
     :returns: cloud name
@@ -240,6 +288,8 @@ def _init_session(arguments, is_non_api=False):
         warn = red('WARNING: CA certifications path not set (insecure) ')
         kloger.warning(warn)
     https.patch_to_raise_ssl_errors(not ignore_ssl)
+    _set_timeouts(_cnf)
+    _set_response_cache(_cnf)
 
     _check_config_version(_cnf.value)
 
@@ -509,6 +559,7 @@ def is_non_api(parser):
 
 def main(func):
     def wrap():
+        collector, tracer = None, None
         try:
             exe = basename(argv[0])
             internal_argv = []
@@ -544,10 +595,16 @@ def main(func):
                     'Allow connections to SSL sites without certs',
                     ('-k', '--ignore-ssl', '--insecure')),
                 ca_file=ValueArgument(
-                    'CA certificates for SSL authentication', '--ca-certs'),)
+                    'CA certificates for SSL authentication', '--ca-certs'),
+                request_stats=FlagArgument(
+                    'Print a summary of HTTP request stats at exit',
+                    '--request-stats'),)
             )
             if parser.arguments['version'].value:
                 exit(0)
+            if parser.arguments['request_stats'].value:
+                collector = stats.SummaryCollector()
+                stats.add_collector(collector)
 
             _cnf = parser.arguments['config']
             log_file = _cnf.get('global', 'log_file')
@@ -556,6 +613,7 @@ def main(func):
             filelog = logger.add_file_logger(__name__.split('.')[0])
 
             filelog.info('%s\n- - -' % ' '.join(argv))
+            tracer = _init_trace(_cnf)
 
             _colors = _cnf.value.get('global', 'colors')
             exclude = ['ansicolors'] if not _colors == 'on' else []
@@ -601,6 +659,15 @@ def main(func):
             if _debug:
                 raise
             exit(1)
+        finally:
+            if tracer:
+                stats.remove_collector(tracer)
+            if collector:
+                stats.remove_collector(collector)
+                report = collector.report()
+                if report:
+                    stderr.write('%s\n' % report)
+                    stderr.flush()
     return wrap
 
 
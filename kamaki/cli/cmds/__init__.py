@@ -352,6 +352,12 @@ class NameFilter(object):
     def _filter_by_name(self, items):
         return self._non_exact_name_filter(self._exact_name_filter(items))
 
+    def _iter_by_name(self, items):
+        """Like _filter_by_name, but lazy, for listings too long to keep"""
+        for item in items:
+            if self._filter_by_name([item]):
+                yield item
+
 
 class IDFilter(object):
 
@@ -31,14 +31,18 @@
 # interpreted as representing official policies, either expressed
 # or implied, of GRNET S.A.command
 
-from time import localtime, strftime
+from time import localtime, strftime, strptime
+from calendar import timegm
 from io import StringIO
 from pydoc import pager
-from os import path, walk, makedirs
-from threading import activeCount, enumerate as activethreads
+from os import path, walk, makedirs, remove, rmdir, stat, utime
+from threading import enumerate as activethreads, currentThread
+from itertools import chain, islice, groupby
 
 from kamaki.clients.pithos import PithosClient, ClientError
 from kamaki.clients.utils import escape_ctrl_chars
+from kamaki.clients.utils.cache import FileCache
+from kamaki.clients.utils.transfer import TransferScheduler
 
 from kamaki.cli import command
 from kamaki.cli.cmdtree import CommandTree
@@ -85,10 +89,30 @@ class _PithosInit(CommandInit):
         else:
             raise CLIBaseUrlError(service='astakos')
 
+    def _get_file_cache(self, term):
+        """:returns: (FileCache) in the global.<term> directory, limited by
+            global.<term>_limit bytes, or None if global.<term> is not set
+        """
+        cache_path = self['config'].get('global', term)
+        if not cache_path:
+            return None
+        try:
+            limit = int(self['config'].get('global', '%s_limit' % term))
+            return FileCache(cache_path, limit)
+        except (ValueError, TypeError, OSError) as e:
+            self.error('Local cache %s is disabled: %s' % (term, e))
+            return None
+
+    @dont_raise(ValueError)
+    def _set_range_blocks(self):
+        self.client.MAX_RANGE_BLOCKS = int(
+            self['config'].get('global', 'download_range_blocks') or 1)
+
     @errors.Generic.all
     @client_log
     def _run(self):
         self.client = self.get_client(PithosClient, 'pithos')
+        self._set_range_blocks()
         self.endpoint_url = self.client.endpoint_url
         self.token = self.client.token
         self._set_account()
@@ -110,10 +134,12 @@ class _PithosAccount(_PithosInit):
         self.arguments['account'].account_client = astakos
 
     def print_objects(self, object_list):
+        """:param object_list: a list, or any iterable if not enumerated"""
+        width = len(str(len(object_list))) if self['enum'] else 0
         for index, obj in enumerate(object_list):
             pretty_obj = obj.copy()
             index += 1
-            empty_space = ' ' * (len(str(len(object_list))) - len(str(index)))
+            empty_space = ' ' * (width - len(str(index)))
             if 'subdir' in obj:
                 continue
             if self.object_is_dir(obj):
@@ -176,6 +202,46 @@ class _PithosContainer(_PithosAccount):
         finally:
             self.container = bu_cont
 
+    def _run_transfers(
+            self, transfers, done_cb, parallel=None, progress_msg=None,
+            failure_msg=None, interrupt_msg=None):
+        """Run transfers, up to parallel (default: 5) at once. If there is a
+        progress_msg, a progress bar shows the progress of all the transfers,
+        otherwise done_cb reports each transfer when it is over
+
+        :param transfers: (list) of (name, units, method, args) tuples, for
+            TransferScheduler.add
+
+        :param done_cb: (callable) called with each finished Transfer
+
+        :param failure_msg: (str) if given and some transfers fail, raise a
+            CLIError with it, formatted with the failed and total transfers
+
+        :param interrupt_msg: (str) if given, raise a CLIError with it when
+            the user interrupts the transfers
+
+        :returns: (list, list) all the Transfers and the failed ones
+        """
+        (progress_bar, progress_cb) = self._safe_progress_bar(
+            progress_msg) if progress_msg else (None, None)
+        scheduler = TransferScheduler(
+            parallel or 5, progress_cb, None if progress_cb else done_cb)
+        scheduled = [scheduler.add(name, units, method, *args) for (
+            name, units, method, args) in transfers]
+        try:
+            failed = scheduler.run()
+        except KeyboardInterrupt:
+            if interrupt_msg:
+                raise CLIError(interrupt_msg)
+            raise
+        finally:
+            self._safe_progress_bar_finish(progress_bar)
+        if failed and failure_msg:
+            raise CLIError(
+                failure_msg % (len(failed), len(scheduled)),
+                details=['%s: %s' % (t.name, t.exception) for t in failed])
+        return scheduled, failed
+
     def _run(self, url=None):
         acc, con, self.path = self.resolve_pithos_url(url or '')
         super(_PithosContainer, self)._run()
@@ -285,8 +351,14 @@ class file_list(_PithosContainer, OptionalOutput, NameFilter):
 
     @errors.Pithos.container
     def _container_info(self):
-        r = self.client.container_get(
-            limit=False if self['more'] else self['limit'],
+        """:returns: (iterator) the listed objects, None if there are none.
+            The first page is requested here, so that errors.Pithos.container
+            handles its errors
+        """
+        limit = None if self['more'] else self['limit']
+        objects = self.client.iter_objects(
+            page_size=limit,
+            prefetch=not limit,
             marker=self['marker'],
             prefix=self.path,
             delimiter=self['delimiter'],
@@ -297,15 +369,16 @@ class file_list(_PithosContainer, OptionalOutput, NameFilter):
             if_unmodified_since=self['if_unmodified_since'],
             until=self['until'],
             meta=self['meta'])
-        files = list(r.json or [])
-        return files
+        objects = islice(objects, limit) if limit else objects
+        first = next(objects, None)
+        return None if first is None else chain([first], objects)
 
     @errors.Generic.all
     @errors.Pithos.connection
     @errors.Pithos.object_path
     def _run(self):
         r = self._container_info()
-        if not r:
+        if r is None:
             if self.path:
                 obj_path = '/%s/%s' % (self.container, self.path)
                 obj_info = self.client.get_object_info(self.path)
@@ -328,7 +401,11 @@ class file_list(_PithosContainer, OptionalOutput, NameFilter):
             else:
                 self.error('Container "%s" is empty' % self.client.container)
 
-        files = self._filter_by_name(r)
+        #  Objects are printed as they are listed, unless the whole listing
+        #  is needed: to format it, or to align the enumeration
+        files = self._iter_by_name(r or [])
+        if self['output_format'] or self['enum']:
+            files = list(files)
         if self['more']:
             outbu, self._out = self._out, StringIO()
         try:
@@ -346,6 +423,33 @@ class file_list(_PithosContainer, OptionalOutput, NameFilter):
         self._run()
 
 
+def _transfer_threads():
+    """Threads to wait for, before exiting (daemon threads are ignored)"""
+    current = currentThread()
+    return [t for t in activethreads() if not (t.daemon or t is current)]
+
+
+def _progress_units(size):
+    """Progress of many files is counted in units of 64KB, so that bigger
+    files weigh more. The units of each file are spread over its blocks
+
+    :returns: (int) the units of a file of size bytes, at least one
+    """
+    return max(1, 1 + (size - 1) // 65536)
+
+
+def _remote_mtime(obj):
+    """:returns: (float) the last_modified time of a listed object, in
+        seconds since the epoch, or None if it is missing or malformed"""
+    try:
+        stamp = obj['last_modified']
+        seconds = timegm(strptime(stamp[:19], '%Y-%m-%dT%H:%M:%S'))
+        fraction = stamp[19:].split('+')[0].rstrip('Z')
+        return seconds + (float(fraction) if fraction else 0)
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
 def _assert_path(self, path_or_url):
     if not self.path:
         raise CLISyntaxError(
@@ -563,7 +667,10 @@ class _PithosFromTo(_PithosContainer):
         force=FlagArgument(
             'Overwrite destination objects, if needed', ('-f', '--force')),
         source_version=ValueArgument(
-            'The version of the source object', '--source-version')
+            'The version of the source object', '--source-version'),
+        max_threads=IntArgument(
+            'Transfer up to that many objects at once (default: 5)',
+            '--threads'),
     )
 
     def __init__(self, arguments={}, astakos=None, cloud=None):
@@ -590,21 +697,32 @@ class _PithosFromTo(_PithosContainer):
         else:
             self.error('  mkdir %s' % full_dest_path)
 
-    @errors.Generic.all
-    @errors.Pithos.account
-    def _src_dst(self, version=None):
-        """Preconditions:
-        self.account, self.container, self.path
-        self.dst_acc, self.dst_con, self.dst_path
-        They should all be configured properly
-        :returns: [(src_path, dst_path), ...], if src_path is None, create
-            destination directory
+    @staticmethod
+    def _same_object(src_obj, dst_obj):
+        """:returns: (bool) whether a source object (listed, or its headers)
+            has the same size and hash as a listed destination object"""
+        def signature(obj):
+            return (
+                '%s' % obj.get('bytes', obj.get('content-length')),
+                obj.get('hash', obj.get('x-object-hash')))
+        src = signature(src_obj)
+        return bool(src[1]) and src == signature(dst_obj)
+
+    def _dst_objects(self, prefix, names=None):
+        """List the destination objects under prefix
+
+        :param names: (container) keep only the objects of these names
+
+        :returns: (dict) {name: obj}, where obj keeps only what _same_object
+            and object_is_dir check, so that long listings stay small
         """
-        src_objects, dst_objects, pairs = dict(), dict(), []
+        dst_objects = dict()
         try:
-            for obj in self.dst_client.list_objects(
-                    prefix=self.dst_path or self.path or '/'):
-                dst_objects[obj['name']] = obj
+            for obj in self.dst_client.iter_objects(prefix=prefix):
+                if names is None or obj['name'] in names:
+                    dst_objects[obj['name']] = dict(
+                        (k, obj[k]) for k in (
+                            'bytes', 'hash', 'content_type') if k in obj)
         except ClientError as ce:
             if ce.status in (404, ):
                 raise CLIError(
@@ -612,21 +730,41 @@ class _PithosFromTo(_PithosContainer):
                         self.dst_client.account, self.dst_client.container),
                     importance=2)
             raise ce
+        return dst_objects
+
+    @errors.Generic.all
+    @errors.Pithos.account
+    def _src_dst(self, version=None, skip_same=False):
+        """Preconditions:
+        self.account, self.container, self.path
+        self.dst_acc, self.dst_con, self.dst_path
+        They should all be configured properly
+        :param skip_same: (bool) leave out objects which exist in the
+            destination with the same size and hash, e.g., copied by a
+            previous, partially failed run
+        :returns: [(src_path, dst_path), ...], if src_path is None, create
+            destination directory. The pairs are kept as a list, since
+            _transfer creates the directories before it transfers objects
+        """
+        pairs, dst_prefix = [], self.dst_path or self.path or '/'
         if self['source_prefix']:
-            #  Copy and replace prefixes
-            for src_obj in self.client.list_objects(prefix=self.path):
-                src_objects[src_obj['name']] = src_obj
-            for src_path, src_obj in src_objects.items():
+            #  Copy and replace prefixes. The source is not kept in memory
+            dst_objects = self._dst_objects(dst_prefix)
+            for src_obj in self.client.iter_objects(prefix=self.path):
+                src_path = src_obj['name']
                 dst_path = '%s%s' % (
                     self.dst_path or self.path, src_path[len(self.path):])
                 dst_obj = dst_objects.get(dst_path, None)
-                if self['force'] or not dst_obj:
+                if skip_same and dst_obj and not self.object_is_dir(
+                        src_obj) and self._same_object(src_obj, dst_obj):
+                    self.error('  %s is up to date' % dst_path)
+                elif self['force'] or not dst_obj:
                     #  Just do it
                     pairs.append((
                         None if self.object_is_dir(src_obj) else src_path,
                         dst_path))
                     if self.object_is_dir(src_obj):
-                        pairs.append((self.path or dst_path, None))
+                        pairs.append((src_path, None))
                 elif not any([
                         self.object_is_dir(dst_obj),
                         self.object_is_dir(src_obj)]):
@@ -657,8 +795,12 @@ class _PithosFromTo(_PithosContainer):
                                 self.arguments['source_prefix'].lvalue)])
                 raise
             dst_path = self.dst_path or self.path
-            dst_obj = dst_objects.get(dst_path or self.path, None)
-            if self['force'] or not dst_obj:
+            dst_obj = self._dst_objects(dst_prefix, (dst_path, )).get(
+                dst_path, None)
+            if skip_same and dst_obj and not self.object_is_dir(
+                    src_obj) and self._same_object(src_obj, dst_obj):
+                self.error('  %s is up to date' % dst_path)
+            elif self['force'] or not dst_obj:
                 pairs.append((
                     None if self.object_is_dir(src_obj) else self.path,
                     dst_path))
@@ -692,6 +834,86 @@ class _PithosFromTo(_PithosContainer):
                             self.arguments['force'].lvalue)])
         return pairs
 
+    def _run_batch(self, method, pairs, transfer_name):
+        """Call method(src, dst) for all pairs, up to --threads at once
+
+        :returns: (list) the failed Transfers
+        """
+        def done_cb(transfer):
+            src, dst = transfer.args[1:]
+            if transfer.exception:
+                self.error('  %s failed: %s' % (
+                    transfer.name, transfer.exception))
+            else:
+                self._report_transfer(src, dst, transfer_name)
+        transfers = [(src or dst, 1, lambda progress_cb, m, s, d: m(s, d), (
+            method, src, dst)) for src, dst in pairs]
+        return self._run_transfers(
+            transfers, done_cb, int(self['max_threads'] or 5))[1]
+
+    def _transfer(
+            self, pairs, transfer_name, transfer_object, skip_same=False):
+        """Create the destination directories, a level at a time, then
+        transfer the objects concurrently. When moving, delete the source
+        directories (deeper first), unless some of their contents are left
+
+        :param pairs: as returned by _src_dst
+
+        :param transfer_object: method(src, dst) to transfer one object
+
+        :param skip_same: (bool) as in _src_dst, for the hint on failures
+        """
+        def depth(p):
+            return p.strip('/').count('/')
+
+        mkdirs = sorted(
+            set(d for s, d in pairs if d and not s),
+            key=lambda d: (depth(d), d))
+        failed = []
+        for level, dirs in groupby(mkdirs, key=depth):
+            failed += self._run_batch(
+                lambda s, d: self.dst_client.create_directory(d),
+                [(None, d) for d in dirs],
+                transfer_name)
+        failed += self._run_batch(
+            transfer_object, [(s, d) for s, d in pairs if s and d],
+            transfer_name)
+
+        if transfer_name in ('move', ):
+            rmdirs = sorted(
+                set(s for s, d in pairs if s and not d),
+                key=lambda s: (-depth(s), s))
+            left = set(t.args[1] for t in failed if t.args[1])
+            for level, dirs in groupby(rmdirs, key=depth):
+                dirs, kept = list(dirs), []
+                for src in dirs:
+                    prefix = '%s/' % src.rstrip('/')
+                    if any(p.startswith(prefix) for p in left):
+                        self.error('  keep source directory %s' % src)
+                        kept.append(src)
+                failed += self._run_batch(
+                    lambda s, d: self.client.del_object(s),
+                    [(src, None) for src in dirs if src not in kept],
+                    transfer_name)
+                left.update(kept)
+                left.update(t.args[1] for t in failed if t.args[1])
+
+        if failed:
+            hint = 'To resume, run the same command again'
+            if skip_same:
+                hint += ': objects already copied are skipped'
+            elif transfer_name in ('move', ):
+                hint += ': moved objects are not in the source any more'
+            details = []
+            for t in failed:
+                src, dst = t.args[1:]
+                action = '%s --> %s' % (src, dst) if src and dst else (
+                    'mkdir %s' % dst if dst else 'delete %s' % src)
+                details.append('%s: %s' % (action, t.exception))
+            raise CLIError(
+                'Failed to %s %s objects' % (transfer_name, len(failed)),
+                details=details + [hint])
+
     def _run(self, source_path_or_url, destination_path_or_url=''):
         super(_PithosFromTo, self)._run(source_path_or_url)
         dst_acc, dst_con, dst_path = self.resolve_pithos_url(
@@ -716,25 +938,29 @@ class file_copy(_PithosFromTo):
             'The version of the source object', '--object-version')
     )
 
+    def _copy_object(self, src, dst):
+        self.dst_client.copy_object(
+            src_container=self.client.container,
+            src_object=src,
+            dst_container=self.dst_client.container,
+            dst_object=dst,
+            source_account=self.client.account,
+            source_version=self['source_version'],
+            public=self['public'],
+            content_type=self['content_type'])
+
     @errors.Generic.all
     @errors.Pithos.connection
     @errors.Pithos.container
     @errors.Pithos.account
     def _run(self):
-        for src, dst in self._src_dst(self['source_version']):
-            self._report_transfer(src, dst, 'copy')
-            if src and dst:
-                self.dst_client.copy_object(
-                    src_container=self.client.container,
-                    src_object=src,
-                    dst_container=self.dst_client.container,
-                    dst_object=dst,
-                    source_account=self.client.account,
-                    source_version=self['source_version'],
-                    public=self['public'],
-                    content_type=self['content_type'])
-            elif dst:
-                self.dst_client.create_directory(dst)
+        #  Unless the copies are modified or forced, copied objects are not
+        #  copied again
+        skip_same = not (self['force'] or self['source_version'] or (
+            self['public'] or self['content_type']))
+        self._transfer(
+            self._src_dst(self['source_version'], skip_same=skip_same),
+            'copy', self._copy_object, skip_same=skip_same)
 
     def main(self, source_path_or_url, destination_path_or_url=None):
         super(file_copy, self)._run(
@@ -752,26 +978,22 @@ class file_move(_PithosFromTo):
             'change object\'s content type', '--content-type')
     )
 
+    def _move_object(self, src, dst):
+        self.dst_client.move_object(
+            src_container=self.client.container,
+            src_object=src,
+            dst_container=self.dst_client.container,
+            dst_object=dst,
+            source_account=self.account,
+            public=self['public'],
+            content_type=self['content_type'])
+
     @errors.Generic.all
     @errors.Pithos.connection
     @errors.Pithos.container
     @errors.Pithos.account
     def _run(self):
-        for src, dst in self._src_dst():
-            self._report_transfer(src, dst, 'move')
-            if src and dst:
-                self.dst_client.move_object(
-                    src_container=self.client.container,
-                    src_object=src,
-                    dst_container=self.dst_client.container,
-                    dst_object=dst,
-                    source_account=self.account,
-                    public=self['public'],
-                    content_type=self['content_type'])
-            elif dst:
-                self.dst_client.create_directory(dst)
-            else:
-                self.client.del_object(src)
+        self._transfer(self._src_dst(), 'move', self._move_object)
 
     def main(self, source_path_or_url, destination_path_or_url=None):
         super(file_move, self)._run(
@@ -926,6 +1148,17 @@ class file_upload(_PithosContainer):
             'Confirm upload with a custom checksum (MD5)', '--etag'),
         use_hashes=FlagArgument(
             'Source file contains hashmap not data', '--source-is-hashmap'),
+        pipeline=FlagArgument(
+            'Hash and upload blocks in a single pass (faster for big files, '
+            'but blocks already on the server are uploaded again)',
+            '--pipeline'),
+        no_hash_cache=FlagArgument(
+            'Calculate block hashes even if they are cached locally',
+            '--no-hash-cache'),
+        parallel_files=IntArgument(
+            'Upload up to that many files at once, when uploading '
+            'directories (default: 5)',
+            '--parallel-files'),
     )
 
     def _sharing(self):
@@ -941,8 +1174,8 @@ class file_upload(_PithosContainer):
     def _check_container_limit(self, path):
         cl_dict = self.client.get_container_limit()
         container_limit = int(cl_dict['x-container-policy-quota'])
-        r = self.client.container_get()
-        used_bytes = sum(int(o['bytes']) for o in r.json)
+        used_bytes = sum(
+            int(o['bytes']) for o in self.client.iter_objects())
         path_size = get_path_size(path)
         if container_limit and path_size > (container_limit - used_bytes):
             raise CLIError(
@@ -1006,7 +1239,7 @@ class file_upload(_PithosContainer):
                     if path.isfile(fpath):
                         rel_path = rel_path.replace(path.sep, '/')
                         pathfix = f.replace(path.sep, '/')
-                        yield open(fpath, 'rb'), '%s/%s' % (rel_path, pathfix)
+                        yield fpath, '%s/%s' % (rel_path, pathfix)
                     else:
                         self.error('%s not a regular file' % fpath)
         else:
@@ -1029,70 +1262,96 @@ class file_upload(_PithosContainer):
                 else:
                     raise
             self._check_container_limit(lpath)
-            yield open(lpath, 'rb'), rpath
+            yield lpath, rpath
 
-    def _run(self, local_path, remote_path):
-        self.client.MAX_THREADS = int(self['max_threads'] or 5)
+    def _upload(self, upload_cb, lpath, rpath, hash_cb=None):
         params = dict(
             content_encoding=self['content_encoding'],
             content_type=self['content_type'],
             content_disposition=self['content_disposition'],
             sharing=self._sharing(),
             public=self['public'])
-        container_info_cache = dict()
-        rpref = 'pithos://%s' if self['account'] else ''
-        for f, rpath in self._src_dst(local_path, remote_path):
-            self.error('%s --> %s/%s/%s' % (
-                f.name, rpref, self.client.container, rpath))
-            if not (self['content_type'] and self['content_encoding']):
-                ctype, cenc = guess_mime_type(f.name)
-                params['content_type'] = self['content_type'] or ctype
-                params['content_encoding'] = self['content_encoding'] or cenc
+        if not (self['content_type'] and self['content_encoding']):
+            ctype, cenc = guess_mime_type(lpath)
+            params['content_type'] = self['content_type'] or ctype
+            params['content_encoding'] = self['content_encoding'] or cenc
+        with open(lpath, 'rb') as f:
             if self['unchunked']:
-                self.client.upload_object_unchunked(
+                return self.client.upload_object_unchunked(
                     rpath, f,
                     etag=self['md5_checksum'], withHashFile=self['use_hashes'],
                     **params)
+            return self.client.upload_object(
+                rpath, f,
+                hash_cb=hash_cb,
+                upload_cb=upload_cb,
+                container_info_cache=self._container_info_cache,
+                pipeline=self['pipeline'],
+                hash_cache=self._hash_cache,
+                **params)
+
+    def _upload_one(self, lpath, rpath):
+        progress_bar = None
+        try:
+            if self['unchunked']:
+                upload_cb, hash_cb = None, None
             else:
-                try:
-                    (progress_bar, upload_cb) = self._safe_progress_bar(
-                        'Uploading %s' % f.name.split(path.sep)[-1])
-                    if progress_bar:
-                        hash_bar = progress_bar.clone()
-                        hash_cb = hash_bar.get_generator(
-                            'Calculating block hashes')
-                    else:
-                        hash_cb = None
-                    self.client.upload_object(
-                        rpath, f,
-                        hash_cb=hash_cb,
-                        upload_cb=upload_cb,
-                        container_info_cache=container_info_cache,
-                        **params)
-                except KeyboardInterrupt:
-                    timeout = 0.5
-                    msg = '\n'
-                    while activeCount() > 1:
-                        msg += 'Wait for %s threads: ' % (activeCount() - 1)
-                        self._err.write(msg)
-                        for thread in activethreads():
-                            try:
-                                thread.join(timeout)
-                                self._err.write(
-                                    '.' if thread.isAlive() else '*')
-                                self._err.flush()
-                            except RuntimeError:
-                                continue
-                            finally:
-                                timeout += 0.1
-                                self._err.flush()
-                                msg = '\b' * len(msg)
-                    raise CLIError('Upload canceled by user')
-                except Exception:
-                    self._safe_progress_bar_finish(progress_bar)
-                    raise
-                finally:
-                    self._safe_progress_bar_finish(progress_bar)
+                (progress_bar, upload_cb) = self._safe_progress_bar(
+                    'Uploading %s' % lpath.split(path.sep)[-1])
+                if progress_bar:
+                    hash_bar = progress_bar.clone()
+                    hash_cb = hash_bar.get_generator(
+                        'Calculating block hashes')
+                else:
+                    hash_cb = None
+            self._upload(upload_cb, lpath, rpath, hash_cb=hash_cb)
+        except KeyboardInterrupt:
+            #  Pending block uploads are canceled by the client and
+            #  the pool workers are daemons, so there is no waiting
+            raise CLIError('Upload canceled by user')
+        finally:
+            self._safe_progress_bar_finish(progress_bar)
+
+    def _upload_many(self, src_dst):
+        """Upload many files at once, with one progress bar for all"""
+        if not src_dst:
+            return
+        self._container_info_cache[
+            self.client.container] = self.client.get_container_info()
+        rpref = 'pithos://%s' if self['account'] else ''
+
+        def done_cb(transfer):
+            if transfer.exception:
+                self.error('%s: %s' % (transfer.name, transfer.exception))
+            else:
+                self.error('%s --> %s/%s/%s' % (
+                    transfer.args[0], rpref, self.client.container,
+                    transfer.args[1]))
+        transfers = []
+        for lpath, rpath in src_dst:
+            units = _progress_units(path.getsize(lpath))
+            transfers.append((lpath, units, self._upload, (lpath, rpath)))
+        self._run_transfers(
+            transfers, done_cb, self['parallel_files'],
+            progress_msg='Uploading %s files' % len(src_dst),
+            failure_msg='%s of %s files failed to upload',
+            interrupt_msg='Upload canceled by user')
+
+    def _run(self, local_path, remote_path):
+        self.client.MAX_THREADS = int(self['max_threads'] or 5)
+        self._container_info_cache = dict()
+        self._hash_cache = None if (
+            self['unchunked'] or self['no_hash_cache']) else (
+                self._get_file_cache('hashmap_cache'))
+        rpref = 'pithos://%s' if self['account'] else ''
+        if path.isdir(path.abspath(local_path)):
+            self._upload_many(list(self._src_dst(local_path, remote_path)))
+            self.error('Upload completed')
+            return
+        for lpath, rpath in self._src_dst(local_path, remote_path):
+            self.error('%s --> %s/%s/%s' % (
+                lpath, rpref, self.client.container, rpath))
+            self._upload_one(lpath, rpath)
             self.error('Upload completed')
 
     def main(self, local_path, remote_path_or_url=None):
@@ -1154,13 +1413,15 @@ class file_cat(_PithosContainer):
         if_unmodified_since=DateArgument(
             'show output unmodified since then', '--if-unmodified-since'),
         object_version=ValueArgument(
-            'Get contents of the chosen version', '--object-version')
+            'Get contents of the chosen version', '--object-version'),
+        max_threads=IntArgument('default: 5', '--threads'),
     )
 
     @errors.Generic.all
     @errors.Pithos.connection
     @errors.Pithos.object_path
     def _run(self):
+        self.client.MAX_THREADS = int(self['max_threads'] or 5)
         try:
             self.client.download_object(
                 self.path, self._out,
@@ -1208,15 +1469,27 @@ class file_download(_PithosContainer):
             default=False),
         recursive=FlagArgument(
             'Download a remote directory object and its contents',
-            ('-r', '--recursive'))
+            ('-r', '--recursive')),
+        no_block_cache=FlagArgument(
+            'Download all blocks, even if they are cached locally',
+            '--no-block-cache'),
+        verify=FlagArgument(
+            'When resuming, check all local blocks, even the ones recorded '
+            'as complete by an interrupted download',
+            '--verify'),
+        parallel_files=IntArgument(
+            'Download up to that many files at once, when downloading '
+            'directories (default: 5)',
+            '--parallel-files'),
         )
 
     def _src_dst(self, local_path):
-        """Create a list of (src, dst) where src is a remote location and dst
-        is an open file descriptor. Directories are denoted as (None, dirpath)
+        """Create a list of (src, dst, resume) where src is a remote location
+        and dst a local path. Directories are denoted as (None, dirpath, None)
         and they are pretended to other objects in a very strict order (shorter
-        to longer path)."""
-        ret, obj = [], None
+        to longer path). The sizes of the remote files are kept in
+        self._sizes"""
+        ret, obj, self._sizes = [], None, dict()
         try:
             if self.path:
                 obj = self.client.get_object_info(
@@ -1255,11 +1528,11 @@ class file_download(_PithosContainer):
                 obj = obj or dict(
                     name='', content_type='application/directory')
                 dirs, files = [], []
-                objects = self.client.container_get(
+                objects = self.client.iter_objects(
                     prefix=rpath,
                     if_modified_since=self['modified_since_date'],
                     if_unmodified_since=self['unmodified_since_date'])
-                for o in objects.json:
+                for o in objects:
                     (dirs if self.object_is_dir(o) else files).append(o)
 
                 #  Put the directories on top of the list
@@ -1277,7 +1550,9 @@ class file_download(_PithosContainer):
                     ret.append((None, dpath, None))
 
                 #  Append the file objects
-                for opath in [o['name'] for o in files]:
+                for o in files:
+                    opath = o['name']
+                    self._sizes[opath] = int(o.get('bytes', 0))
                     lpath = '%s%s' % (local_path, opath[len(rpath):])
                     if self['resume']:
                         fxists = path.exists(lpath)
@@ -1336,12 +1611,53 @@ class file_download(_PithosContainer):
                                 'Either remove the file, or choose another '
                                 'destination'])
             ret.append((rpath, local_path, self['resume']))
-        for r, l, resume in ret:
-            if r:
-                with open(l, 'rwb+' if resume else 'wb+') as f:
-                    yield (r, f)
+            self._sizes[rpath] = int(obj.get('content-length', 0))
+        return ret
+
+    def _download(self, download_cb, rpath, lpath, resume):
+        with open(lpath, 'rwb+' if resume else 'wb+') as f:
+            self.client.download_object(
+                rpath, f,
+                download_cb=download_cb,
+                range_str=self['range'],
+                version=self['object_version'],
+                if_match=self['matching_etag'],
+                resume=self['resume'],
+                if_none_match=self['non_matching_etag'],
+                if_modified_since=self['modified_since_date'],
+                if_unmodified_since=self['unmodified_since_date'],
+                block_cache=self._block_cache,
+                journal=True,
+                verify=self['verify'])
+
+    def _download_one(self, rpath, lpath, resume):
+        self.error('/%s/%s --> %s' % (self.container, rpath, lpath))
+        progress_bar, download_cb = self._safe_progress_bar('  download')
+        try:
+            self._download(download_cb, rpath, lpath, resume)
+        finally:
+            self._safe_progress_bar_finish(progress_bar)
+
+    def _download_many(self, src_dst):
+        """Download many files at once, with one progress bar for all"""
+        if not src_dst:
+            return
+
+        def done_cb(transfer):
+            if transfer.exception:
+                self.error('%s: %s' % (transfer.name, transfer.exception))
             else:
-                yield (r, l)
+                self.error('/%s/%s --> %s' % (
+                    self.container, transfer.args[0], transfer.args[1]))
+        transfers = []
+        for rpath, lpath, resume in src_dst:
+            units = _progress_units(self._sizes.get(rpath, 0))
+            transfers.append(
+                (rpath, units, self._download, (rpath, lpath, resume)))
+        self._run_transfers(
+            transfers, done_cb, self['parallel_files'],
+            progress_msg='Downloading %s files' % len(src_dst),
+            failure_msg='%s of %s files failed to download')
 
     @errors.Generic.all
     @errors.Pithos.connection
@@ -1351,34 +1667,28 @@ class file_download(_PithosContainer):
     @errors.Pithos.local_path_download
     def _run(self, local_path):
         self.client.MAX_THREADS = int(self['max_threads'] or 5)
-        progress_bar = None
+        self._block_cache = None if self['no_block_cache'] else (
+            self._get_file_cache('block_cache'))
+        src_dst = self._src_dst(local_path)
+        #  Create the local directories, before downloading any files
+        for rpath, lpath, resume in src_dst:
+            if not rpath:
+                self.error('Create local directory %s' % lpath)
+                makedirs(lpath)
+        src_dst = [(r, l, resume) for r, l, resume in src_dst if r]
         try:
-            for rpath, output_file in self._src_dst(local_path):
-                if not rpath:
-                    self.error('Create local directory %s' % output_file)
-                    makedirs(output_file)
-                    continue
-                self.error('/%s/%s --> %s' % (
-                    self.container, rpath, output_file.name))
-                progress_bar, download_cb = self._safe_progress_bar(
-                    '  download')
-                self.client.download_object(
-                    rpath, output_file,
-                    download_cb=download_cb,
-                    range_str=self['range'],
-                    version=self['object_version'],
-                    if_match=self['matching_etag'],
-                    resume=self['resume'],
-                    if_none_match=self['non_matching_etag'],
-                    if_modified_since=self['modified_since_date'],
-                    if_unmodified_since=self['unmodified_since_date'])
+            if self['recursive']:
+                self._download_many(src_dst)
+            else:
+                for rpath, lpath, resume in src_dst:
+                    self._download_one(rpath, lpath, resume)
         except KeyboardInterrupt:
             timeout = 0.5
             msg = '\n'
-            while activeCount() > 1:
-                msg += 'Wait for %s threads: ' % (activeCount() - 1)
+            while _transfer_threads():
+                msg += 'Wait for %s threads: ' % len(_transfer_threads())
                 self._err.write(msg)
-                for thread in activethreads():
+                for thread in _transfer_threads():
                     try:
                         thread.join(timeout)
                         self._err.write('.' if thread.isAlive() else '*')
@@ -1389,8 +1699,6 @@ class file_download(_PithosContainer):
                         msg = '\b' * len(msg)
                         timeout += 0.1
             raise CLIError('Download canceled by user')
-        finally:
-            self._safe_progress_bar_finish(progress_bar)
         self.error('Download completed')
 
     def main(self, remote_path_or_url, local_path=None):
@@ -1405,6 +1713,268 @@ class file_download(_PithosContainer):
         self._run(local_path=local_path)
 
 
+@command(file_cmds)
+class file_sync(_PithosContainer):
+    """Synchronize a remote directory with a local one, or the opposite
+    Files are compared by size and modification time first, and then by
+    their block hashes. Only the files which differ are transferred, and
+    only the blocks which differ: uploads send the blocks missing from the
+    server, downloads fetch the blocks missing from the local files.
+    The default direction is from the local to the remote directory"""
+
+    arguments = dict(
+        download=FlagArgument(
+            'Synchronize the local directory with the remote one',
+            '--download'),
+        delete=FlagArgument(
+            'Delete destination files and directories which do not exist '
+            'in the source',
+            '--delete'),
+        dry_run=FlagArgument(
+            'Show what would be transferred or deleted, without doing it',
+            '--dry-run'),
+        checksum=FlagArgument(
+            'Compare the block hashes of all files of the same size, even if '
+            'their modification times show no change',
+            '--checksum'),
+        max_threads=IntArgument('default: 5', '--threads'),
+        parallel_files=IntArgument(
+            'Transfer up to that many files at once (default: 5)',
+            '--parallel-files'),
+        progress_bar=ProgressBarArgument(
+            'do not show progress bar', ('-N', '--no-progress-bar'),
+            default=False),
+    )
+
+    #  Kept next to files being downloaded, until they are complete
+    JOURNAL_SUFFIX = '.kamaki-journal'
+
+    def _local_tree(self, local_path):
+        """:returns: (dict, set) the files as {relative path: (size, mtime)}
+            and the directories, with / as a path separator. Download
+            journals are not synchronized"""
+        files, dirs = dict(), set()
+        for top, subdirs, names in walk(local_path):
+            rel = path.relpath(top, local_path).replace(path.sep, '/')
+            rel = '' if rel in ('.', ) else '%s/' % rel
+            dirs.update('%s%s' % (rel, d) for d in subdirs)
+            for name in names:
+                if name.endswith(self.JOURNAL_SUFFIX):
+                    continue
+                fpath = path.join(top, name)
+                if path.isfile(fpath):
+                    st = stat(fpath)
+                    files['%s%s' % (rel, name)] = (st.st_size, st.st_mtime)
+                else:
+                    self.error('%s not a regular file' % fpath)
+        return files, dirs
+
+    def _remote_tree(self, rpath):
+        """:returns: (dict, set) the objects as
+            {relative path: (size, mtime, hash)} and the directory objects"""
+        prefix = '%s/' % rpath if rpath else ''
+        files, dirs = dict(), set()
+        for o in self.client.iter_objects(prefix=prefix):
+            rel = o['name'][len(prefix):]
+            if not rel:
+                continue
+            if self.object_is_dir(o):
+                dirs.add(rel.rstrip('/'))
+            else:
+                files[rel] = (
+                    int(o['bytes']), _remote_mtime(o), o.get('hash', None))
+        return files, dirs
+
+    def _to_check(self, src, dst):
+        """Downloaded files get the mtime of their object, so any other
+        mtime means a change. An uploaded object is as old as its upload, so
+        only a file modified later may differ
+
+        :returns: (bool or None) True if the src file must be transferred,
+            False if the block hashes must be compared first, None if dst is
+            up to date"""
+        if dst is None or src[0] != dst[0]:
+            return True
+        if not src[0]:
+            return None
+        if self['checksum'] or None in (src[1], dst[1]):
+            return False
+        modified = (src[1] != dst[1]) if self['download'] else (
+            src[1] > dst[1])
+        return False if modified else None
+
+    def _same_blocks(self, lpath, rpath, rhash=None):
+        """Compare the hashmap of a local file to the one of an object, or to
+        the hash of the object, as listed. The local hashes are cached, so
+        files are not hashed again, unless they change
+
+        :param rhash: (str) the hash of the object in the listing, if any
+        """
+        with open(lpath, 'rb') as f:
+            local = self.client.get_file_hashmap(
+                f,
+                container_info_cache=self._container_info_cache,
+                hash_cache=self._hash_cache)
+        if rhash:
+            return local['hash'] == rhash
+        remote = self.client.get_object_hashmap(rpath)
+        return (local['bytes'], local['hashes']) == (
+            remote.get('bytes'), remote.get('hashes'))
+
+    def _sync_file(
+            self, progress_cb, lpath, rpath, changed, mtime, rhash=None):
+        """:returns: (bool) whether the file was (or would be) transferred"""
+        if not changed and self._same_blocks(lpath, rpath, rhash):
+            if self['download'] and mtime and not self['dry_run']:
+                utime(lpath, (mtime, mtime))
+            return False
+        if self['dry_run']:
+            return True
+        if self['download']:
+            resume = path.exists(lpath)
+            with open(lpath, 'rwb+' if resume else 'wb+') as f:
+                self.client.download_object(
+                    rpath, f,
+                    download_cb=progress_cb,
+                    resume=resume,
+                    block_cache=self._block_cache,
+                    journal=True)
+            if mtime:
+                utime(lpath, (mtime, mtime))
+        else:
+            ctype, cenc = guess_mime_type(lpath)
+            with open(lpath, 'rb') as f:
+                self.client.upload_object(
+                    rpath, f,
+                    upload_cb=progress_cb,
+                    content_type=ctype,
+                    content_encoding=cenc,
+                    container_info_cache=self._container_info_cache,
+                    hash_cache=self._hash_cache)
+        return True
+
+    def _make_dirs(self, local_path, rpath, dirs):
+        for d in sorted(dirs):
+            if self['download']:
+                dpath = path.join(local_path, d.replace('/', path.sep))
+                self.error('mkdir %s' % dpath)
+                if path.exists(dpath) and not path.isdir(dpath):
+                    raise CLIError(
+                        'Cannot replace local file %s with a directory' % (
+                            dpath),
+                        details=['Remove the file and try again'])
+                if not self['dry_run']:
+                    makedirs(dpath)
+            else:
+                dpath = '/'.join([p for p in (rpath, d) if p])
+                self.error('mkdir /%s/%s' % (self.container, dpath))
+                if not self['dry_run']:
+                    self.client.create_directory(dpath)
+
+    def _delete(self, local_path, rpath, files, dirs):
+        """Delete files, and then directories, deepest first"""
+        for rel in sorted(files) + sorted(dirs, reverse=True):
+            if self['download']:
+                lpath = path.join(local_path, rel.replace('/', path.sep))
+                self.error('delete %s' % lpath)
+                if self['dry_run']:
+                    continue
+                try:
+                    (rmdir if rel in dirs else remove)(lpath)
+                except OSError as e:
+                    self.error('Failed to delete %s: %s' % (lpath, e))
+            else:
+                opath = '/'.join([p for p in (rpath, rel) if p])
+                self.error('delete /%s/%s' % (self.container, opath))
+                if not self['dry_run']:
+                    self.client.del_object(opath)
+
+    @errors.Generic.all
+    @errors.Pithos.connection
+    @errors.Pithos.container
+    @errors.Pithos.object_path
+    @errors.Pithos.local_path
+    def _run(self, local_path, rpath):
+        self.client.MAX_THREADS = int(self['max_threads'] or 5)
+        self._hash_cache = self._get_file_cache('hashmap_cache')
+        self._block_cache = self._get_file_cache('block_cache')
+        self._container_info_cache = {
+            self.container: self.client.get_container_info()}
+        if not (self['download'] or path.isdir(local_path)):
+            raise CLIError('%s is not a directory' % local_path)
+
+        local_files, local_dirs = self._local_tree(local_path) if (
+            path.isdir(local_path)) else (dict(), set())
+        remote_files, remote_dirs = self._remote_tree(rpath)
+        if self['download']:
+            src_files, src_dirs = remote_files, remote_dirs
+            dst_files, dst_dirs = local_files, local_dirs
+            if rpath and not (remote_files or remote_dirs):
+                self.client.get_object_info(rpath)
+            #  Directory objects may be missing from the remote tree
+            src_dirs = src_dirs.union(
+                '/'.join(f.split('/')[:i]) for f in src_files for i in range(
+                    1, f.count('/') + 1))
+            new_dirs = set(src_dirs).difference(dst_dirs)
+            if not path.isdir(local_path):
+                new_dirs.add('')
+        else:
+            src_files, src_dirs = local_files, local_dirs
+            dst_files, dst_dirs = remote_files, remote_dirs
+            new_dirs = set(src_dirs).difference(dst_dirs)
+            if rpath and not (remote_files or remote_dirs):
+                try:
+                    if not self.object_is_dir(
+                            self.client.get_object_info(rpath)):
+                        new_dirs.add('')
+                except ClientError as ce:
+                    if ce.status not in (404, ):
+                        raise
+                    new_dirs.add('')
+        self._make_dirs(local_path, rpath, new_dirs)
+
+        def done_cb(transfer):
+            if transfer.exception:
+                self.error('%s: %s' % (transfer.name, transfer.exception))
+            elif transfer.value:
+                lpath, opath = transfer.args[:2]
+                self.error(('/%s/%s --> %s' if self['download'] else (
+                    '%s --> /%s/%s')) % ((self.container, opath, lpath) if (
+                        self['download']) else (lpath, self.container, opath)))
+        to_sync = []
+        for rel, src in sorted(src_files.items()):
+            changed = self._to_check(src, dst_files.get(rel))
+            if changed is None:
+                continue
+            lpath = path.join(local_path, rel.replace('/', path.sep))
+            opath = '/'.join([p for p in (rpath, rel) if p])
+            remote = src if self['download'] else dst_files.get(rel)
+            to_sync.append((rel, _progress_units(src[0]), self._sync_file, (
+                lpath, opath, changed, src[1], remote and remote[2])))
+        transfers, failed = self._run_transfers(
+            to_sync, done_cb, self['parallel_files'],
+            progress_msg=None if self['dry_run'] else 'Synchronizing',
+            failure_msg='%s of %s files failed to synchronize',
+            interrupt_msg='Synchronization canceled by user')
+
+        deleted = 0
+        if self['delete']:
+            old_files = set(dst_files).difference(src_files)
+            old_dirs = set(dst_dirs).difference(src_dirs)
+            self._delete(local_path, rpath, old_files, old_dirs)
+            deleted = len(old_files) + len(old_dirs)
+        transferred = len([t for t in transfers if t.value])
+        self.error('%s: %s files transferred, %s up to date, %s deleted' % (
+            'Dry run' if self['dry_run'] else 'Synchronization completed',
+            transferred, len(src_files) - transferred, deleted))
+
+    def main(self, local_path, remote_path_or_url):
+        super(self.__class__, self)._run(remote_path_or_url)
+        self._run(
+            local_path=path.abspath(local_path),
+            rpath=(self.path or '').strip('/'))
+
+
 @command(container_cmds)
 class container_info(_PithosAccount, OptionalOutput):
     """Get information about a container"""
@@ -1556,48 +2126,52 @@ class container_list(_PithosAccount, OptionalOutput, NameFilter):
                 self.print_objects(objects)
                 self.writeln('')
 
+    def _limited(self, listing, **kwargs):
+        """:returns: (iterator) the listed items, up to the requested number"""
+        limit = None if self['more'] else self['limit']
+        items = listing(page_size=limit, prefetch=not limit, **kwargs)
+        return islice(items, limit) if limit else items
+
     def _create_object_forest(self, container_list):
-        try:
-            for container in container_list:
-                self.client.container = container['name']
-                objects = self.client.container_get(
-                    limit=False if self['more'] else self['limit'],
+        """:returns: (generator) the containers, each with the list of its
+            objects. A container is listed when the previous one is consumed
+        """
+        for container in container_list:
+            self.client.container = container['name']
+            try:
+                container['objects'] = list(self._limited(
+                    self.client.iter_objects,
                     if_modified_since=self['modified_since_date'],
                     if_unmodified_since=self['unmodified_since_date'],
                     until=self['until_date'],
                     show_only_shared=self['shared_by_me'],
-                    public=self['public'])
-                container['objects'] = objects.json
-        finally:
-            self.client.container = None
+                    public=self['public']))
+            finally:
+                self.client.container = None
+            yield container
 
     @errors.Generic.all
     @errors.Pithos.connection
     @errors.Pithos.container
     def _run(self):
         container = self.container
-        if container:
-            r = self.client.container_get(
-                limit=False if self['more'] else self['limit'],
-                marker=self['marker'],
-                if_modified_since=self['modified_since_date'],
-                if_unmodified_since=self['unmodified_since_date'],
-                until=self['until_date'],
-                show_only_shared=self['shared_by_me'],
-                public=self['public'])
-        else:
-            r = self.client.account_get(
-                limit=False if self['more'] else self['limit'],
-                marker=self['marker'],
-                if_modified_since=self['modified_since_date'],
-                if_unmodified_since=self['unmodified_since_date'],
-                until=self['until_date'],
-                show_only_shared=self['shared_by_me'],
-                public=self['public'])
-        items = list(r.json or [])
-        files = self._filter_by_name(items)
+        listing = self.client.iter_objects if (
+            container) else self.client.iter_containers
+        items = self._limited(
+            listing,
+            marker=self['marker'],
+            if_modified_since=self['modified_since_date'],
+            if_unmodified_since=self['unmodified_since_date'],
+            until=self['until_date'],
+            show_only_shared=self['shared_by_me'],
+            public=self['public'])
+        #  Items are printed as they are listed, unless the whole listing is
+        #  needed: to format it, or to align the enumeration of objects
+        files = self._iter_by_name(items)
         if self['recursive'] and not container:
-            self._create_object_forest(files)
+            files = self._create_object_forest(files)
+        if self['output_format'] or (self['enum'] and container):
+            files = list(files)
         if self['more']:
             outbu, self._out = self._out, StringIO()
         try:
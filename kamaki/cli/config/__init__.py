@@ -57,6 +57,7 @@ log = getLogger(__name__)
 # Path to the file that stores the configuration
 CONFIG_PATH = os.path.expanduser('~/.kamakirc')
 HISTORY_PATH = os.path.expanduser('~/.kamaki.history')
+HASHMAP_CACHE_PATH = os.path.expanduser('~/.kamaki.cache/hashmaps')
 CLOUD_PREFIX = 'cloud'
 
 # Name of a shell variable to bypass the CONFIG_PATH value
@@ -85,8 +86,19 @@ DEFAULTS = {
         'log_token': 'off',
         'log_data': 'off',
         'log_pid': 'off',
+        'trace_file': '',
+        'trace_sample_rate': 1.0,
         'history_file': HISTORY_PATH,
         'history_limit': 0,
+        'hashmap_cache': HASHMAP_CACHE_PATH,
+        'hashmap_cache_limit': 16 * 1024 * 1024,
+        'download_range_blocks': 4,
+        'block_cache': '',
+        'block_cache_limit': 1024 * 1024 * 1024,
+        'response_cache': '',
+        'response_cache_limit': 64 * 1024 * 1024,
+        'connection_timeout': 10,
+        'read_timeout': 60,
         'user_cli': 'astakos',
         'quota_cli': 'astakos',
         'resource_cli': 'astakos',
@@ -98,10 +98,11 @@ def _add_logger(name, level=None, filename=None, fmt=None):
 
 
 @if_logger_enabled
-def add_file_logger(name, level=None, filename=None):
+def add_file_logger(name, level=None, filename=None, fmt=None):
     try:
-        fmt = '%(name)s(%(levelname)s) %(asctime)s\n  %(message)s' if (
-            level == logging.DEBUG) else '%(name)s: %(message)s'
+        fmt = fmt or (
+            '%(name)s(%(levelname)s) %(asctime)s\n  %(message)s' if (
+                level == logging.DEBUG) else '%(name)s: %(message)s')
         return _add_logger(
             name, level, filename or get_log_filename(), fmt=fmt)
     except Exception:
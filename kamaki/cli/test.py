@@ -261,6 +261,9 @@ class LoggerMethods(TestCase):
                 else:
                     GLFcount = GLF.call_count
                     self.assertEqual(GLF.mock_calls[-1], call())
+            add_file_logger('my name', None, 'my filename', fmt='%(message)s')
+            self.assertEqual(AL.mock_calls[-1], call(
+                'my name', None, 'my filename', fmt='%(message)s'))
         with patch('kamaki.cli.logger._add_logger', side_effect=Exception):
             self.assertEqual(add_file_logger('X'), 'my get logger ret')
             GL.assert_called_once_with('X')
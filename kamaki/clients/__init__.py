@@ -32,18 +32,28 @@
 
 from urllib2 import quote, unquote
 from urlparse import urlparse
-from threading import Thread
+from threading import Thread, Event, Lock, local as local_data
+from Queue import Queue, Full
 from json import dumps, loads
 from time import time
-from httplib import ResponseNotReady, HTTPException
+from httplib import HTTPException, IncompleteRead
 from time import sleep
-from random import random
-from logging import getLogger
+from random import uniform
+from email.utils import parsedate_tz, mktime_tz
+from logging import getLogger, DEBUG, INFO
+from copy import copy
+from sys import exc_info
+import socket
 import ssl
 
 from kamaki.clients.utils import https
 
 from kamaki.clients import utils
+from kamaki.clients.utils import stats
+from kamaki.clients.utils.eventloop import (
+    Future, get_event_loop, resolve, Return)
+from kamaki.clients.utils.limiter import get_concurrency_limiter
+from kamaki.clients.utils.singleflight import SingleFlight
 
 
 TIMEOUT = 60.0   # seconds
@@ -53,6 +63,9 @@ log = getLogger(__name__)
 sendlog = getLogger('%s.send' % __name__)
 recvlog = getLogger('%s.recv' % __name__)
 
+#  Identical GETs in flight, shared by all clients
+_single_flight = SingleFlight()
+
 
 def _encode(v):
     if v and isinstance(v, unicode):
@@ -60,6 +73,31 @@ def _encode(v):
     return v
 
 
+#  Parsed endpoint urls, and header quoting decisions per set of rules
+_endpoints, _quoted_headers, _CACHE_LIMIT = dict(), dict(), 1024
+
+
+def _endpoint_info(url):
+    """:returns: (tuple) the url with a trailing slash, its scheme, netloc
+        and path, and whether it is simple, i.e., it has no params, query or
+        fragment. Results are cached
+    """
+    try:
+        return _endpoints[url]
+    except KeyError:
+        pass
+    base = url or 'http://127.0.0.1/'
+    base += '' if base.endswith('/') else '/'
+    parsed = urlparse(base)
+    info = (
+        base, parsed.scheme, parsed.netloc, parsed.path or '/',
+        not (parsed.params or parsed.query or parsed.fragment))
+    if len(_endpoints) >= _CACHE_LIMIT:
+        _endpoints.clear()
+    _endpoints[url] = info
+    return info
+
+
 class ClientError(Exception):
     def __init__(self, message, status=0, details=None):
         log.debug('ClientError: msg[%s], sts[%s], dtl[%s]' % (
@@ -111,6 +149,78 @@ class Logged(object):
     _token = None
 
 
+class RetryPolicy(object):
+    """Decide whether a failed request is retried and how long to wait first
+
+    Requests are retried on connection errors (timeouts included, but not
+    FATAL_ERRORS) and on the RETRY_STATUSES responses. A request which is not
+    idempotent (e.g., a POST) is retried only on errors before it was sent,
+    and on statuses which mean it was not processed (429, 503), unless the
+    caller marks it idempotent.
+    Waits grow exponentially with full jitter: a random time between 0 and
+    min(max_delay, base_delay * 2 ** attempt). A Retry-After header, if any,
+    overrides this, up to max_delay.
+
+    :param retries: (int) the maximum number of retries, 0 for none
+
+    :param base_delay: (float) seconds
+
+    :param max_delay: (float) seconds
+
+    :param statuses: (tuple) of HTTP statuses to retry on, RETRY_STATUSES by
+        default
+    """
+
+    IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE', 'COPY', 'MOVE')
+    RETRY_STATUSES = (429, 502, 503, 504)
+    NOT_PROCESSED_STATUSES = (429, 503)
+    RETRY_ERRORS = (HTTPException, socket.error)
+    #  Connection errors which a retry can not fix, e.g., unknown hosts
+    FATAL_ERRORS = (socket.gaierror, socket.herror)
+
+    def __init__(
+            self, retries=3, base_delay=0.5, max_delay=30.0, statuses=None):
+        self.retries = retries
+        self.base_delay, self.max_delay = base_delay, max_delay
+        self.statuses = self.RETRY_STATUSES if (
+            statuses is None) else tuple(statuses)
+
+    def is_idempotent(self, method, idempotent=None):
+        if idempotent is not None:
+            return idempotent
+        return method.upper() in self.IDEMPOTENT_METHODS
+
+    def retry_status(self, method, status, attempt, idempotent=None):
+        """:returns: (bool) whether to retry after a response of status"""
+        if attempt >= self.retries or status not in self.statuses:
+            return False
+        return self.is_idempotent(method, idempotent) or (
+            status in self.NOT_PROCESSED_STATUSES)
+
+    def retry_error(self, method, error, attempt, idempotent=None, sent=True):
+        """:returns: (bool) whether to retry after a connection error
+
+        :param sent: (bool) False if the request failed before it was sent
+            (e.g., on a stale pooled connection), so it was not processed
+        """
+        if attempt >= self.retries or isinstance(error, self.FATAL_ERRORS) or (
+                not isinstance(error, self.RETRY_ERRORS)):
+            return False
+        return self.is_idempotent(method, idempotent) or not sent
+
+    def delay(self, attempt, retry_after=None):
+        """:returns: (float) seconds to wait before retry #attempt + 1"""
+        if retry_after:
+            try:
+                wait = float(retry_after)
+            except ValueError:
+                date = parsedate_tz(retry_after)
+                wait = (mktime_tz(date) - time()) if date else None
+            if wait is not None:
+                return min(self.max_delay, max(0.0, wait))
+        return uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
 class RequestManager(Logged):
     """Handle http request information"""
 
@@ -124,17 +234,22 @@ class RequestManager(Logged):
 
         :returns: (scheme, netloc)
         """
-        url = url or 'http://127.0.0.1/'
-        url += '' if url.endswith('/') else '/'
+        base, scheme, netloc, base_path, simple = _endpoint_info(url)
         if path:
-            url += _encode(path[1:] if path.startswith('/') else path)
-        delim = '?'
+            path = _encode(path[1:] if path.startswith('/') else path)
+        query = []
         for key, val in params.items():
             val = quote('' if val in (None, False) else '%s' % _encode(val))
-            url += '%s%s%s' % (delim, key, ('=%s' % val) if val else '')
-            delim = '&'
-        parsed = urlparse(url)
+            query.append(('%s=%s' % (key, val)) if val else key)
+        query = '&'.join(query)
+        url = base + (path or '') + ('?%s' % query if query else '')
         self.url = '%s' % url
+        if simple and not (path and (
+                '?' in path or ';' in path or '#' in path)):
+            self.path = base_path + (path or '') + (
+                '?%s' % query if query else '')
+            return (scheme, netloc)
+        parsed = urlparse(url)
         self.path = (('%s' % parsed.path) if parsed.path else '/') + (
             '?%s' % parsed.query if parsed.query else '')
         return (parsed.scheme, parsed.netloc)
@@ -148,65 +263,98 @@ class RequestManager(Logged):
             assert isinstance(headers, dict)
         self.headers = dict(headers)
         self.method, self.data = method, data
+        self.sent = False
         self.scheme, self.netloc = self._connection_info(url, path, params)
         self._headers_to_quote, self._header_prefices = [], []
 
     def dump_log(self):
+        """Log the request, if the send logger is enabled for INFO messages.
+        Otherwise, no message is constructed at all
+        """
+        if not sendlog.isEnabledFor(INFO):
+            return
         plog = ('\t[%s]' % self) if self.LOG_PID else ''
-        sendlog.info('%s %s://%s%s%s' % (
-            self.method, self.scheme, self.netloc, self.path, plog))
+        sendlog.info(
+            '%s %s://%s%s%s',
+            self.method, self.scheme, self.netloc, self.path, plog)
         for key, val in self.headers.items():
             if key.lower() in ('x-auth-token', ) and not self.LOG_TOKEN:
                 self._token, val = val, '...'
-            sendlog.info('  %s: %s%s' % (key, val, plog))
+            sendlog.info('  %s: %s%s', key, val, plog)
         if self.data:
-            sendlog.info('data size: %s%s' % (len(self.data), plog))
+            sendlog.info('data size: %s%s', len(self.data), plog)
             if self.LOG_DATA:
-                sendlog.info(utils.escape_ctrl_chars(self.data.replace(
-                    self._token, '...') if self._token else self.data))
+                data = '%s' % self.data
+                sendlog.info(utils.escape_ctrl_chars(data.replace(
+                    self._token, '...') if self._token else data))
         else:
-            sendlog.info('data size: 0%s' % plog)
+            sendlog.info('data size: 0%s', plog)
 
     def _encode_headers(self):
+        rules = (tuple(self._headers_to_quote), tuple(self._header_prefices))
+        try:
+            quotable = _quoted_headers[rules]
+        except KeyError:
+            if len(_quoted_headers) >= _CACHE_LIMIT:
+                _quoted_headers.clear()
+            quotable = _quoted_headers[rules] = dict()
         headers = dict()
         for k, v in self.headers.items():
-            key = k.lower()
-            val = '' if v is None else '%s' % (
-                v.encode('utf-8') if isinstance(v, unicode) else v)
-            quotable = any([key in self._headers_to_quote, ]) or any(
-                [key.startswith(p) for p in self._header_prefices])
-            headers[k] = quote(val) if quotable else val
+            try:
+                quote_it = quotable[k]
+            except KeyError:
+                key = k.lower()
+                quote_it = quotable[k] = key in rules[0] or key.startswith(
+                    rules[1])
+            if v is None:
+                val = ''
+            elif isinstance(v, str):
+                val = v
+            else:
+                val = '%s' % (
+                    v.encode('utf-8') if isinstance(v, unicode) else v)
+            headers[k] = quote(val) if quote_it else val
         self.headers = headers
 
-    def perform(self, conn):
+    def perform(self, conn, connection_timeout=None, read_timeout=None):
         """
         :param conn: (httplib connection object)
 
+        :param connection_timeout: (float) seconds to wait for a connection,
+            if conn is not connected yet. None for no limit
+
+        :param read_timeout: (float) seconds to wait on the socket for each
+            send or receive. None for no limit
+
         :returns: (HTTPResponse)
+
+        :raises socket.timeout: to be retried, if the retry policy allows it.
+            Check self.sent to tell if it timed out before the request was
+            sent or while waiting for the response
         """
         self._encode_headers()
         self.dump_log()
+        self.sent = False
         try:
+            if conn.sock is None:
+                conn.timeout = connection_timeout
+                conn.connect()
+            conn.sock.settimeout(read_timeout)
             conn.request(
                 method=self.method.upper(),
                 url=self.path.encode('utf-8'),
                 headers=self.headers,
                 body=self.data)
+            self.sent = True
             sendlog.info('')
-            keep_trying = TIMEOUT
-            while keep_trying > 0:
-                try:
-                    return conn.getresponse()
-                except ResponseNotReady:
-                    wait = 0.03 * random()
-                    sleep(wait)
-                    keep_trying -= wait
+            return conn.getresponse()
+        except socket.timeout:
+            recvlog.debug(
+                'Kamaki Timeout %s %s%s', self.method, self.path,
+                ('\t[%s]' % self) if self.LOG_PID else '')
+            raise
         except ssl.SSLError as ssle:
             raise KamakiSSLError('SSL Connection error (%s)' % ssle)
-        plog = ('\t[%s]' % self) if self.LOG_PID else ''
-        logmsg = 'Kamaki Timeout %s %s%s' % (self.method, self.path, plog)
-        recvlog.debug(logmsg)
-        raise ClientError('HTTPResponse takes too long - kamaki timeout')
 
     @property
     def headers_to_quote(self):
@@ -230,19 +378,49 @@ class RequestManager(Logged):
 class ResponseManager(Logged):
     """Manage the http request and handle the response data, headers, etc."""
 
-    def __init__(self, request, poolsize=None, connection_retry_limit=0):
+    def __init__(
+            self, request, poolsize=None, connection_retry_limit=0,
+            stream=False, connection_timeout=None, read_timeout=None,
+            retry_policy=None, idempotent=None, response_cache=None):
         """
         :param request: (RequestManager)
 
         :param poolsize: (int) the size of the connection pool
 
-        :param connection_retry_limit: (int)
+        :param connection_retry_limit: (int) immediate retries on connection
+            errors, if there is no retry_policy
+
+        :param retry_policy: (RetryPolicy)
+
+        :param idempotent: (bool) whether the request is safe to retry, if
+            not implied by its method (e.g., a POST of a Pithos block)
+
+        :param connection_timeout: (float) in seconds, None for no limit
+
+        :param read_timeout: (float) in seconds, None for no limit
+
+        :param stream: (bool) do not read the response body in advance. It
+            is read with iter_content, and the connection is kept out of the
+            pool until then
+
+        :param response_cache: (FileCache) if given, the response to a GET
+            is stored there, if it has an ETag or a Last-Modified header. The
+            next GET of the same url with the same token is conditional, and
+            a 304 (Not Modified) is served from the cache
         """
-        self.CONNECTION_TRY_LIMIT = 1 + connection_retry_limit
+        self.retry_policy = retry_policy or RetryPolicy(
+            retries=connection_retry_limit, base_delay=0.0, statuses=())
+        self.idempotent = idempotent
         self.request = request
         self._request_performed = False
         self.poolsize = poolsize
+        self.stream = stream
+        self.service, self._stats = '', None
+        self.connection_timeout = connection_timeout
+        self.read_timeout = read_timeout
+        self._response, self._pooled_connection = None, None
         self._headers_to_decode, self._header_prefices = [], []
+        self.response_cache = response_cache
 
     def _get_headers_to_decode(self, headers):
         keys = set([k.lower() for k, v in headers])
@@ -255,58 +433,358 @@ class ResponseManager(Logged):
             return False
         return encodable + filter(has_prefix, keys.difference(encodable))
 
+    CONDITIONAL_HEADERS = ('if-none-match', 'if-modified-since', 'range')
+
+    def _cache_key(self):
+        """:returns: (str) the key of the response in the response_cache, or
+            None if the request is not cacheable"""
+        if self.response_cache is None or self.stream or (
+                self.request.method.upper() != 'GET'):
+            return None
+        for key in self.request.headers:
+            if key.lower() in self.CONDITIONAL_HEADERS:
+                return None
+        return '%s %s' % (self._token or '', self.request.url)
+
+    def _get_cached(self, key):
+        """Make the request conditional, if there is a cached response
+        :returns: (tuple) the cached status, reason, headers and body, or None
+        """
+        value = self.response_cache.get(key)
+        if value is None:
+            return None
+        try:
+            meta, content = value.split('\n', 1)
+            status, reason, headers = loads(meta)
+        except ValueError:
+            self.response_cache.delete(key)
+            return None
+        validators = dict((k.lower(), v) for k, v in headers)
+        if 'etag' in validators:
+            self.request.headers['If-None-Match'] = validators['etag']
+        if 'last-modified' in validators:
+            self.request.headers['If-Modified-Since'] = validators[
+                'last-modified']
+        headers = [(k.encode('utf-8'), v.encode('utf-8')) for k, v in headers]
+        return status, reason.encode('utf-8'), headers, content
+
+    def _set_cached(self, key, status, reason, headers, content):
+        """Cache a response, if it can be validated later"""
+        validators = dict((k.lower(), v) for k, v in headers)
+        if 'no-store' in validators.get('cache-control', '') or not (
+                'etag' in validators or 'last-modified' in validators):
+            return
+        try:
+            meta = dumps([status, reason, headers])
+        except (TypeError, ValueError):
+            return
+        self.response_cache.set(key, '%s\n%s' % (meta, content or ''))
+
+    @property
+    def _plog(self):
+        return ('\t[%s]' % self) if self.LOG_PID else ''
+
+    def _start(self):
+        """Start the stats of the request, if they are collected, and look it
+        up in the response cache
+
+        :returns: (tuple) the cache key, and the cached response or None
+        """
+        if stats.collecting():
+            self._stats = stats.RequestStats(
+                self.request.method.upper(), self.request.url, self.service,
+                sent=len(self.request.data or ''))
+        self.request.LOG_TOKEN = self.LOG_TOKEN
+        self.request.LOG_DATA = self.LOG_DATA
+        self.request.LOG_PID = self.LOG_PID
+        cache_key = self._cache_key()
+        return cache_key, self._get_cached(cache_key) if cache_key else None
+
+    def _retry_wait(self, r, attempt):
+        """:returns: (float) seconds to wait before retrying after response
+            r, or None if r is final
+        """
+        if self._stats:
+            self._stats.status = r.status
+        if self.LOG_PID and recvlog.isEnabledFor(INFO):
+            recvlog.info('\n%s <-- %s <-- [req: %s]\n', self, r, self.request)
+        if not self.retry_policy.retry_status(
+                self.request.method, r.status, attempt, self.idempotent):
+            return None
+        r.read()
+        wait = self.retry_policy.delay(attempt, r.getheader('Retry-After'))
+        recvlog.info(
+            '%d %s, retry in %.2fs%s', r.status, r.reason, wait, self._plog)
+        return wait
+
+    def _retry_error(self, err, attempt):
+        """Call it while handling err
+
+        :returns: (float) seconds to wait before retrying after a connection
+            error
+
+        :raises: err (a ClientError for connection errors), if it is final
+        """
+        error = exc_info()
+        if self.retry_policy.retry_error(
+                self.request.method, err, attempt, self.idempotent,
+                sent=self.request.sent):
+            wait = self.retry_policy.delay(attempt)
+            recvlog.info('%s: %s, retry in %.2fs', type(err), err, wait)
+            return wait
+        self._finish_stats(error=err)
+        if isinstance(err, (HTTPException, socket.error)):
+            raise self._connection_error(err, attempt + 1)
+        if recvlog.isEnabledFor(DEBUG):
+            from traceback import format_stack
+            recvlog.debug('\n'.join(['%s' % type(err)] + format_stack()))
+        raise error[0], error[1], error[2]
+
+    def _set_status(self, r, cached):
+        """Keep the status and headers of response r, or the cached ones, if
+        r is a 304 (Not Modified)
+
+        :returns: (tuple) the cached response, if served, else None
+        """
+        self._request_performed = True
+        status, reason, r_headers = r.status, r.reason, r.getheaders()
+        served = cached if (cached and status == 304) else None
+        if served:
+            r.read()
+            status, reason, r_headers, content = served
+            recvlog.info('304 %s, served from cache%s', r.reason, self._plog)
+        self._status_code, self._status = status, unquote(reason)
+        self._headers = dict()
+
+        enc_headers = self._get_headers_to_decode(r_headers)
+        for k, v in r_headers:
+            self._headers[k] = unquote(v).decode('utf-8') if (
+                k.lower()) in enc_headers else v
+        if recvlog.isEnabledFor(INFO):
+            plog = self._plog
+            recvlog.info('%d %s%s', self.status_code, self.status, plog)
+            for k, v in r_headers:
+                recvlog.info('  %s: %s%s', k, v, plog)
+        return served
+
+    def _set_content(self, r, served, cache_key):
+        """Keep the body of response r, or the cached one, if served"""
+        if served:
+            self._content = served[3]
+        else:
+            self._content = r.read()
+            if cache_key and r.status == 200:
+                self._set_cached(
+                    cache_key, r.status, r.reason, r.getheaders(),
+                    self._content)
+        self._finish_stats(len(self._content or ''))
+        if recvlog.isEnabledFor(INFO):
+            plog = self._plog
+            recvlog.info('data size: %s%s', len(self._content or ''), plog)
+            if self.LOG_DATA and self._content:
+                data = '%s%s' % (self._content, plog)
+                if self._token:
+                    data = data.replace(self._token, '...')
+                recvlog.info(utils.escape_ctrl_chars(data))
+
     def _get_response(self):
         if self._request_performed:
             return
-
         pool_kw = dict(size=self.poolsize) if self.poolsize else dict()
-        for retries in range(1, self.CONNECTION_TRY_LIMIT + 1):
+        cache_key, cached = self._start()
+        attempt, wait = 0, 0.0
+        while True:
+            if wait:
+                sleep(wait)
+            pooled, self.request.sent = None, False
             try:
-                with https.PooledHTTPConnection(
-                        self.request.netloc, self.request.scheme,
-                        **pool_kw) as connection:
-                    self.request.LOG_TOKEN = self.LOG_TOKEN
-                    self.request.LOG_DATA = self.LOG_DATA
-                    self.request.LOG_PID = self.LOG_PID
-                    r = self.request.perform(connection)
-                    plog = ''
-                    if self.LOG_PID:
-                        recvlog.info('\n%s <-- %s <-- [req: %s]\n' % (
-                            self, r, self.request))
-                        plog = '\t[%s]' % self
-                    self._request_performed = True
-                    self._status_code, self._status = r.status, unquote(
-                        r.reason)
-                    recvlog.info(
-                        '%d %s%s' % (self.status_code, self.status, plog))
-                    self._headers = dict()
-
-                    r_headers = r.getheaders()
-                    enc_headers = self._get_headers_to_decode(r_headers)
-                    for k, v in r_headers:
-                        self._headers[k] = unquote(v).decode('utf-8') if (
-                            k.lower()) in enc_headers else v
-                        recvlog.info('  %s: %s%s' % (k, v, plog))
-                    self._content = r.read()
-                    recvlog.info('data size: %s%s' % (
-                        len(self._content) if self._content else 0, plog))
-                    if self.LOG_DATA and self._content:
-                        data = '%s%s' % (self._content, plog)
-                        if self._token:
-                            data = data.replace(self._token, '...')
-                        recvlog.info(utils.escape_ctrl_chars(data))
+                pooled = https.PooledHTTPConnection(
+                    self.request.netloc, self.request.scheme, **pool_kw)
+                connection = pooled.acquire()
+                if self._stats:
+                    self._stats.acquired()
+                    self._stats.retries = attempt
+                r = self.request.perform(
+                    connection, self.connection_timeout, self.read_timeout)
+                if self._stats:
+                    self._stats.first_byte()
+                wait = self._retry_wait(r, attempt)
+                if wait is not None:
+                    attempt += 1
+                    continue
+                served = self._set_status(r, cached)
+                if self.stream:
+                    #  The connection is released when the body is read
+                    self._content = None
+                    self._response, self._pooled_connection = r, pooled
+                    pooled = None
+                    recvlog.info('data size: (streamed)%s', self._plog)
+                    break
+                self._set_content(r, served, cache_key)
                 break
             except Exception as err:
-                if isinstance(err, HTTPException):
-                    if retries >= self.CONNECTION_TRY_LIMIT:
-                        raise ClientError(
-                            'Connection to %s failed %s times (%s: %s )' % (
-                                self.request.url, retries, type(err), err))
-                else:
-                    from traceback import format_stack
-                    recvlog.debug(
-                        '\n'.join(['%s' % type(err)] + format_stack()))
+                wait = self._retry_error(err, attempt)
+                attempt += 1
+            finally:
+                if pooled and pooled.obj:
+                    pooled.release()
+
+    def perform_async(self, loop):
+        """Perform the request on an event loop, without waiting. It is
+        retried and cached like a blocking one, but it can not be streamed
+
+        :param loop: (EventLoop)
+
+        :returns: (Task) its result is self, performed
+        """
+        assert not self.stream, 'Streamed requests are not performed async'
+        return loop.spawn(self._perform_async(loop))
+
+    def _perform_async(self, loop):
+        if self._request_performed:
+            raise Return(self)
+        cache_key, cached = self._start()
+        self.request._encode_headers()
+        attempt, wait = 0, 0.0
+        while True:
+            if wait:
+                yield loop.sleep(wait)
+            self.request.sent = False
+            self.request.dump_log()
+            if self._stats:
+                self._stats.retries = attempt
+            try:
+                try:
+                    r = yield loop.fetch(
+                        self.request, self.connection_timeout,
+                        self.read_timeout, self.poolsize, self._stats)
+                except ssl.SSLError as ssle:
+                    raise KamakiSSLError('SSL Connection error (%s)' % ssle)
+            except Exception as err:
+                wait = self._retry_error(err, attempt)
+                attempt += 1
+                continue
+            wait = self._retry_wait(r, attempt)
+            if wait is None:
+                break
+            attempt += 1
+        self._set_content(r, self._set_status(r, cached), cache_key)
+        raise Return(self)
+
+    def _connection_error(self, err, attempts):
+        """:returns: (ClientError) for a connection error, out of retries.
+            The connection error is kept as its errobject
+        """
+        if isinstance(err, socket.timeout):
+            error = ClientError('Connection to %s timed out (%s)' % (
+                self.request.netloc, err))
+        else:
+            error = ClientError(
+                'Connection to %s failed %s times (%s: %s )' % (
+                    self.request.url, attempts, type(err), err))
+        error.errobject = err
+        return error
+
+    def iter_content(self, chunk_size=64 * 1024):
+        """Iterate over the response body, a chunk at a time. In stream mode,
+        chunks are read from the connection, which goes back to the pool when
+        the body is exhausted or the iteration is stopped early. If the
+        connection fails while a GET body is streamed, the rest of the body
+        is requested again, according to the retry policy
+
+        :param chunk_size: (int) in bytes
+
+        :returns: (generator) of str
+        """
+        self._get_response()
+        if self._response is None:
+            content = self._content or ''
+            for i in xrange(0, len(content), chunk_size):
+                yield content[i:i + chunk_size]
+            return
+        received, attempt = 0, 0
+        try:
+            while True:
+                try:
+                    chunk = self._response.read(chunk_size)
+                    #  httplib returns a short body as if it was complete
+                    missing = getattr(self._response, 'length', None)
+                    if not chunk and missing:
+                        raise IncompleteRead('', missing)
+                except Exception as err:
+                    if self._resume(err, received, attempt):
+                        received, attempt = 0, attempt + 1
+                        continue
+                    if isinstance(err, (HTTPException, socket.error)):
+                        self._finish_stats(error=err)
+                        raise self._connection_error(err, attempt + 1)
                     raise
+                if not chunk:
+                    break
+                received += len(chunk)
+                if self._stats:
+                    self._stats.received += len(chunk)
+                yield chunk
+        finally:
+            self.release()
+
+    def _resume(self, err, received, attempt):
+        """Request the rest of a streamed GET body, from the first byte not
+        received since the last request, if the retry policy allows it. The
+        request is conditional on the ETag of the response, so that all parts
+        come from the same object. Status and headers are kept from the first
+        response
+
+        :returns: (bool) whether the body is streamed again
+        """
+        request, policy = self.request, self.retry_policy
+        if request.method.upper() != 'GET' or not policy.retry_error(
+                'GET', err, attempt):
+            return False
+        etag = [v for k, v in self._headers.items() if k.lower() == 'etag']
+        key = ([k for k in request.headers if k.lower() == 'range'] or [
+            'Range'])[0]
+        unit, sep, byte_range = request.headers.get(
+            key, 'bytes=0-').partition('=')
+        first, sep, last = byte_range.partition('-')
+        if not (etag and first.isdigit()) or ',' in byte_range:
+            return False
+        wait = policy.delay(attempt)
+        recvlog.info(
+            '%s: %s, resume at byte %s in %.2fs',
+            type(err), err, int(first) + received, wait)
+        self._finish_stats(error=err)
+        self.release()
+        sleep(wait)
+        request.headers[key] = 'bytes=%s-%s' % (int(first) + received, last)
+        request.headers['If-Match'] = etag[0]
+        status = self._status_code, self._status, self._headers
+        self._request_performed = False
+        self._get_response()
+        resumed = self._status_code == 206 and self._response is not None
+        self._status_code, self._status, self._headers = status
+        if not resumed:
+            self.release()
+        return resumed
+
+    def release(self):
+        """Give the connection of a streamed response back to the pool. If
+        the body is not fully read, the connection is closed first
+        """
+        pooled, r = self._pooled_connection, self._response
+        self._pooled_connection, self._response = None, None
+        if pooled:
+            if not r.isclosed():
+                pooled.obj.close()
+            pooled.release()
+            self._finish_stats()
+
+    def _finish_stats(self, received=0, error=None):
+        """Pass the stats of this request, if kept, to the collectors"""
+        if self._stats:
+            self._stats.received += received
+            self._stats.finish(error)
+            self._stats = None
 
     @property
     def status_code(self):
@@ -325,7 +803,10 @@ class ResponseManager(Logged):
 
     @property
     def content(self):
+        """In stream mode, the part of the body that is not read yet"""
         self._get_response()
+        if self._response is not None:
+            self._content = ''.join(self.iter_content())
         return self._content
 
     @property
@@ -333,8 +814,7 @@ class ResponseManager(Logged):
         """
         :returns: (str) content
         """
-        self._get_response()
-        return '%s' % self._content
+        return '%s' % self.content
 
     @property
     def headers_to_decode(self):
@@ -359,9 +839,8 @@ class ResponseManager(Logged):
         """
         :returns: (dict) squeezed from json-formated content
         """
-        self._get_response()
         try:
-            return loads(self._content)
+            return loads(self.content)
         except ValueError as err:
             raise ClientError('Response not formated in JSON - %s' % err)
 
@@ -390,11 +869,168 @@ class SilentEvent(Thread):
             self._exception = e
 
 
+class WorkerJob(object):
+    """A method(*args, **kwargs) call, to be run by a WorkerPool worker
+    It can be handled like a SilentEvent (value, exception, isAlive, join)
+    """
+
+    def __init__(self, method, *args, **kwargs):
+        self.method, self.args, self.kwargs = method, args, kwargs
+        self._done, self._canceled = Event(), False
+
+    @property
+    def exception(self):
+        return getattr(self, '_exception', False)
+
+    @property
+    def value(self):
+        return getattr(self, '_value', None)
+
+    def run(self):
+        try:
+            if self._canceled:
+                raise ClientError('Job canceled before it was run')
+            self._value = self.method(*(self.args), **(self.kwargs))
+        except Exception as e:
+            estatus = e.status if isinstance(e, ClientError) else ''
+            recvlog.debug('Job %s got exception %s\n<%s %s' % (
+                self, type(e), estatus, e))
+            self._exception = e
+        finally:
+            self._done.set()
+
+    def cancel(self):
+        """If not started yet, the job will fail instead of running"""
+        self._canceled = True
+
+    def isAlive(self):
+        return not self._done.is_set()
+
+    is_alive = isAlive
+
+    def result(self, timeout=None):
+        """Wait for the job to finish
+
+        :returns: the value of the method call
+
+        :raises: the exception of the method call, if any
+        """
+        self.join(timeout)
+        if self.isAlive():
+            raise ClientError('Job %s is not finished' % self)
+        if self.exception:
+            raise self.exception
+        return self.value
+
+    def join(self, timeout=None):
+        """Wait in short steps, so that KeyboardInterrupt is not blocked"""
+        if timeout is not None:
+            self._done.wait(timeout)
+            return
+        while not self._done.is_set():
+            self._done.wait(0.1)
+
+
+class WorkerPool(object):
+    """A bounded set of long-lived threads, consuming WorkerJobs off a queue
+    Workers pick the next job as soon as they finish one. The queue is
+    bounded as well, so that producers (e.g., block readers) block instead of
+    running ahead of the workers.
+    Workers are daemon threads: an interrupted process does not wait for them
+    """
+
+    def __init__(self, size=1, backlog=None):
+        assert isinstance(size, int) and size > 0, 'Pool size not a +int'
+        self.size = size
+        self._jobs = Queue(backlog or 2 * size)
+        self._closed = False
+        self._workers = []
+        for i in range(size):
+            worker = Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def _work(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                break
+            job.run()
+
+    def _enqueue(self, item):
+        while True:
+            try:
+                return self._jobs.put(item, timeout=0.1)
+            except Full:
+                continue
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def submit(self, method, *args, **kwargs):
+        """Queue a method call, block while the queue is full
+
+        :returns: (WorkerJob)
+        """
+        assert not self._closed, 'Submit to a closed WorkerPool'
+        job = WorkerJob(method, *args, **kwargs)
+        self._enqueue(job)
+        return job
+
+    def shutdown(self, wait=True, cancel=False):
+        """Stop the workers when they run out of jobs
+
+        :param wait: (bool) block until all workers are done
+
+        :param cancel: (bool) cancel all jobs not started yet
+        """
+        self._closed = True
+        if cancel:
+            while not self._jobs.empty():
+                job = self._jobs.get_nowait()
+                if job:
+                    job.cancel()
+                    job.run()
+        for worker in self._workers:
+            self._enqueue(None)
+        if wait:
+            for worker in self._workers:
+                while worker.isAlive():
+                    worker.join(0.1)
+
+
+_worker_pools, _worker_pools_lock = dict(), Lock()
+
+
+def get_worker_pool(size):
+    """:returns: (WorkerPool) a long-lived pool of this size, process-wide"""
+    with _worker_pools_lock:
+        pool = _worker_pools.get(size, None)
+        if not pool or pool.closed:
+            pool = WorkerPool(size)
+            _worker_pools[size] = pool
+        return pool
+
+
 class Client(Logged):
     service_type = ''
     MAX_THREADS = 1
     DATE_FORMATS = ['%a %b %d %H:%M:%S %Y', ]
     CONNECTION_RETRY_LIMIT = 0
+    CONNECTION_TIMEOUT = 10.0  # seconds, None for no limit
+    READ_TIMEOUT = TIMEOUT  # seconds, None for no limit
+    #  None for CONNECTION_RETRY_LIMIT immediate retries on connection errors
+    RETRY_POLICY = RetryPolicy()
+    #  Errors which mean that the host is overloaded
+    OVERLOAD_STATUSES = (429, 502, 503, 504)
+    #  A FileCache for conditional GETs, None for no caching
+    RESPONSE_CACHE = None
+    #  Identical concurrent GETs are performed once and share the response.
+    #  A shared GET may have started before the caller's own writes, so it
+    #  is off by default (see request, shared)
+    SINGLE_FLIGHT = False
 
     def __init__(self, endpoint_url, token, base_url=None):
         #  BW compatibility - keep base_url for some time
@@ -436,38 +1072,66 @@ class Client(Logged):
         for old, new in new_keys.items():
             headers[new] = headers.pop(old)
 
-    def _init_thread_limit(self, limit=1):
-        assert isinstance(limit, int) and limit > 0, 'Thread limit not a +int'
-        self._thread_limit = limit
-        self._elapsed_old = 0.0
-        self._elapsed_new = 0.0
-
-    def _watch_thread_limit(self, threadlist):
-        self._thread_limit = getattr(self, '_thread_limit', 1)
-        self._elapsed_new = getattr(self, '_elapsed_new', 0.0)
-        self._elapsed_old = getattr(self, '_elapsed_old', 0.0)
-        recvlog.debug('# running threads: %s' % len(threadlist))
-        if self._elapsed_old and self._elapsed_old >= self._elapsed_new and (
-                self._thread_limit < self.MAX_THREADS):
-            self._thread_limit += 1
-        elif self._elapsed_old <= self._elapsed_new and self._thread_limit > 1:
-            self._thread_limit -= 1
-
-        self._elapsed_old = self._elapsed_new
-        if len(threadlist) >= self._thread_limit:
-            self._elapsed_new = 0.0
-            for thread in threadlist:
-                begin_time = time()
-                thread.join()
-                self._elapsed_new += time() - begin_time
-            self._elapsed_new = self._elapsed_new / len(threadlist)
-            return []
-        return threadlist
+    @property
+    def concurrency_limiter(self):
+        """The ConcurrencyLimiter of requests to the host of this client, up
+        to MAX_THREADS at a time. It is shared with any other client of the
+        same host, and it is bound by the MAX_THREADS of the latest one
+        """
+        return get_concurrency_limiter(
+            urlparse(self.endpoint_url).netloc, self.MAX_THREADS)
+
+    def _limited_call(self, nbytes, method, *args, **kwargs):
+        """Call method in a slot of the concurrency limiter, and adapt the
+        limit to the outcome
+
+        :param nbytes: (int) the bytes the call is expected to transfer
+        """
+        limiter = self.concurrency_limiter
+        started = limiter.acquire()
+        try:
+            value = method(*args, **kwargs)
+        except BaseException as e:
+            self._release_slot(limiter, started, error=e)
+            raise
+        self._release_slot(limiter, started, nbytes)
+        return value
+
+    def _release_slot(self, limiter, started, nbytes=0, error=None):
+        """Free a slot of the concurrency limiter, and adapt the limit to the
+        outcome of its call
+
+        :param error: the exception of the call, if it failed
+        """
+        if error is None:
+            limiter.release(started, nbytes)
+        elif isinstance(error, (ClientError, HTTPException, socket.error)):
+            error = getattr(error, 'errobject', error)
+            overload = not isinstance(error, ClientError) or (
+                error.status in self.OVERLOAD_STATUSES)
+            limiter.release(started, error=overload, measure=overload)
+        else:
+            limiter.release(started, measure=False)
+
+    @property
+    def worker_pool(self):
+        """A WorkerPool of MAX_THREADS workers, shared with any other client
+        of the same MAX_THREADS, unless a custom one is set
+        """
+        pool = getattr(self, '_worker_pool', None)
+        if pool and not pool.closed:
+            return pool
+        return get_worker_pool(self.MAX_THREADS)
+
+    @worker_pool.setter
+    def worker_pool(self, pool):
+        self._worker_pool = pool
 
     def async_run(self, method, kwarg_list):
-        """Fire threads of operations
+        """Run operations on the worker pool, as many at a time as the
+        concurrency limiter allows
 
-        :param method: the method to run in each thread
+        :param method: the method to run in each job
 
         :param kwarg_list: (list of dicts) the arguments to pass in each method
             call
@@ -475,29 +1139,21 @@ class Client(Logged):
         :returns: (list) the results of each method call w.r. to the order of
             kwarg_list
         """
-        flying, results = {}, {}
-        self._init_thread_limit()
-        for index, kwargs in enumerate(kwarg_list):
-            self._watch_thread_limit(flying.values())
-            flying[index] = SilentEvent(method=method, **kwargs)
-            flying[index].start()
-            unfinished = {}
-            for key, thread in flying.items():
-                if thread.isAlive():
-                    unfinished[key] = thread
-                elif thread.exception:
-                    raise thread.exception
-                else:
-                    results[key] = thread.value
-            flying = unfinished
-        sendlog.info('- - - wait for threads to finish')
-        for key, thread in flying.items():
-            if thread.isAlive():
-                thread.join()
-            if thread.exception:
-                raise thread.exception
-            results[key] = thread.value
-        return results.values()
+        pool, jobs = self.worker_pool, []
+        try:
+            for kwargs in kwarg_list:
+                jobs.append(pool.submit(
+                    self._limited_call, 0, method, **kwargs))
+            sendlog.info('- - - wait for jobs to finish')
+            for job in jobs:
+                job.join()
+                if job.exception:
+                    raise job.exception
+        except (Exception, KeyboardInterrupt):
+            for job in jobs:
+                job.cancel()
+            raise
+        return [job.value for job in jobs]
 
     def set_header(self, name, value, iff=True):
         """Set a header 'name':'value'"""
@@ -517,6 +1173,17 @@ class Client(Logged):
         These classes perform a lazy http request. Present method, by default,
         enforces them to perform the http call. Hint: call present method with
         success=None to get a non-performed ResponseManager object.
+        Call it with stream=True to read the response body in chunks, with
+        the iter_content method of the ResponseManager.
+        Failed requests are retried according to RETRY_POLICY. Call it with
+        idempotent=True to retry a request which is safe to repeat, although
+        its method is not (e.g., a POST).
+        If RESPONSE_CACHE is set, GET responses are cached and revalidated
+        with conditional requests.
+        If SINGLE_FLIGHT is set, or for a call with shared=True, a GET with
+        the same url and headers (hence, token) as one in flight, waits for
+        it and shares its response. Share only reads which may tolerate a
+        response older than the writes of the caller.
         """
         assert isinstance(method, str) or isinstance(method, unicode)
         assert method
@@ -527,6 +1194,9 @@ class Client(Logged):
             params = dict(self.params)
             params.update(async_params)
             success = kwargs.pop('success', 200)
+            stream = kwargs.pop('stream', False)
+            idempotent = kwargs.pop('idempotent', None)
+            shared = kwargs.pop('shared', None)
             data = kwargs.pop('data', None)
             headers.setdefault('X-Auth-Token', self.token)
             if 'json' in kwargs:
@@ -545,9 +1215,16 @@ class Client(Logged):
             r = ResponseManager(
                 req,
                 poolsize=self.poolsize,
-                connection_retry_limit=self.CONNECTION_RETRY_LIMIT)
+                connection_retry_limit=self.CONNECTION_RETRY_LIMIT,
+                stream=stream,
+                connection_timeout=self.CONNECTION_TIMEOUT,
+                read_timeout=self.READ_TIMEOUT,
+                retry_policy=self.RETRY_POLICY,
+                idempotent=idempotent,
+                response_cache=self.RESPONSE_CACHE)
             r.headers_to_decode = self.response_headers
             r.header_prefices = self.response_header_prefices
+            r.service = self.service_type or type(self).__name__
             r.LOG_TOKEN, r.LOG_DATA, r.LOG_PID = (
                 self.LOG_TOKEN, self.LOG_DATA, self.LOG_PID)
             r._token = headers['X-Auth-Token']
@@ -555,18 +1232,43 @@ class Client(Logged):
             self.headers = dict()
             self.params = dict()
 
+        if shared is None:
+            shared = self.SINGLE_FLIGHT
+        if success is not None and shared and not stream and (
+                method.upper() == 'GET'):
+            r = self._single_flight(r)
         if success is not None:
-            # Success can either be an int or a collection
-            success = (success,) if isinstance(success, int) else success
-            if r.status_code not in success:
-                log.debug(u'Client caught error %s (%s)' % (r, type(r)))
-                status_msg = getattr(r, 'status', '')
-                try:
-                    message = u'%s %s\n' % (status_msg, r.text)
-                except:
-                    message = u'%s %s\n' % (status_msg, r)
-                status = getattr(r, 'status_code', getattr(r, 'status', 0))
-                raise ClientError(message, status=status)
+            self._check_success(r, success)
+        return r
+
+    def _check_success(self, r, success):
+        """:raises ClientError: if the status of r is not a success"""
+        # Success can either be an int or a collection
+        success = (success,) if isinstance(success, int) else success
+        if r.status_code not in success:
+            log.debug(u'Client caught error %s (%s)' % (r, type(r)))
+            status_msg = getattr(r, 'status', '')
+            try:
+                message = u'%s %s\n' % (status_msg, r.text)
+            except:
+                message = u'%s %s\n' % (status_msg, r)
+            status = getattr(r, 'status_code', getattr(r, 'status', 0))
+            raise ClientError(message, status=status)
+
+    def _single_flight(self, r):
+        """Perform r, unless an identical request is in flight
+
+        :returns: (ResponseManager) r, or a copy of the identical request
+        """
+        def perform():
+            r._get_response()
+            return r
+        key = (r.request.url, tuple(sorted(r.request.headers.items())))
+        response, shared = _single_flight.call(key, perform)
+        if response is r:
+            return r
+        r = copy(response)
+        r._headers = dict(response._headers)
         return r
 
     def delete(self, path, **kwargs):
@@ -591,6 +1293,158 @@ class Client(Logged):
         return self.request('move', path, **kwargs)
 
 
+class AsyncClient(Client):
+    """A Client which can also perform requests without waiting for them
+    The *_async methods return a Task at once, and task.result() waits for
+    the outcome. Requests are built in the calling thread, and performed by
+    the event loop of the process (see kamaki.clients.utils.eventloop): it
+    sends them and reads the responses over non-blocking keep-alive
+    connections, as many at a time as the concurrency limiter of the host
+    allows. Async requests are retried and cached like blocking ones, but
+    they are not streamed or shared with identical requests in flight.
+    Coroutines which chain requests run on the event loop too (see spawn).
+    Blocking calls run on the worker pool (see call_async). Headers and
+    params set with set_header and set_param are kept per thread, so that
+    concurrent requests don't mix them
+    """
+
+    def _thread_state(self):
+        local = self.__dict__.get('_local', None)
+        if local is None:
+            local = self.__dict__.setdefault('_local', local_data())
+        return local
+
+    @property
+    def headers(self):
+        return self._thread_state().__dict__.setdefault('headers', dict())
+
+    @headers.setter
+    def headers(self, headers):
+        self._thread_state().headers = headers
+
+    @property
+    def params(self):
+        return self._thread_state().__dict__.setdefault('params', dict())
+
+    @params.setter
+    def params(self, params):
+        self._thread_state().params = params
+
+    def _backlog(self):
+        backlog = self.__dict__.get('_backlog_slots', None)
+        if backlog is None:
+            backlog = self.__dict__.setdefault(
+                '_backlog_slots', Queue(2 * self.MAX_THREADS))
+        return backlog
+
+    def call_async(self, method, *args, **kwargs):
+        """Run a blocking method(*args, **kwargs) on the worker pool
+
+        :returns: (WorkerJob)
+        """
+        return self.worker_pool.submit(method, *args, **kwargs)
+
+    def spawn(self, coro):
+        """Run a coroutine on the event loop. Outside the event loop, block
+        while 2 * MAX_THREADS tasks of this client are not done, so that the
+        caller does not run ahead (e.g., reading blocks to upload)
+
+        :param coro: (generator) yields Futures to wait for them, e.g., the
+            Tasks of perform_async, and returns a value with
+            raise Return(value). It must not block
+
+        :returns: (Task) task.result() is the value of the coroutine
+        """
+        loop = get_event_loop()
+        if loop.in_loop_thread():
+            return loop.spawn(coro)
+        backlog = self._backlog()
+        while True:
+            try:
+                backlog.put(None, timeout=0.1)
+                break
+            except Full:
+                continue
+        task = loop.spawn(coro)
+        task.add_done_callback(lambda task: backlog.get_nowait())
+        return task
+
+    def perform_async(self, r, success=200, nbytes=0, then=None):
+        """Perform a request without waiting, in a slot of the concurrency
+        limiter
+
+        :param r: (ResponseManager) a request which is not performed, as
+            returned by request with success=None
+
+        :param success: (int or tuple) the expected status(es), None for any
+
+        :param nbytes: (int) the bytes the request is expected to transfer
+
+        :param then: (callable) r --> the result of the task, on the event
+            loop (so, it must not block)
+
+        :returns: (Task) task.result() is then(r), or r
+        """
+        assert not r.stream, 'Streamed requests are not performed async'
+        if not get_event_loop().in_loop_thread():
+            try:
+                resolve(r.request.scheme, r.request.netloc)
+            except socket.error:
+                #  The request fails with it on the event loop
+                pass
+        return self.spawn(self._perform(r, success, nbytes, then))
+
+    def _perform(self, r, success, nbytes, then):
+        loop, limiter = get_event_loop(), self.concurrency_limiter
+        started = None
+        while started is None:
+            free = Future()
+            started = limiter.try_acquire(
+                lambda free=free: free.set_result(None))
+            if started is None:
+                yield free
+        try:
+            yield r.perform_async(loop)
+            if success is not None:
+                self._check_success(r, success)
+            value = then(r) if then else r
+        except BaseException as e:
+            self._release_slot(limiter, started, error=e)
+            raise
+        self._release_slot(limiter, started, nbytes)
+        raise Return(value)
+
+    def request_async(self, method, path, **kwargs):
+        """Like request, but without waiting for the response
+
+        :returns: (Task) task.result() is the ResponseManager
+        """
+        success = kwargs.pop('success', 200)
+        r = self.request(method, path, success=None, **kwargs)
+        return self.perform_async(r, success)
+
+    def delete_async(self, path, **kwargs):
+        return self.request_async('delete', path, **kwargs)
+
+    def get_async(self, path, **kwargs):
+        return self.request_async('get', path, **kwargs)
+
+    def head_async(self, path, **kwargs):
+        return self.request_async('head', path, **kwargs)
+
+    def post_async(self, path, **kwargs):
+        return self.request_async('post', path, **kwargs)
+
+    def put_async(self, path, **kwargs):
+        return self.request_async('put', path, **kwargs)
+
+    def copy_async(self, path, **kwargs):
+        return self.request_async('copy', path, **kwargs)
+
+    def move_async(self, path, **kwargs):
+        return self.request_async('move', path, **kwargs)
+
+
 class Waiter(object):
 
     def _wait(
@@ -0,0 +1,230 @@
+# Copyright 2014 GRNET S.A. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following
+# conditions are met:
+#
+#   1. Redistributions of source code must retain the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer.
+#
+#   2. Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials
+#      provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY GRNET S.A. ``AS IS'' AND ANY EXPRESS
+# OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL GRNET S.A OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF
+# USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED
+# AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and
+# documentation are those of the authors and should not be
+# interpreted as representing official policies, either expressed
+# or implied, of GRNET S.A.
+
+
+"""Micro-benchmarks for performance sensitive parts of kamaki.clients
+
+Usage: python -m kamaki.clients.bench <benchmark> [args]
+"""
+
+from os import urandom, devnull
+from time import time, clock
+from threading import Thread
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+import logging
+
+from kamaki.clients import RequestManager, sendlog, recvlog
+from kamaki.clients.pithos import BLOCK_HASHERS, PithosClient
+
+
+def _report(name, seconds, amount, unit):
+    print('  %-12s %8.3f sec  %10.2f %s/sec' % (
+        name, seconds, amount / seconds if seconds else 0.0, unit))
+
+
+def bench_hashing(
+        size_in_mb=256, blocksize=4 * 1024 * 1024, blockhash='sha256'):
+    """Compare block hashers (serial is the reference implementation)"""
+    size_in_mb, blocksize = int(size_in_mb), int(blocksize)
+    nblocks = max(1, size_in_mb * 1024 * 1024 // blocksize)
+    block = urandom(blocksize)
+    print('Hash %s blocks of %s bytes with %s' % (
+        nblocks, blocksize, blockhash))
+    reference = None
+    for name in ('serial', 'threads', 'processes'):
+        hasher = BLOCK_HASHERS[name](blockhash)
+        try:
+            start = time()
+            hashes = list(hasher.hash_blocks(block for i in xrange(nblocks)))
+            _report(
+                name, time() - start, nblocks * blocksize / 1048576.0, 'MB')
+        finally:
+            hasher.close()
+        reference = reference or hashes
+        assert hashes == reference, '%s hashes differ from serial' % name
+
+
+class _BlockUploaded(object):
+    """The response of a Pithos server to a block upload, without a server"""
+
+    status, reason = 202, 'Accepted'
+    body = '["%s"]' % ('0' * 64)
+
+    def getheaders(self):
+        return [
+            ('content-type', 'application/json; charset=utf-8'),
+            ('content-length', '%s' % len(self.body)),
+            ('date', 'Thu, 01 Jan 2015 00:00:00 GMT'),
+            ('server', 'gunicorn/18.0')]
+
+    def getheader(self, name, default=None):
+        return dict(self.getheaders()).get(name.lower(), default)
+
+    def read(self, amt=None):
+        return self.body
+
+    def isclosed(self):
+        return True
+
+
+def _perform(self, conn, connection_timeout=None, read_timeout=None):
+    self._encode_headers()
+    self.dump_log()
+    return _BlockUploaded()
+
+
+def bench_logging(requests=2000, blocksize=4 * 1024 * 1024):
+    """Measure the CPU time per block upload request, spent on the client
+    side, with the send/recv loggers off and on, with and without log_data.
+    The data are logged in 1/100 of the requests, since escaping them is slow
+    """
+    requests, blocksize = int(requests), int(blocksize)
+    client = PithosClient('http://pithos.example.com/v1', 'token', 'user', 'c')
+    block, blockhash = urandom(blocksize), '0' * 64
+    print('Upload %s blocks of %s bytes' % (requests, blocksize))
+    handler = logging.StreamHandler(open(devnull, 'w'))
+    perform, RequestManager.perform = RequestManager.perform, _perform
+    try:
+        for name, level, log_data, n in (
+                ('off', logging.WARNING, False, requests),
+                ('off + data', logging.WARNING, True, requests),
+                ('on', logging.INFO, False, requests),
+                ('on + data', logging.INFO, True, max(1, requests // 100))):
+            for logger in (sendlog, recvlog):
+                logger.setLevel(level)
+                if level == logging.INFO:
+                    logger.addHandler(handler)
+            client.LOG_DATA = log_data
+            start = clock()
+            for i in xrange(n):
+                client._put_block(block, blockhash)
+            seconds = clock() - start
+            print('  %-12s %8.1f usec/request' % (
+                name, 1000000.0 * seconds / n))
+    finally:
+        RequestManager.perform = perform
+        for logger in (sendlog, recvlog):
+            logger.removeHandler(handler)
+            logger.setLevel(logging.NOTSET)
+        handler.stream.close()
+
+
+class _NoOpHandler(BaseHTTPRequestHandler):
+    """Answer every request with an empty 204, on a keep-alive connection"""
+
+    protocol_version = 'HTTP/1.1'
+    #  Send each response at once, or Nagle's algorithm delays it
+    wbufsize, disable_nagle_algorithm = -1, True
+
+    def _no_op(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+        self.send_response(204)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    do_GET = do_HEAD = do_POST = do_PUT = do_DELETE = _no_op
+
+    def log_message(self, *args):
+        pass
+
+
+class _NoOpServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def bench_requests(requests=5000):
+    """Metadata requests per second against a local no-op HTTP server, and
+    the CPU time spent to build each request
+    """
+    requests = int(requests)
+    server = _NoOpServer(('127.0.0.1', 0), _NoOpHandler)
+    server_thread = Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+    try:
+        client = PithosClient(
+            'http://127.0.0.1:%s/v1' % server.server_port, 'token', 'user',
+            'container')
+        metadata = {'color': 'blue', u'\u03c7\u03c1\u03ce\u03bc\u03b1': 'x'}
+        print('%s requests to a no-op server' % requests)
+        for name, request in (
+                ('object_head', lambda i: client.object_head(
+                    'dir/object%s' % i, success=204)),
+                ('object_post', lambda i: client.object_post(
+                    'dir/object%s' % i, update=True, metadata=metadata,
+                    success=204))):
+            start = time()
+            for i in xrange(requests):
+                request(i)
+            _report(name, time() - start, requests, 'requests')
+
+        headers = {
+            'X-Auth-Token': 'token', 'Content-Type': 'text/plain',
+            'X-Object-Meta-Color': 'blue', u'X-Object-Meta-Tag': u'\u03c7'}
+        params = dict(format='json', update=None)
+        start = clock()
+        for i in xrange(requests):
+            r = RequestManager(
+                'POST', client.endpoint_url, '/container/object%s' % i,
+                headers=headers, params=params)
+            r.headers_to_quote = ['x-copy-from', 'x-move-from']
+            r.header_prefices = ['x-object-meta-']
+            r._encode_headers()
+        seconds = clock() - start
+        print('  %-12s %8.1f usec/request' % (
+            'build', 1000000.0 * seconds / requests))
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+benchmarks = dict(
+    hashing=bench_hashing, logging=bench_logging, requests=bench_requests)
+
+
+def main(argv):
+    names = argv[1:2] or sorted(benchmarks)
+    for name in names:
+        if name not in benchmarks:
+            print('Benchmark "%s" not found, try one of %s' % (
+                name, ', '.join(sorted(benchmarks))))
+            return
+        benchmarks[name](*argv[2:])
+
+
+if __name__ == '__main__':
+    from sys import argv
+    main(argv)
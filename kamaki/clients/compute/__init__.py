@@ -315,7 +315,9 @@ class ComputeClient(ComputeRestClient):
 
         :raises ClientError: 404 if image not available
         """
-        r = self.images_get(image_id, **kwargs)
+        return self._image_details(self.images_get(image_id, **kwargs))
+
+    def _image_details(self, r):
         try:
             return r.json['image']
         except KeyError:
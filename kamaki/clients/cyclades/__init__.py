@@ -35,10 +35,12 @@ from kamaki.clients.cyclades.rest_api import (
     CycladesComputeRestClient, CycladesBlockStorageRestClient)
 from kamaki.clients.network import NetworkClient
 from kamaki.clients.utils import path4url
-from kamaki.clients import ClientError, Waiter
+from kamaki.clients import ClientError, Waiter, AsyncClient
+from kamaki.clients.utils.eventloop import Return
 
 
-class CycladesComputeClient(CycladesComputeRestClient, Waiter):
+class CycladesComputeClient(
+        CycladesComputeRestClient, AsyncClient, Waiter):
     """Synnefo Cyclades Compute API client"""
 
     CONSOLE_TYPES = ('vnc', 'vnc-ws', 'vnc-wss')
@@ -75,6 +77,18 @@ class CycladesComputeClient(CycladesComputeRestClient, Waiter):
         :raises ClientError: wraps request errors
         """
         image = self.get_image_details(image_id)
+        req = self._server_request(
+            name, flavor_id, image_id, image,
+            metadata, personality, networks, project_id)
+        r = self.servers_post(json_data=req, success=(202, ))
+        for k, v in response_headers.items():
+            response_headers[k] = r.headers.get(k, v)
+        return r.json['server']
+
+    def _server_request(
+            self, name, flavor_id, image_id, image,
+            metadata, personality, networks, project_id):
+        """:returns: (dict) the body of a request to create a server"""
         metadata = metadata or dict()
         for key in ('os', 'users'):
             try:
@@ -96,11 +110,38 @@ class CycladesComputeClient(CycladesComputeRestClient, Waiter):
 
         if project_id is not None:
             req['server']['project'] = project_id
+        return req
 
-        r = self.servers_post(json_data=req, success=(202, ))
+    def create_server_async(
+            self, name, flavor_id, image_id,
+            metadata=None, personality=None, networks=None, project_id=None,
+            response_headers=None):
+        """Submit a request to create a new server, without waiting. Arguments
+        are the same as in create_server
+
+        :returns: (Task) task.result() is the new server details
+        """
+        #  Don't share the default response_headers among concurrent tasks
+        if response_headers is None:
+            response_headers = dict(location=None)
+        return self.spawn(self._create_server(
+            self.images_get(image_id, success=None), name, flavor_id,
+            image_id, metadata, personality, networks, project_id,
+            response_headers))
+
+    def _create_server(
+            self, image_request, name, flavor_id, image_id,
+            metadata, personality, networks, project_id, response_headers):
+        """Coroutine: get the image details, then create the server"""
+        r = yield self.perform_async(image_request)
+        req = self._server_request(
+            name, flavor_id, image_id, self._image_details(r),
+            metadata, personality, networks, project_id)
+        r = yield self.perform_async(
+            self.servers_post(json_data=req, success=None), success=(202, ))
         for k, v in response_headers.items():
             response_headers[k] = r.headers.get(k, v)
-        return r.json['server']
+        raise Return(r.json['server'])
 
     def set_firewall_profile(self, server_id, profile, port_id):
         """Set the firewall profile for the public interface of a server
@@ -211,6 +211,42 @@ class CycladesComputeClient(TestCase):
         FR.status_code = 200
         FR.json = vm_recv
 
+    @patch('%s.perform_async' % cyclades_pkg)
+    @patch('%s.servers_post' % cyclades_pkg)
+    @patch('%s.images_get' % cyclades_pkg)
+    def test_create_server_async(self, GET, POST, PA):
+        from kamaki.clients.utils.eventloop import Future
+        image, server = FR(), FR()
+        image.json = dict(image=dict(
+            id=img_ref, metadata=dict(os='debian', users='root')))
+        server.json, server.headers = vm_recv, dict(location='l0c')
+        GET.return_value, POST.return_value = image, server
+        performed = []
+
+        def perform_async(r, success=200):
+            performed.append((r, success))
+            future = Future()
+            future.set_result(r)
+            return future
+        PA.side_effect = perform_async
+        headers = [dict(location=None), dict(location=None)]
+        jobs = [self.client.create_server_async(
+            vm_name, fid, img_ref, project_id='p',
+            response_headers=headers[fid - 1]) for fid in (1, 2)]
+        self.assertEqual(
+            [job.result() for job in jobs], [vm_recv['server']] * 2)
+        self.assertEqual(headers, [dict(location='l0c')] * 2)
+        GET.assert_called_with(img_ref, success=None)
+        self.assertEqual(sorted(performed), sorted(
+            [(image, 200), (server, (202, ))] * 2))
+        for fid in (1, 2):
+            req = [c[2]['json_data'] for c in POST.mock_calls if (
+                c[2]['json_data']['server']['flavorRef'] == fid)][0]
+            self.assertEqual(req['server']['imageRef'], img_ref)
+            self.assertEqual(req['server']['project'], 'p')
+            self.assertEqual(req['server']['metadata'], dict(
+                os='debian', users='root'))
+
     @patch('%s.servers_action_post' % cyclades_pkg, return_value=FR())
     def test_shutdown_server(self, SP):
         vm_id = vm_recv['server']['id']
@@ -31,27 +31,264 @@
 # interpreted as representing official policies, either expressed
 # or implied, of GRNET S.A.
 
-from threading import enumerate as activethreads
-
-from os import fstat
+import sys
+from os import fstat, path as ospath, remove as os_remove
+from stat import S_ISREG
+from json import dumps as json_dumps, loads as json_loads
 from hashlib import new as newhashlib
+from binascii import hexlify, unhexlify
 from time import time
 from StringIO import StringIO
+from multiprocessing import cpu_count, Pool
+from collections import deque
+from itertools import izip
+from copy import copy
+from threading import Lock, local
 
-from binascii import hexlify
-
-from kamaki.clients import SilentEvent, sendlog
+from kamaki.clients import WorkerPool, AsyncClient, sendlog
 from kamaki.clients.pithos.rest_api import PithosRestClient
 from kamaki.clients.storage import ClientError
-from kamaki.clients.utils import path4url, filter_in, readall
+from kamaki.clients.utils import path4url, filter_in, readall, BlockSource
 
 
 def _pithos_hash(block, blockhash):
+    """:param block: (str or buffer) trailing zeros are not hashed"""
     h = newhashlib(blockhash)
-    h.update(block.rstrip('\x00'))
+    if block[-1:] == '\x00':
+        block = str(block).rstrip('\x00')
+    h.update(block)
     return h.hexdigest()
 
 
+def _pithos_top_hash(hashes, blockhash):
+    """The hash of a whole hashmap, as in the hash of an object listing: the
+    root of a merkle tree over the block hashes (hex strings), padded with
+    zero hashes up to a power of 2
+    """
+    if len(hashes) == 1:
+        return hashes[0]
+    if not hashes:
+        return newhashlib(blockhash, '').hexdigest()
+    tree, size = [unhexlify(h) for h in hashes], 2
+    while size < len(tree):
+        size *= 2
+    tree += ['\x00' * len(tree[0])] * (size - len(tree))
+    while len(tree) > 1:
+        tree = [newhashlib(blockhash, tree[i] + tree[i + 1]).digest() for (
+            i) in range(0, len(tree), 2)]
+    return hexlify(tree[0])
+
+
+class BlockHasher(object):
+    """Calculate the Pithos+ hashes of a sequence of blocks, serially
+
+    :param blockhash: (str) the hash algorithm of the container (as in
+        x-container-block-hash)
+
+    :param workers: (int) the degree of parallelism, ignored here
+    """
+
+    def __init__(self, blockhash, workers=1):
+        self.blockhash, self.workers = blockhash, workers
+
+    def hash_blocks(self, blocks):
+        """:returns: (generator) the hash of each block, in block order"""
+        for block in blocks:
+            yield _pithos_hash(block, self.blockhash)
+
+    def close(self):
+        pass
+
+    def _sliding(self, submit, blocks, result, cancel):
+        """Keep up to 2 * workers blocks in the works, to bound memory. The
+        next block is submitted as soon as the oldest one is hashed
+
+        :param submit: (callable) block --> job
+
+        :param result: (callable) job --> hash, waits for the job
+
+        :param cancel: (callable) job --> None, for jobs left on early exit
+        """
+        jobs = deque()
+        try:
+            for block in blocks:
+                jobs.append(submit(block))
+                if len(jobs) >= 2 * self.workers:
+                    yield result(jobs.popleft())
+            while jobs:
+                yield result(jobs.popleft())
+        finally:
+            for job in jobs:
+                cancel(job)
+
+
+_hash_pools, _hash_pools_lock = dict(), Lock()
+
+
+def _get_hash_pool(size):
+    """:returns: (WorkerPool) a long-lived pool of this size for hashing,
+        process-wide. It is kept apart from the request pools, which may be
+        waiting for hashes themselves
+    """
+    with _hash_pools_lock:
+        pool = _hash_pools.get(size, None)
+        if not pool or pool.closed:
+            pool = _hash_pools[size] = WorkerPool(size)
+        return pool
+
+
+class ThreadBlockHasher(BlockHasher):
+    """Hash blocks on a pool of threads (hashlib releases the GIL while it
+    hashes large buffers, so the threads run on multiple cores). The pool
+    outlives the hasher, and is shared with any hasher of the same workers
+    """
+
+    def __init__(self, blockhash, workers=None):
+        super(ThreadBlockHasher, self).__init__(
+            blockhash, workers or cpu_count())
+
+    @staticmethod
+    def _result(job):
+        job.join()
+        if job.exception:
+            raise job.exception
+        return job.value
+
+    def hash_blocks(self, blocks):
+        pool = _get_hash_pool(self.workers)
+        return self._sliding(
+            lambda block: pool.submit(_pithos_hash, block, self.blockhash),
+            blocks, self._result, lambda job: job.cancel())
+
+
+class ProcessBlockHasher(BlockHasher):
+    """Hash blocks on a pool of processes (blocks are copied to the worker
+    processes, so this pays off for slow hash algorithms only)
+    """
+
+    def __init__(self, blockhash, workers=None):
+        super(ProcessBlockHasher, self).__init__(
+            blockhash, workers or cpu_count())
+        self._pool = None
+
+    def hash_blocks(self, blocks):
+        self._pool = self._pool or Pool(self.workers)
+        return self._sliding(
+            lambda block: self._pool.apply_async(
+                _pithos_hash, (str(block), self.blockhash)),
+            blocks, lambda job: job.get(), lambda job: None)
+
+    def close(self):
+        if self._pool:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+
+BLOCK_HASHERS = dict(
+    serial=BlockHasher, threads=ThreadBlockHasher,
+    processes=ProcessBlockHasher)
+
+
+class DownloadJournal(object):
+    """Record the blocks of a local file that are known to match the remote
+    object, so that a resumed download does not have to hash them again
+
+    The journal is a text file with a header line (block size and hash) and a
+    "<block index> <block hash>" line for each block written or verified
+
+    :param path: (str) the journal file, e.g., next to the downloaded file
+
+    :param blocksize: (int)
+
+    :param blockhash: (str) the hash algorithm of the blocks
+    """
+
+    def __init__(self, path, blocksize, blockhash):
+        self.path, self._file = path, None
+        self.header = '%s %s\n' % (blocksize, blockhash)
+
+    def load(self):
+        """:returns: (dict) {block index: block hash} of recorded blocks"""
+        blocks = dict()
+        try:
+            with open(self.path) as f:
+                if f.readline() != self.header:
+                    return blocks
+                for line in f:
+                    try:
+                        index, hash = line.split()
+                        blocks[int(index)] = hash
+                    except ValueError:
+                        #  A partially written line, the last one
+                        break
+        except IOError:
+            pass
+        return blocks
+
+    def open(self, keep=True):
+        """:param keep: (bool) keep records of a journal with the same header
+        """
+        if keep and self.load():
+            self._file = open(self.path, 'a')
+        else:
+            self._file = open(self.path, 'w')
+            self._file.write(self.header)
+
+    def record(self, index, hash):
+        self._file.write('%s %s\n' % (index, hash))
+
+    def flush(self):
+        if self._file:
+            self._file.flush()
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def remove(self):
+        """Close and delete the journal, e.g., when the download is over"""
+        self.close()
+        try:
+            os_remove(self.path)
+        except OSError:
+            pass
+
+
+def _is_seekable(fileobj):
+    """False for ttys, pipes, sockets and other streams"""
+    try:
+        if fileobj.isatty():
+            return False
+        fileobj.seek(0, 1)
+        return True
+    except (AttributeError, IOError, OSError, ValueError):
+        return False
+
+
+def _block_runs(blockids, max_blocks=1):
+    """Merge adjacent block indices into runs, to fetch them with a single
+    range request each
+
+    :param blockids: (iterable of int) block indices in ascending order
+
+    :param max_blocks: (int) the maximum length of a run
+
+    :returns: (generator) of (first block index, number of blocks) pairs
+    """
+    first, count = None, 0
+    for blockid in blockids:
+        if count and blockid == first + count and count < max_blocks:
+            count += 1
+            continue
+        if count:
+            yield first, count
+        first, count = blockid, 1
+    if count:
+        yield first, count
+
+
 def _range_up(start, end, max_value, a_range):
     """
     :param start: (int) the window bottom
@@ -99,12 +336,41 @@ def _range_up(start, end, max_value, a_range):
     return ','.join(selected)
 
 
-class PithosClient(PithosRestClient):
+class PithosClient(PithosRestClient, AsyncClient):
     """Synnefo Pithos+ API client"""
 
+    #  One of BLOCK_HASHERS, or a BlockHasher subclass
+    BLOCK_HASHER = 'threads'
+
+    #  Adjacent blocks are downloaded in ranges of up to that many blocks
+    MAX_RANGE_BLOCKS = 1
+
+    #  Listings are paginated by the server, up to that many items a page
+    LISTING_LIMIT = 10000
+
     def __init__(self, endpoint_url, token, account=None, container=None):
         super(PithosClient, self).__init__(
             endpoint_url, token, account, container)
+        self._progress = local()
+
+    @property
+    def progress_bar_gen(self):
+        """The progress generator of the running transfer. It is kept per
+        thread, so that transfers running at once on the same client (e.g.,
+        the files of a directory) advance their own progress"""
+        try:
+            return self._progress.gen
+        except AttributeError:
+            raise AttributeError('progress_bar_gen')
+
+    @progress_bar_gen.setter
+    def progress_bar_gen(self, gen):
+        self._progress.gen = gen
+
+    def _get_block_hasher(self, blockhash):
+        hasher = self.BLOCK_HASHER
+        hasher = BLOCK_HASHERS[hasher] if hasher in BLOCK_HASHERS else hasher
+        return hasher(blockhash)
 
     def create_container(
             self,
@@ -243,20 +509,37 @@ class PithosClient(PithosRestClient):
         return r.headers
 
     # upload_* auxiliary methods
-    def _put_block_async(self, data, hash):
-        event = SilentEvent(method=self._put_block, data=data, hash=hash)
-        event.start()
-        return event
+    def put_block_async(self, data, hash):
+        """Upload a block to the container, without waiting
 
-    def _put_block(self, data, hash):
-        r = self.container_post(
+        :param data: (str) the block
+
+        :param hash: (str) the hash of the block, to check the upload
+
+        :returns: (Task) task.result() fails if the block is not uploaded
+        """
+        r = self._post_block(data, success=None)
+        return self.perform_async(
+            r, success=202, nbytes=len(data),
+            then=lambda r: self._check_block(r, hash))
+
+    def _post_block(self, data, **kwargs):
+        #  Blocks are content-addressed, so repeating the POST is safe
+        return self.container_post(
             update=True,
             content_type='application/octet-stream',
             content_length=len(data),
             data=data,
-            format='json')
+            format='json',
+            idempotent=True,
+            **kwargs)
+
+    def _check_block(self, r, hash):
         assert r.json[0] == hash, 'Local hash does not match server'
 
+    def _put_block(self, data, hash):
+        self._check_block(self._post_block(data), hash)
+
     def _get_file_block_info(self, fileobj, size=None, cache=None):
         """
         :param fileobj: (file descriptor) source
@@ -308,70 +591,167 @@ class PithosClient(PithosRestClient):
             success=success)
         return (None if r.status_code == 201 else r.json), r.headers
 
+    def _hash_cache_key(self, fileobj, size, blocksize, blockhash):
+        """The identity of a local file as a hash cache key, or None if the
+        file is not a regular file read from the start and up to its end
+        """
+        try:
+            st = fstat(fileobj.fileno())
+            if not (S_ISREG(st.st_mode) and size == st.st_size and (
+                    fileobj.tell() == 0)):
+                return None
+            return '%s:%s:%s:%r:%s:%s' % (
+                ospath.realpath(fileobj.name), st.st_ino, st.st_size,
+                st.st_mtime, blocksize, blockhash)
+        except (AttributeError, IOError, OSError, ValueError):
+            return None
+
+    def _get_cached_hashes(self, hash_cache, key, size, blocksize, hmap):
+        """:returns: (list) the cached hashes of the blocks, hmap is updated
+        """
+        try:
+            hashes = json_loads(hash_cache.get(key) or 'null')
+        except ValueError:
+            hashes = None
+        if not hashes or len(hashes) != 1 + (size - 1) // blocksize:
+            return None
+        for i, hash in enumerate(hashes):
+            offset = i * blocksize
+            hmap[hash] = (offset, min(blocksize, size - offset))
+        sendlog.info('Block hashes found in local cache')
+        return hashes
+
     def _calculate_blocks_for_upload(
             self, blocksize, blockhash, size, nblocks, hashes, hmap, fileobj,
             hash_cb=None):
-        offset = 0
+        offset, sizes = 0, []
         if hash_cb:
             hash_gen = hash_cb(nblocks)
             hash_gen.next()
 
-        for i in xrange(nblocks):
-            block = readall(fileobj, min(blocksize, size - offset))
-            bytes = len(block)
-            if bytes <= 0:
-                break
-            hash = _pithos_hash(block, blockhash)
-            hashes.append(hash)
-            hmap[hash] = (offset, bytes)
-            offset += bytes
-            if hash_cb:
-                hash_gen.next()
+        source = BlockSource(fileobj)
+
+        def read_blocks():
+            for block in source.blocks(blocksize, size):
+                sizes.append(len(block))
+                yield block
+
+        hasher = self._get_block_hasher(blockhash)
+        try:
+            for i, hash in enumerate(hasher.hash_blocks(read_blocks())):
+                hashes.append(hash)
+                hmap[hash] = (offset, sizes[i])
+                offset += sizes[i]
+                if hash_cb:
+                    hash_gen.next()
+        finally:
+            hasher.close()
+            source.close()
+        msg = ('Failed to calculate uploading blocks: '
+               'read bytes(%s) != requested size (%s)' % (offset, size))
+        assert offset == size, msg
+
+    def _calculate_and_upload_blocks(
+            self, blocksize, blockhash, size, nblocks, hashes, hmap, fileobj,
+            hash_cb=None, upload_gen=None):
+        """Hash blocks as they are read and upload them speculatively, without
+        asking the server which blocks are missing. The file is read once and
+        the network is busy while hashing goes on.
+        """
+        offset, flying = 0, []
+        if hash_cb:
+            hash_gen = hash_cb(nblocks)
+            hash_gen.next()
+
+        def harvest(jobs, wait=False):
+            unfinished = []
+            for job in jobs:
+                if wait:
+                    job.join()
+                if job.isAlive():
+                    unfinished.append(job)
+                elif upload_gen and not job.exception:
+                    try:
+                        upload_gen.next()
+                    except:
+                        pass
+            return unfinished
+
+        source = BlockSource(fileobj)
+        try:
+            for block in source.blocks(blocksize, size):
+                bytes = len(block)
+                hash = _pithos_hash(block, blockhash)
+                hashes.append(hash)
+                if hash not in hmap:
+                    flying.append(self.put_block_async(block, hash))
+                hmap[hash] = (offset, bytes)
+                offset += bytes
+                if hash_cb:
+                    hash_gen.next()
+                flying = harvest(flying)
+            harvest(flying, wait=True)
+        except KeyboardInterrupt:
+            sendlog.info('- - - cancel pending block uploads')
+            for job in flying:
+                job.cancel()
+            raise
+        finally:
+            source.close()
         msg = ('Failed to calculate uploading blocks: '
                'read bytes(%s) != requested size (%s)' % (offset, size))
         assert offset == size, msg
 
     def _upload_missing_blocks(self, missing, hmap, fileobj, upload_gen=None):
-        """upload missing blocks asynchronously"""
-
-        self._init_thread_limit()
-
-        flying = []
-        failures = []
-        for hash in missing:
-            offset, bytes = hmap[hash]
-            fileobj.seek(offset)
-            data = readall(fileobj, bytes)
-            r = self._put_block_async(data, hash)
-            flying.append(r)
-            unfinished = self._watch_thread_limit(flying)
-            for thread in set(flying).difference(unfinished):
-                if thread.exception:
-                    failures.append(thread)
-                    if isinstance(
-                            thread.exception,
-                            ClientError) and thread.exception.status == 502:
-                        self.POOLSIZE = self._thread_limit
-                elif thread.isAlive():
-                    flying.append(thread)
+        """upload missing blocks asynchronously, on the worker pool
+
+        :returns: (list) the jobs of the blocks which failed to upload
+        """
+        source = BlockSource(fileobj)
+        try:
+            return self._upload_blocks(
+                missing, lambda hash: source.block(*hmap[hash]), upload_gen)
+        finally:
+            source.close()
+
+    def _upload_blocks(self, missing, read_block, upload_gen=None):
+        """upload blocks asynchronously, on the worker pool. Each block is
+        retried according to the RETRY_POLICY
+
+        :param read_block: (callable) hash --> the data of the block
+
+        :returns: (list) the jobs of the blocks which failed to upload
+        """
+        flying, failures = [], []
+
+        def harvest(jobs, wait=False):
+            unfinished = []
+            for job in jobs:
+                if wait:
+                    job.join()
+                if job.isAlive():
+                    unfinished.append(job)
+                elif job.exception:
+                    failures.append(job)
                 elif upload_gen:
                     try:
                         upload_gen.next()
                     except:
                         pass
-            flying = unfinished
+            return unfinished
 
-        for thread in flying:
-            thread.join()
-            if thread.exception:
-                failures.append(thread)
-            elif upload_gen:
-                try:
-                    upload_gen.next()
-                except:
-                    pass
+        try:
+            for hash in missing:
+                flying.append(self.put_block_async(read_block(hash), hash))
+                flying = harvest(flying)
+            harvest(flying, wait=True)
+        except KeyboardInterrupt:
+            sendlog.info('- - - cancel pending block uploads')
+            for job in flying:
+                job.cancel()
+            raise
 
-        return [failure.kwargs['hash'] for failure in failures]
+        return failures
 
     def upload_object(
             self, obj, f,
@@ -386,7 +766,9 @@ class PithosClient(PithosRestClient):
             content_type=None,
             sharing=None,
             public=None,
-            container_info_cache=None):
+            container_info_cache=None,
+            pipeline=False,
+            hash_cache=None):
         """Upload an object using multiple connections (threads)
 
         :param obj: (str) remote object path
@@ -420,6 +802,14 @@ class PithosClient(PithosRestClient):
 
         :param container_info_cache: (dict) if given, avoid redundant calls to
             server for container info (block size and hash information)
+
+        :param pipeline: (bool) upload blocks while hashing, in a single read
+            of the file. Blocks already stored on the server are uploaded too
+
+        :param hash_cache: (FileCache) if given, the block hashes of local
+            files are kept there, keyed by file identity (path, inode, size,
+            mtime, block size and hash), so that unchanged files are not
+            hashed again
         """
         self._assert_container()
 
@@ -428,13 +818,34 @@ class PithosClient(PithosRestClient):
                 f, size, container_info_cache)
         (hashes, hmap, offset) = ([], {}, 0)
         content_type = content_type or 'application/octet-stream'
-
-        self._calculate_blocks_for_upload(
-            *block_info,
-            hashes=hashes,
-            hmap=hmap,
-            fileobj=f,
-            hash_cb=hash_cb)
+        upload_gen = None
+        cache_key = self._hash_cache_key(
+            f, size, blocksize, blockhash) if hash_cache else None
+        cached = cache_key and self._get_cached_hashes(
+            hash_cache, cache_key, size, blocksize, hmap)
+
+        if cached:
+            hashes = cached
+        elif pipeline:
+            if upload_cb:
+                upload_gen = upload_cb(nblocks)
+                upload_gen.next()
+            self._calculate_and_upload_blocks(
+                *block_info,
+                hashes=hashes,
+                hmap=hmap,
+                fileobj=f,
+                hash_cb=hash_cb,
+                upload_gen=upload_gen)
+        else:
+            self._calculate_blocks_for_upload(
+                *block_info,
+                hashes=hashes,
+                hmap=hmap,
+                fileobj=f,
+                hash_cb=hash_cb)
+        if cache_key and not cached:
+            hash_cache.set(cache_key, json_dumps(hashes))
 
         hashmap = dict(bytes=size, hashes=hashes)
         missing, obj_headers = self._create_object_or_get_missing_hashes(
@@ -451,7 +862,7 @@ class PithosClient(PithosRestClient):
         if missing is None:
             return obj_headers
 
-        if upload_cb:
+        if upload_cb and not upload_gen:
             upload_gen = upload_cb(len(hashmap['hashes']))
             for i in range(len(hashmap['hashes']) + 1 - len(missing)):
                 try:
@@ -459,30 +870,14 @@ class PithosClient(PithosRestClient):
                 except:
                     sendlog.debug('Progress bar failure')
                     break
-        else:
-            upload_gen = None
-
-        retries = 7
-        while retries:
-            sendlog.info('%s blocks missing' % len(missing))
-            num_of_blocks = len(missing)
-            missing = self._upload_missing_blocks(
-                missing, hmap, f, upload_gen)
-            if missing:
-                if num_of_blocks == len(missing):
-                    retries -= 1
-                else:
-                    num_of_blocks = len(missing)
-            else:
-                break
-        if missing:
-            try:
-                details = ['%s' % thread.exception for thread in missing]
-            except Exception:
-                details = ['Also, failed to read thread exceptions']
+
+        #  Each block upload is retried according to the RETRY_POLICY
+        sendlog.info('%s blocks missing' % len(missing))
+        failures = self._upload_missing_blocks(missing, hmap, f, upload_gen)
+        if failures:
             raise ClientError(
-                '%s blocks failed to upload' % len(missing),
-                details=details)
+                '%s blocks failed to upload' % len(failures),
+                details=['%s' % job.exception for job in failures])
 
         r = self.object_put(
             obj,
@@ -556,11 +951,15 @@ class PithosClient(PithosRestClient):
 
         hashes = []
         hmap = {}
-        for blockid in range(nblocks):
-            start = blockid * blocksize
-            block = input_str[start: (start + blocksize)]
-            hashes.append(_pithos_hash(block, blockhash))
-            hmap[hashes[blockid]] = (start, block)
+        hasher = self._get_block_hasher(blockhash)
+        try:
+            blocks = [input_str[start: (start + blocksize)] for start in range(
+                0, nblocks * blocksize, blocksize)]
+            for block, hash in izip(blocks, hasher.hash_blocks(blocks)):
+                hashes.append(hash)
+                hmap[hash] = block
+        finally:
+            hasher.close()
 
         hashmap = dict(bytes=size, hashes=hashes)
         missing, obj_headers = self._create_object_or_get_missing_hashes(
@@ -575,49 +974,24 @@ class PithosClient(PithosRestClient):
             public=public)
         if missing is None:
             return obj_headers
-        num_of_missing = len(missing)
-
+        upload_gen = None
         if upload_cb:
-            self.progress_bar_gen = upload_cb(nblocks)
-            for i in range(nblocks + 1 - num_of_missing):
-                self._cb_next()
+            upload_gen = upload_cb(nblocks)
+            for i in range(nblocks + 1 - len(missing)):
+                try:
+                    upload_gen.next()
+                except:
+                    sendlog.debug('Progress bar failure')
+                    break
 
-        tries = 7
-        old_failures = 0
-        try:
-            while tries and missing:
-                flying = []
-                failures = []
-                for hash in missing:
-                    offset, block = hmap[hash]
-                    bird = self._put_block_async(block, hash)
-                    flying.append(bird)
-                    unfinished = self._watch_thread_limit(flying)
-                    for thread in set(flying).difference(unfinished):
-                        if thread.exception:
-                            failures.append(thread.kwargs['hash'])
-                        if thread.isAlive():
-                            flying.append(thread)
-                        else:
-                            self._cb_next()
-                    flying = unfinished
-                for thread in flying:
-                    thread.join()
-                    if thread.exception:
-                        failures.append(thread.kwargs['hash'])
-                    self._cb_next()
-                missing = failures
-                if missing and len(missing) == old_failures:
-                    tries -= 1
-                old_failures = len(missing)
-            if missing:
-                raise ClientError('%s blocks failed to upload' % len(missing))
-        except KeyboardInterrupt:
-            sendlog.info('- - - wait for threads to finish')
-            for thread in activethreads():
-                thread.join()
-            raise
-        self._cb_next()
+        #  Each block upload is retried according to the RETRY_POLICY
+        sendlog.info('%s blocks missing' % len(missing))
+        failures = self._upload_blocks(
+            missing, lambda hash: hmap[hash], upload_gen)
+        if failures:
+            raise ClientError(
+                '%s blocks failed to upload' % len(failures),
+                details=['%s' % job.exception for job in failures])
 
         r = self.object_put(
             obj,
@@ -653,97 +1027,287 @@ class PithosClient(PithosRestClient):
                 map_dict[h] = [i]
         return (blocksize, blockhash, total_size, hashmap['hashes'], map_dict)
 
-    def _dump_blocks_sync(
-            self, obj, remote_hashes, blocksize, total_size, dst, crange,
-            **args):
+    def _iter_block_runs(
+            self, obj, remote_hashes, blocksize, total_size, crange, **args):
+        """Fetch blocks concurrently, on the worker pool, and yield them in
+        order. Fetched blocks wait in a reorder window of 2 * MAX_THREADS
+        requests at most, so memory is bounded no matter how large the object
+        is. Pending requests are canceled if the generator is closed
+
+        :returns: (generator) of (number of blocks, content) for each range
+            request, in order. Blocks out of crange come with empty content,
+            maybe out of order
+        """
         if not total_size:
             return
-        for blockid, blockhash in enumerate(remote_hashes):
-            if blockhash:
+        window, window_size = deque(), 2 * self.MAX_THREADS
+        span = 1 if crange else max(1, self.MAX_RANGE_BLOCKS)
+
+        def harvest():
+            job, count = window.popleft()
+            job.join()
+            if job.exception:
+                raise job.exception
+            return count, job.value.content
+
+        try:
+            blockids = [i for i, h in enumerate(remote_hashes) if h]
+            for blockid, count in _block_runs(blockids, span):
                 start = blocksize * blockid
-                is_last = start + blocksize > total_size
-                end = (total_size - 1) if is_last else (start + blocksize - 1)
+                end = min(total_size, start + count * blocksize) - 1
                 data_range = _range_up(start, end, total_size, crange)
                 if not data_range:
-                    self._cb_next()
+                    yield count, ''
                     continue
-                args['data_range'] = 'bytes=%s' % data_range
-                r = self.object_get(obj, success=(200, 206), **args)
-                self._cb_next()
-                dst.write(r.content)
+                while len(window) >= window_size:
+                    yield harvest()
+                window.append((self.worker_pool.submit(
+                    self._limited_call, end - start + 1,
+                    self.object_get, obj,
+                    success=(200, 206),
+                    **dict(args, data_range='bytes=%s' % data_range)), count))
+            while window:
+                yield harvest()
+        finally:
+            if window:
+                sendlog.info('- - - cancel pending block downloads')
+            for job, count in window:
+                job.cancel()
+
+    def _dump_blocks_ordered(
+            self, obj, remote_hashes, blocksize, total_size, dst, crange,
+            **args):
+        """Fetch blocks concurrently and write them to dst in order, so that
+        dst may be a stream (e.g., a pipe or a tty)
+        """
+        for count, content in self._iter_block_runs(
+                obj, remote_hashes, blocksize, total_size, crange, **args):
+            if content:
+                dst.write(content)
                 dst.flush()
+            self._cb_next(count)
+
+    def _get_blocks_to_file(
+            self, obj, local_file, file_lock, blocks, blocksize, offset=0,
+            block_cache=None, blockhash=None, **restargs):
+        """GET a range of blocks and write it to local_file while it is
+        streamed. Only blocks to be cached or written in many positions are
+        kept in memory as a whole
+
+        :param file_lock: (Lock) guards seek-write pairs on local_file
+
+        :param blocks: (list) the (hash, positions in the file) of each block
+            of the range
+        """
+        r = self.object_get(obj, success=(200, 206), stream=True, **restargs)
+        #  The range of a single block is not split (e.g., in a filerange)
+        span = blocksize if len(blocks) > 1 else None
+        i, written, kept = 0, 0, []
+
+        def keep(i):
+            hash, block_starts = blocks[i]
+            return len(block_starts) > 1 or bool(
+                block_cache is not None and hash)
+
+        def block_done(i):
+            if not kept:
+                return
+            hash, block_starts = blocks[i]
+            block = ''.join(kept)
+            del kept[:]
+            if block_cache is not None and hash:
+                block_cache.set(self._cache_key(blockhash, hash), block)
+            with file_lock:
+                for block_start in block_starts:
+                    local_file.seek(block_start + offset)
+                    local_file.write(block)
+
+        for chunk in r.iter_content():
+            while chunk:
+                size = len(chunk) if span is None else min(
+                    len(chunk), span - written)
+                piece, chunk = chunk[:size], chunk[size:]
+                if keep(i):
+                    kept.append(piece)
+                else:
+                    with file_lock:
+                        local_file.seek(blocks[i][1][0] + offset + written)
+                        local_file.write(piece)
+                written += size
+                if written == span:
+                    block_done(i)
+                    i, written = i + 1, 0
+        if written:
+            block_done(i)
 
-    def _get_block_async(self, obj, **args):
-        event = SilentEvent(self.object_get, obj, success=(200, 206), **args)
-        event.start()
-        return event
+    def _hash_local_blocks(self, source, blockids, blocksize, blockhash):
+        """Hash blocks of a local file in parallel, with the block hasher
 
-    def _hash_from_file(self, fp, start, size, blockhash):
-        fp.seek(start)
-        block = readall(fp, size)
-        h = newhashlib(blockhash)
-        h.update(block.strip('\x00'))
-        return hexlify(h.digest())
+        :param source: (BlockSource) the local file
 
-    def _thread2file(self, flying, blockids, local_file, offset=0, **restargs):
-        """write the results of a greenleted rest call to a file
+        :param blockids: (list of int) the indices of the blocks to hash
 
-        :param offset: the offset of the file up to blocksize
-        - e.g. if the range is 10-100, all blocks will be written to
-        normal_position - 10
+        :returns: (dict) {block index: block hash}
         """
-        for key, g in flying.items():
-            if g.isAlive():
+        hasher = self._get_block_hasher(blockhash)
+        try:
+            return dict(zip(blockids, hasher.hash_blocks(
+                source.block(i * blocksize, blocksize) for i in blockids)))
+        finally:
+            hasher.close()
+
+    def _cache_key(self, blockhash, hash):
+        return '%s:%s' % (blockhash, hash)
+
+    def _get_cached_block(self, block_cache, blockhash, hash):
+        """:returns: (str) the block, if it is cached and not corrupted"""
+        key = self._cache_key(blockhash, hash)
+        block = block_cache.get(key)
+        if block is not None and _pithos_hash(block, blockhash) != hash:
+            sendlog.info('Cached block %s is corrupted' % hash)
+            block_cache.delete(key)
+            return None
+        return block
+
+    def _thread2file(
+            self, flying, blockids, local_file, file_lock, blocksize=None,
+            journal=None):
+        """Collect the jobs that have written block ranges to a file. The
+        blocks of successful jobs are journaled, and then the first failure,
+        if any, is raised
+
+        :param blockids: (dict) for each fetched range, a list with the
+            (hash, positions in the file) of each block of the range
+
+        :param file_lock: (Lock) guards local_file from the writing threads
+
+        :param blocksize: (int) needed to journal the blocks
+
+        :param journal: (DownloadJournal) if given, record written blocks
+        """
+        done = [key for key, g in flying.items() if not g.isAlive()]
+        #  Blocks are journaled only after they are flushed to the file
+        with file_lock:
+            local_file.flush()
+        failure = None
+        for key in done:
+            job, blocks = flying.pop(key), blockids.pop(key)
+            if job.exception:
+                failure = failure or job.exception
                 continue
-            if g.exception:
-                raise g.exception
-            block = g.value.content
-            for block_start in blockids[key]:
-                local_file.seek(block_start + offset)
-                local_file.write(block)
-                self._cb_next()
-            flying.pop(key)
-            blockids.pop(key)
-        local_file.flush()
+            for hash, block_starts in blocks:
+                for block_start in block_starts:
+                    if journal:
+                        journal.record(block_start // blocksize, hash)
+                    self._cb_next()
+        if journal:
+            journal.flush()
+        if failure:
+            raise failure
 
     def _dump_blocks_async(
             self, obj, remote_hashes, blocksize, total_size, local_file,
-            blockhash=None, resume=False, filerange=None, **restargs):
+            blockhash=None, resume=False, filerange=None, block_cache=None,
+            journal=None, verify=False, **restargs):
         file_size = fstat(local_file.fileno()).st_size if resume else 0
         flying = dict()
         blockid_dict = dict()
         offset = 0
+        file_lock = Lock()
+        if filerange:
+            block_cache, journal = None, None
+
+        #  Blocks already in the local file: recorded in the journal (unless
+        #  asked to verify them all) or verified by hashing, in parallel
+        local_hashes, verified = dict(), dict()
+        if file_size:
+            if journal and not verify:
+                local_hashes = journal.load()
+            unknown = sorted(blk for block_hash, blockids in (
+                remote_hashes.items()) for blk in blockids if (
+                    blk * blocksize < file_size and (
+                        local_hashes.get(blk) != block_hash)))
+            verified = self._hash_local_blocks(
+                BlockSource(local_file), unknown, blocksize, blockhash)
+            local_hashes.update(verified)
+        if journal:
+            journal.open(keep=bool(file_size) and not verify)
+            for blk in sorted(verified):
+                journal.record(blk, verified[blk])
+
+        try:
+            #  For each block to fetch, its hash and the positions to write
+            unsaved_blocks = dict()
+            for block_hash, blockids in remote_hashes.items():
+                unsaved = [blk * blocksize for blk in blockids if not (
+                    blk * blocksize < file_size and (
+                        local_hashes.get(blk) == block_hash))]
+                self._cb_next(len(blockids) - len(unsaved))
+                if not unsaved:
+                    continue
+                block = None if block_cache is None else (
+                    self._get_cached_block(block_cache, blockhash, block_hash))
+                if block is None:
+                    unsaved_blocks[unsaved[0] // blocksize] = (
+                        block_hash, unsaved)
+                    continue
+                for block_start in unsaved:
+                    #  Trailing zeros are not hashed, so they may be missing
+                    size = min(blocksize, total_size - block_start)
+                    local_file.seek(block_start)
+                    local_file.write(block[:size])
+                    local_file.write('\x00' * (size - len(block)))
+                    if journal:
+                        journal.record(block_start // blocksize, block_hash)
+                    self._cb_next()
 
-        self._init_thread_limit()
-        for block_hash, blockids in remote_hashes.items():
-            blockids = [blk * blocksize for blk in blockids]
-            unsaved = [blk for blk in blockids if not (
-                blk < file_size and block_hash == self._hash_from_file(
-                        local_file, blk, blocksize, blockhash))]
-            self._cb_next(len(blockids) - len(unsaved))
-            if unsaved:
-                key = unsaved[0]
-                self._watch_thread_limit(flying.values())
+            span = 1 if filerange else max(1, self.MAX_RANGE_BLOCKS)
+            pool = self.worker_pool
+            for blockid, count in _block_runs(sorted(unsaved_blocks), span):
+                key = blockid * blocksize
                 self._thread2file(
-                    flying, blockid_dict, local_file, offset,
-                    **restargs)
-                end = total_size - 1 if (
-                    key + blocksize > total_size) else key + blocksize - 1
+                    flying, blockid_dict, local_file, file_lock, blocksize,
+                    journal)
+                end = min(total_size, key + count * blocksize) - 1
                 if end < key:
-                    self._cb_next()
+                    self._cb_next(count)
                     continue
                 data_range = _range_up(key, end, total_size, filerange)
                 if not data_range:
-                    self._cb_next()
+                    self._cb_next(count)
                     continue
-                restargs[
-                    'async_headers'] = {'Range': 'bytes=%s' % data_range}
-                flying[key] = self._get_block_async(obj, **restargs)
-                blockid_dict[key] = unsaved
-
-        for thread in flying.values():
-            thread.join()
-        self._thread2file(flying, blockid_dict, local_file, offset, **restargs)
+                restargs['async_headers'] = {
+                    'Range': 'bytes=%s' % data_range}
+                blocks = [unsaved_blocks[blockid + i] for i in range(count)]
+                flying[key] = pool.submit(
+                    self._limited_call, end - key + 1,
+                    self._get_blocks_to_file, obj, local_file, file_lock,
+                    blocks, blocksize, offset, block_cache, blockhash,
+                    **restargs)
+                blockid_dict[key] = blocks
+
+            for job in flying.values():
+                job.join()
+            self._thread2file(
+                flying, blockid_dict, local_file, file_lock, blocksize,
+                journal)
+        except (Exception, KeyboardInterrupt):
+            #  Keep what is downloaded so far in the journal, to resume
+            exc_info = sys.exc_info()
+            for job in flying.values():
+                job.cancel()
+            for job in flying.values():
+                job.join()
+            try:
+                self._thread2file(
+                    flying, blockid_dict, local_file, file_lock, blocksize,
+                    journal)
+            except Exception:
+                pass
+            raise exc_info[0], exc_info[1], exc_info[2]
+        finally:
+            if journal:
+                journal.close()
 
     def download_object(
             self, obj, dst,
@@ -754,12 +1318,17 @@ class PithosClient(PithosRestClient):
             if_match=None,
             if_none_match=None,
             if_modified_since=None,
-            if_unmodified_since=None):
+            if_unmodified_since=None,
+            block_cache=None,
+            journal=False,
+            verify=False):
         """Download an object (multiple connections, random blocks)
 
         :param obj: (str) remote object path
 
-        :param dst: open file descriptor (wb+)
+        :param dst: open file descriptor (wb+). If it is not seekable (e.g.,
+            a pipe or a tty), blocks are still downloaded concurrently, but
+            they are written in order
 
         :param download_cb: optional progress.bar object for downloading
 
@@ -775,7 +1344,19 @@ class PithosClient(PithosRestClient):
 
         :param if_modified_since: (str) formated date
 
-        :param if_unmodified_since: (str) formated date"""
+        :param if_unmodified_since: (str) formated date
+
+        :param block_cache: (FileCache) a local store of blocks, keyed by
+            block hash. Cached blocks are not downloaded again, downloaded
+            blocks are cached. It can be shared by any number of objects
+
+        :param journal: (bool) keep a journal of the blocks written to dst,
+            at <dst name>.kamaki-journal, so that resuming an interrupted
+            download does not need to hash the blocks recorded there. The
+            journal is removed when the download is complete
+
+        :param verify: (bool) when resuming, hash all local blocks, even the
+            ones recorded in the journal"""
         restargs = dict(
             version=version,
             data_range=None if range_str is None else 'bytes=%s' % range_str,
@@ -796,8 +1377,8 @@ class PithosClient(PithosRestClient):
             self.progress_bar_gen = download_cb(len(hash_list))
             self._cb_next()
 
-        if dst.isatty():
-            self._dump_blocks_sync(
+        if not _is_seekable(dst):
+            self._dump_blocks_ordered(
                 obj,
                 hash_list,
                 blocksize,
@@ -806,6 +1387,9 @@ class PithosClient(PithosRestClient):
                 range_str,
                 **restargs)
         else:
+            dl_journal = DownloadJournal(
+                '%s.kamaki-journal' % dst.name, blocksize, blockhash) if (
+                    journal and not range_str) else None
             self._dump_blocks_async(
                 obj,
                 remote_hashes,
@@ -815,12 +1399,204 @@ class PithosClient(PithosRestClient):
                 blockhash,
                 resume,
                 range_str,
+                block_cache,
+                dl_journal,
+                verify,
                 **restargs)
             if not range_str:
                 dst.truncate(total_size)
+            if dl_journal:
+                dl_journal.remove()
 
         self._complete_cb()
 
+    def iter_object_blocks(
+            self, obj,
+            version=None,
+            range_str=None,
+            if_match=None,
+            if_none_match=None,
+            if_modified_since=None,
+            if_unmodified_since=None):
+        """Download an object block by block (multiple connections), without
+        keeping more than 2 * MAX_THREADS blocks in memory
+
+        :param obj: (str) remote object path
+
+        :param version: (str) file version
+
+        :param range_str: (str) from, to are file positions (int) in bytes
+
+        :param if_match: (str)
+
+        :param if_none_match: (str)
+
+        :param if_modified_since: (str) formated date
+
+        :param if_unmodified_since: (str) formated date
+
+        :returns: (generator) of str, the object contents in order, a block
+            at a time. Pending downloads are canceled if it is closed early
+        """
+        restargs = dict(
+            version=version,
+            data_range=None if range_str is None else 'bytes=%s' % range_str,
+            if_match=if_match,
+            if_none_match=if_none_match,
+            if_modified_since=if_modified_since,
+            if_unmodified_since=if_unmodified_since)
+        (
+            blocksize,
+            blockhash,
+            total_size,
+            hash_list,
+            remote_hashes) = self._get_remote_blocks_info(obj, **restargs)
+        for count, content in self._iter_block_runs(
+                obj, hash_list, blocksize, total_size, range_str, **restargs):
+            if count == 1 or range_str:
+                if content:
+                    yield content
+                continue
+            for i in xrange(0, len(content), blocksize):
+                yield content[i:i + blocksize]
+
+    def _get_object_range(self, obj, start, end, version=None):
+        r = self.object_get(
+            obj, version=version, data_range='bytes=%s-%s' % (start, end),
+            success=(200, 206))
+        return r.content
+
+    def get_block_async(self, obj, start, end, version=None):
+        """Download a range of an object (e.g., a block), without waiting
+
+        :param start: (int) the first byte of the range
+
+        :param end: (int) the last byte of the range
+
+        :returns: (Task) task.result() is the content of the range
+        """
+        r = self.object_get(
+            obj, version=version, data_range='bytes=%s-%s' % (start, end),
+            success=None)
+        return self.perform_async(
+            r, success=(200, 206), nbytes=end - start + 1,
+            then=lambda r: r.content)
+
+    def list_objects_async(self, **kwargs):
+        """List the objects of the container, without waiting. Arguments are
+        the same as in container_get
+
+        :returns: (Task) task.result() is the list of objects
+        """
+        r = self.container_get(success=None, **kwargs)
+        return self.perform_async(
+            r, success=self.LISTING_STATUSES, then=self._listed_objects)
+
+    def _iter_listing(
+            self, get_page, marker=None, page_size=None, prefetch=True):
+        """Follow the marker of a paginated listing. With prefetch, the next
+        page is requested while the items of the current one are consumed
+
+        :param get_page: method(limit, marker) -> a listing response
+        """
+        page_size = max(1, min(
+            int(page_size or self.LISTING_LIMIT), self.LISTING_LIMIT))
+
+        def page_after(marker):
+            r = get_page(page_size, marker)
+            return r.json if r.status_code == 200 else []
+
+        page, job = page_after(marker), None
+        try:
+            while page:
+                #  A short page is the last one
+                last = page[-1] if len(page) >= page_size else None
+                marker = last and last.get('name', last.get('subdir'))
+                job = self.call_async(page_after, marker) if (
+                    marker and prefetch) else None
+                for item in page:
+                    yield item
+                if not marker:
+                    return
+                page = job.result() if job else page_after(marker)
+                job = None
+        finally:
+            if job:
+                job.cancel()
+
+    def iter_objects(
+            self,
+            prefix=None,
+            delimiter=None,
+            path=None,
+            marker=None,
+            page_size=None,
+            prefetch=True,
+            meta=[],
+            show_only_shared=False,
+            public=False,
+            until=None,
+            if_modified_since=None,
+            if_unmodified_since=None):
+        """Iterate over all the objects of the container, following the
+        listing marker from page to page. Arguments are the same as in
+        container_get
+
+        :param page_size: (int) items per request, up to LISTING_LIMIT
+
+        :param prefetch: (bool) request the next page while the current one
+            is consumed
+
+        :returns: (generator) of dicts, the listed objects (or subdirs)
+        """
+        self._assert_container()
+        #  Pages are listed from the current container, even if it changes
+        client = copy(self)
+
+        def get_page(limit, marker):
+            return client.container_get(
+                limit=limit,
+                marker=marker,
+                prefix=prefix,
+                delimiter=delimiter,
+                path=path,
+                meta=meta,
+                show_only_shared=show_only_shared,
+                public=public,
+                until=until,
+                if_modified_since=if_modified_since,
+                if_unmodified_since=if_unmodified_since,
+                success=(200, 204, 304))
+        return self._iter_listing(get_page, marker, page_size, prefetch)
+
+    def iter_containers(
+            self,
+            marker=None,
+            page_size=None,
+            prefetch=True,
+            show_only_shared=False,
+            public=False,
+            until=None,
+            if_modified_since=None,
+            if_unmodified_since=None):
+        """Iterate over all the containers of the account, following the
+        listing marker from page to page. Arguments are the same as in
+        account_get and iter_objects
+
+        :returns: (generator) of dicts, the listed containers
+        """
+        def get_page(limit, marker):
+            return self.account_get(
+                limit=limit,
+                marker=marker,
+                show_only_shared=show_only_shared,
+                public=public,
+                until=until,
+                if_modified_since=if_modified_since,
+                if_unmodified_since=if_unmodified_since,
+                success=(200, 204, 304))
+        return self._iter_listing(get_page, marker, page_size, prefetch)
+
     def download_to_string(
             self, obj,
             download_cb=None,
@@ -871,35 +1647,15 @@ class PithosClient(PithosRestClient):
             self.progress_bar_gen = download_cb(len(hash_list))
             self._cb_next()
 
-        num_of_blocks = len(remote_hashes)
-        ret = [''] * num_of_blocks
-        self._init_thread_limit()
-        flying = dict()
-        try:
-            for blockid, blockhash in enumerate(remote_hashes):
-                start = blocksize * blockid
-                is_last = start + blocksize > total_size
-                end = (total_size - 1) if is_last else (start + blocksize - 1)
-                data_range_str = _range_up(start, end, end, range_str)
-                if data_range_str:
-                    self._watch_thread_limit(flying.values())
-                    restargs['data_range'] = 'bytes=%s' % data_range_str
-                    flying[blockid] = self._get_block_async(obj, **restargs)
-                for runid, thread in flying.items():
-                    if (blockid + 1) == num_of_blocks:
-                        thread.join()
-                    elif thread.isAlive():
-                        continue
-                    if thread.exception:
-                        raise thread.exception
-                    ret[runid] = thread.value.content
-                    self._cb_next()
-                    flying.pop(runid)
-            return ''.join(ret)
-        except KeyboardInterrupt:
-            sendlog.info('- - - wait for threads to finish')
-            for thread in activethreads():
-                thread.join()
+        #  A range may be shorter than the object, never longer
+        ret, size = bytearray(total_size), 0
+        for count, content in self._iter_block_runs(
+                obj, hash_list, blocksize, total_size, range_str, **restargs):
+            ret[size:size + len(content)] = content
+            size += len(content)
+            self._cb_next(count)
+        del ret[size:]
+        return str(ret)
 
     #Command Progress Bar method
     def _cb_next(self, step=1):
@@ -952,6 +1708,44 @@ class PithosClient(PithosRestClient):
             raise
         return r.json
 
+    def get_file_hashmap(
+            self, f, size=None, container_info_cache=None, hash_cache=None):
+        """Calculate the hashmap a local file would have as an object of the
+        container, so that it can be compared to get_object_hashmap
+
+        :param f: open file descriptor (rb)
+
+        :param size: (int) size of data to hash from f (default: all)
+
+        :param container_info_cache: (dict) if given, avoid redundant calls to
+            server for container info (block size and hash information)
+
+        :param hash_cache: (FileCache) if given, cached block hashes are used
+            and calculated ones are cached, as in upload_object
+
+        :returns: (dict) with block_size, block_hash, bytes, hashes and hash,
+            the hash of the whole hashmap, as in object listings
+        """
+        self._assert_container()
+        block_info = (
+            blocksize, blockhash, size, nblocks) = self._get_file_block_info(
+                f, size, container_info_cache)
+        hashes, hmap = [], {}
+        cache_key = self._hash_cache_key(
+            f, size, blocksize, blockhash) if hash_cache else None
+        cached = cache_key and self._get_cached_hashes(
+            hash_cache, cache_key, size, blocksize, hmap)
+        if cached:
+            hashes = cached
+        else:
+            self._calculate_blocks_for_upload(
+                *block_info, hashes=hashes, hmap=hmap, fileobj=f)
+            if cache_key:
+                hash_cache.set(cache_key, json_dumps(hashes))
+        return dict(
+            block_size=blocksize, block_hash=blockhash, bytes=size,
+            hashes=hashes, hash=_pithos_top_hash(hashes, blockhash))
+
     def set_account_group(self, group, usernames):
         """
         :param group: (str)
@@ -1312,49 +2106,47 @@ class PithosClient(PithosRestClient):
         filesize = fstat(source_file.fileno()).st_size
         nblocks = 1 + (filesize - 1) // blocksize
         offset = 0
-        headers = {}
+        headers = []
         if upload_cb:
             self.progress_bar_gen = upload_cb(nblocks)
             self._cb_next()
-        flying = {}
-        self._init_thread_limit()
+        pool, flying = self.worker_pool, []
         try:
             for i in range(nblocks):
                 block = source_file.read(min(blocksize, filesize - offset))
                 offset += len(block)
-
-                self._watch_thread_limit(flying.values())
-                unfinished = {}
-                flying[i] = SilentEvent(
-                    method=self.object_post,
+                flying.append(pool.submit(
+                    self.object_post,
                     obj=obj,
                     update=True,
                     content_range='bytes */*',
                     content_type='application/octet-stream',
                     content_length=len(block),
-                    data=block)
-                flying[i].start()
-
-                for key, thread in flying.items():
-                    if thread.isAlive():
-                        if i < (nblocks - 1):
-                            unfinished[key] = thread
-                            continue
-                        thread.join()
-                    if thread.exception:
-                        raise thread.exception
-                    headers[key] = thread.value.headers
+                    data=block))
+                unfinished = []
+                for job in flying:
+                    if job.isAlive():
+                        unfinished.append(job)
+                        continue
+                    if job.exception:
+                        raise job.exception
+                    headers.append(job.value.headers)
                     self._cb_next()
                 flying = unfinished
-        except KeyboardInterrupt:
-            sendlog.info('- - - wait for threads to finish')
-            for thread in activethreads():
-                thread.join()
+            for job in flying:
+                job.join()
+                if job.exception:
+                    raise job.exception
+                headers.append(job.value.headers)
+                self._cb_next()
+        except (Exception, KeyboardInterrupt):
+            sendlog.info('- - - cancel pending appends')
+            for job in flying:
+                job.cancel()
+            raise
         finally:
-            from time import sleep
-            sleep(2 * len(activethreads()))
             self._cb_next()
-        return headers.values()
+        return headers
 
     def truncate_object(self, obj, upto_bytes):
         """
@@ -546,7 +546,9 @@ class PithosRestClient(StorageClient):
         path = path4url(self.account, self.container, obj)
         success = kwargs.pop('success', 200)
         r = self.get(path, *args, success=success, **kwargs)
-        self._unquote_header_keys(r.headers, ('x-object-meta-'))
+        if success is not None:
+            #  Otherwise, the request is not performed yet
+            self._unquote_header_keys(r.headers, ('x-object-meta-'))
         return r
 
     def object_put(
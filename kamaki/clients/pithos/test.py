@@ -153,6 +153,28 @@ class FR(object):
     status = None
     status_code = 200
 
+    def iter_content(self, chunk_size=64 * 1024):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+
+def fake_perform_async(r, success=200, nbytes=0, then=None):
+    """Complete an async request at once, with the response of a mock"""
+    from kamaki.clients.utils.eventloop import Future
+    future = Future()
+    try:
+        future.set_result(then(r) if then else r)
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+
+class SFR(FR):
+    """A Fake Response with some content"""
+
+    def __init__(self, content):
+        self.content = content
+
 
 class PithosRestClient(TestCase):
 
@@ -771,6 +793,99 @@ class PithosMethods(TestCase):
                 ((42, 333, 800, '100,50-200,-600',), '42-100,50-200,200-333')):
             self.assertEqual(_range_up(*args), expected)
 
+    def test__block_runs(self):
+        from kamaki.clients.pithos import _block_runs
+        for blockids, max_blocks, expected in (
+                ([], 4, []),
+                ([0, 1, 2, 3, 4], 1, [(i, 1) for i in range(5)]),
+                ([0, 1, 2, 3, 4], 2, [(0, 2), (2, 2), (4, 1)]),
+                ([0, 1, 2, 3, 4], 8, [(0, 5)]),
+                ([1, 2, 4, 5, 6, 9], 3, [(1, 2), (4, 3), (9, 1)]),
+                ([3], 3, [(3, 1)])):
+            self.assertEqual(list(_block_runs(blockids, max_blocks)), expected)
+
+    def test_DownloadJournal(self):
+        from tempfile import mkdtemp
+        from shutil import rmtree
+        from os import path
+        tmp_dir = mkdtemp()
+        try:
+            jpath = path.join(tmp_dir, 'journal')
+            journal = pithos.DownloadJournal(jpath, 16, 'sha256')
+            self.assertEqual(journal.load(), {})
+            journal.open()
+            journal.record(0, 'h0')
+            journal.record(3, 'h3')
+            journal.close()
+            self.assertEqual(journal.load(), {0: 'h0', 3: 'h3'})
+            journal.open(keep=True)
+            journal.record(1, 'h1')
+            journal.flush()
+            self.assertEqual(journal.load(), {0: 'h0', 1: 'h1', 3: 'h3'})
+            journal.close()
+            with open(jpath, 'a') as f:
+                f.write('4')
+            self.assertEqual(journal.load(), {0: 'h0', 1: 'h1', 3: 'h3'})
+            other = pithos.DownloadJournal(jpath, 32, 'sha256')
+            self.assertEqual(other.load(), {})
+            journal.open(keep=False)
+            journal.close()
+            self.assertEqual(journal.load(), {})
+            journal.remove()
+            self.assertFalse(path.exists(jpath))
+        finally:
+            rmtree(tmp_dir)
+
+    def test_block_hashers(self):
+        from kamaki.clients.pithos import _pithos_hash, BLOCK_HASHERS
+        blocks = [urandom(randint(1, 4096)) for i in range(9)] + [
+            'last block\x00\x00', '']
+        for blockhash in ('sha256', 'md5'):
+            expected = [_pithos_hash(b, blockhash) for b in blocks]
+            for name, cls in BLOCK_HASHERS.items():
+                hasher = cls(blockhash, workers=2)
+                try:
+                    r = list(hasher.hash_blocks(iter(blocks)))
+                finally:
+                    hasher.close()
+                self.assertEqual(r, expected)
+            self.assertEqual(
+                [_pithos_hash(buffer(b), blockhash) for b in blocks],
+                expected)
+
+    def test_pithos_top_hash(self):
+        from kamaki.clients.pithos import _pithos_top_hash
+        from hashlib import sha256
+        blocks = [sha256(b) for b in ('a', 'b', 'c')]
+        hashes = [h.hexdigest() for h in blocks]
+        self.assertEqual(_pithos_top_hash(hashes[:1], 'sha256'), hashes[0])
+        self.assertEqual(
+            _pithos_top_hash([], 'sha256'), sha256('').hexdigest())
+        #  3 hashes are padded to 4 with a zero hash
+        left = sha256(blocks[0].digest() + blocks[1].digest()).digest()
+        right = sha256(blocks[2].digest() + '\x00' * 32).digest()
+        self.assertEqual(
+            _pithos_top_hash(hashes, 'sha256'),
+            sha256(left + right).hexdigest())
+
+    def test_thread_block_hasher(self):
+        from kamaki.clients.pithos import ThreadBlockHasher, _get_hash_pool
+        pool = _get_hash_pool(3)
+        hasher = ThreadBlockHasher('sha256', workers=3)
+        submit = patch.object(pool, 'submit', wraps=pool.submit)
+        with submit as submit:
+            hashes = hasher.hash_blocks(iter(['%s' % i for i in range(20)]))
+            #  A window of 2 * workers blocks, then one more per hash
+            hashes.next()
+            self.assertEqual(len(submit.mock_calls), 6)
+            hashes.next()
+            self.assertEqual(len(submit.mock_calls), 7)
+            hashes.close()
+        hasher.close()
+        #  The pool is long-lived
+        self.assertFalse(pool.closed)
+        self.assertTrue(_get_hash_pool(3) is pool)
+
 
 class PithosClient(TestCase):
 
@@ -848,10 +963,11 @@ class PithosClient(TestCase):
         for i in range(len(r)):
             self.assert_dicts_are_equal(r[i], container_list[i])
 
+    @patch('%s.perform_async' % pithos_pkg, side_effect=fake_perform_async)
     @patch('%s.get_container_info' % pithos_pkg, return_value=container_info)
     @patch('%s.container_post' % pithos_pkg, return_value=FR())
     @patch('%s.object_put' % pithos_pkg, return_value=FR())
-    def test_upload_object(self, OP, CP, GCI):
+    def test_upload_object(self, OP, CP, GCI, PA):
         num_of_blocks = 8
         tmpFile = self._create_temp_file(num_of_blocks)
 
@@ -972,6 +1088,45 @@ class PithosClient(TestCase):
         self.assertEqual(OP.mock_calls[-1][2]['if_etag_not_match'], '*')
         self.assertEqual(OP.mock_calls[-1][2]['etag'], etag)
 
+        # Pipelined: every block is uploaded while hashing
+        tmpFile.seek(0)
+        num_of_calls, num_of_posts = len(OP.mock_calls), len(CP.mock_calls)
+        FR.status_code = 201
+        r = self.client.upload_object(obj, tmpFile, pipeline=True)
+        self.assert_dicts_are_equal(r, exp_headers)
+        self.assertEqual(len(CP.mock_calls), num_of_posts + num_of_blocks)
+        self.assertEqual(len(OP.mock_calls), num_of_calls + 1)
+        (args, kwargs) = OP.mock_calls[-1][1:3]
+        self.assertEqual(args, (obj, ))
+        self.assertEqual(len(kwargs['json']['hashes']), num_of_blocks)
+        self.assertEqual(
+            kwargs['json']['bytes'], num_of_blocks * 4 * 1024 * 1024)
+        for c in CP.mock_calls[-num_of_blocks:]:
+            self.assertEqual(c[2]['content_length'], 4 * 1024 * 1024)
+
+        # With a hash cache: the second upload does not hash the file
+        from tempfile import mkdtemp
+        from shutil import rmtree
+        from os import listdir
+        from kamaki.clients.utils.cache import FileCache
+        cache_dir = mkdtemp()
+        try:
+            hash_cache = FileCache(cache_dir)
+            tmpFile.seek(0)
+            self.client.upload_object(obj, tmpFile, hash_cache=hash_cache)
+            hashes = OP.mock_calls[-1][2]['json']['hashes']
+            self.assertEqual(len(listdir(cache_dir)), 1)
+            tmpFile.seek(0)
+            with patch.object(
+                    pithos.PithosClient,
+                    '_calculate_blocks_for_upload') as CBFU:
+                self.client.upload_object(
+                    obj, tmpFile, hash_cache=hash_cache)
+                self.assertFalse(CBFU.called)
+            self.assertEqual(OP.mock_calls[-1][2]['json']['hashes'], hashes)
+        finally:
+            rmtree(cache_dir)
+
     @patch('%s.get_container_info' % pithos_pkg, return_value=container_info)
     @patch('%s.container_post' % pithos_pkg, return_value=FR())
     @patch('%s.object_put' % pithos_pkg, return_value=FR())
@@ -1404,6 +1559,367 @@ class PithosClient(TestCase):
             else:
                 self.assertEqual(GET.mock_calls[-1][2][k], v)
 
+    def test__dump_blocks_ordered(self):
+        from time import sleep
+
+        class Stream(object):
+            def __init__(self):
+                self.chunks = []
+
+            def write(self, data):
+                self.chunks.append(data)
+
+            def flush(self):
+                pass
+
+            def isatty(self):
+                return False
+
+            def seek(self, *args):
+                raise IOError('Illegal seek')
+
+        def get_block(obj, success, data_range, **kwargs):
+            sleep(randint(0, 10) / 1000.0)
+            return SFR(data_range)
+
+        self.assertFalse(pithos._is_seekable(Stream()))
+        blocksize, num_of_blocks = 4, 13
+        hashes = ['h%s' % i for i in range(num_of_blocks)]
+        total_size = blocksize * num_of_blocks - 2
+        self.client.MAX_THREADS = 3
+        with patch.object(
+                pithos.PithosClient, 'object_get',
+                side_effect=get_block) as GET:
+            for crange, exp_ranges in (
+                    (None, ['bytes=%s-%s' % (i * blocksize, min(
+                        total_size, (i + 1) * blocksize) - 1) for i in range(
+                            num_of_blocks)]),
+                    ('6-13', ['bytes=6-7', 'bytes=8-11', 'bytes=12-13'])):
+                dst = Stream()
+                self.client._dump_blocks_ordered(
+                    obj, hashes, blocksize, total_size, dst, crange)
+                self.assertEqual(dst.chunks, exp_ranges)
+                self.assertEqual(GET.mock_calls[-1][2]['success'], (200, 206))
+
+            GET.side_effect = ClientError('Failed', 500)
+            self.assertRaises(
+                ClientError, self.client._dump_blocks_ordered,
+                obj, hashes, blocksize, total_size, Stream(), None)
+
+    def test_download_coalesced(self):
+        blocksize, num_of_blocks = 16, 7
+        blocks = [urandom(blocksize) for i in range(num_of_blocks)]
+        blocks[4], blocks[-1] = blocks[1], blocks[-1][:-5]
+        content = ''.join(blocks)
+        hashes = ['h%s' % i for i in range(num_of_blocks)]
+        hashes[4] = hashes[1]
+        hashmap = dict(
+            block_hash='sha256', block_size=blocksize, bytes=len(content),
+            hashes=hashes)
+
+        def get_range(obj, success, async_headers=None, **kwargs):
+            rng = (async_headers or {}).get('Range') or kwargs['data_range']
+            start, end = rng.split('=')[1].split('-')
+            return SFR(content[int(start):int(end) + 1])
+
+        self.client.MAX_RANGE_BLOCKS = 3
+        with patch.object(
+                pithos.PithosClient, 'get_object_hashmap',
+                return_value=hashmap):
+            with patch.object(
+                    pithos.PithosClient, 'object_get',
+                    side_effect=get_range) as GET:
+                tmpFile = NamedTemporaryFile()
+                self.files.append(tmpFile)
+                self.client.download_object(obj, tmpFile)
+                tmpFile.seek(0)
+                self.assertEqual(tmpFile.read(), content)
+                #  block 4 is a copy of block 1: [0, 1, 2], [3], [5, 6]
+                self.assertEqual(
+                    [c[2]['async_headers']['Range'] for c in GET.mock_calls],
+                    ['bytes=0-47', 'bytes=48-63', 'bytes=80-106'])
+
+                GET.reset_mock()
+                self.assertEqual(
+                    self.client.download_to_string(obj), content)
+                self.assertEqual(len(GET.mock_calls), 3)
+
+    def test_download_block_cache(self):
+        from tempfile import mkdtemp
+        from shutil import rmtree
+        from kamaki.clients.utils.cache import FileCache
+        blocksize = 16
+        blocks = [urandom(blocksize) for i in range(4)] + ['last\x00']
+        blocks[2] = blocks[0]
+        content = ''.join(blocks)
+        hashes = [pithos._pithos_hash(b, 'sha256') for b in blocks]
+        hashmap = dict(
+            block_hash='sha256', block_size=blocksize, bytes=len(content),
+            hashes=hashes)
+
+        def get_range(obj, success, async_headers=None, **kwargs):
+            start, end = async_headers['Range'].split('=')[1].split('-')
+            return SFR(content[int(start):int(end) + 1])
+
+        cache_dir = mkdtemp()
+        try:
+            block_cache = FileCache(cache_dir)
+            with patch.object(
+                    pithos.PithosClient, 'get_object_hashmap',
+                    return_value=hashmap):
+                with patch.object(
+                        pithos.PithosClient, 'object_get',
+                        side_effect=get_range) as GET:
+                    for exp_calls in (4, 0):
+                        GET.reset_mock()
+                        tmpFile = NamedTemporaryFile()
+                        self.files.append(tmpFile)
+                        self.client.download_object(
+                            obj, tmpFile, block_cache=block_cache)
+                        tmpFile.seek(0)
+                        self.assertEqual(tmpFile.read(), content)
+                        self.assertEqual(len(GET.mock_calls), exp_calls)
+
+                    #  A corrupted block is downloaded again
+                    block_cache.set('sha256:%s' % hashes[1], 'corrupted')
+                    GET.reset_mock()
+                    tmpFile = NamedTemporaryFile()
+                    self.files.append(tmpFile)
+                    self.client.download_object(
+                        obj, tmpFile, block_cache=block_cache)
+                    tmpFile.seek(0)
+                    self.assertEqual(tmpFile.read(), content)
+                    self.assertEqual(len(GET.mock_calls), 1)
+                    self.assertEqual(
+                        block_cache.get('sha256:%s' % hashes[1]), blocks[1])
+        finally:
+            rmtree(cache_dir)
+
+    def test_download_journal(self):
+        from os import path
+        blocksize, num_of_blocks = 16, 6
+        blocks = [urandom(blocksize) for i in range(num_of_blocks)]
+        content = ''.join(blocks)
+        hashes = [pithos._pithos_hash(b, 'sha256') for b in blocks]
+        hashmap = dict(
+            block_hash='sha256', block_size=blocksize, bytes=len(content),
+            hashes=hashes)
+
+        calls = []
+
+        def get_range(obj, success, async_headers=None, **kwargs):
+            calls.append(async_headers['Range'])
+            if len(calls) == 4:
+                raise ClientError('Connection lost', 500)
+            start, end = async_headers['Range'].split('=')[1].split('-')
+            return SFR(content[int(start):int(end) + 1])
+
+        tmpFile = NamedTemporaryFile()
+        self.files.append(tmpFile)
+        jpath = '%s.kamaki-journal' % tmpFile.name
+        hash_local_blocks = pithos.PithosClient._hash_local_blocks
+        with patch.object(
+                pithos.PithosClient, 'get_object_hashmap',
+                return_value=hashmap):
+            with patch.object(
+                    pithos.PithosClient, 'object_get',
+                    side_effect=get_range):
+                self.assertRaises(
+                    ClientError, self.client.download_object,
+                    obj, tmpFile, journal=True)
+                #  Concurrent fetches may have started after the failure
+                self.assertTrue(len(calls) >= 4)
+                recorded = pithos.DownloadJournal(
+                    jpath, blocksize, 'sha256').load()
+                fetched = [int(c.split('=')[1].split('-')[0]) // blocksize
+                           for i, c in enumerate(calls) if i != 3]
+                self.assertEqual(sorted(recorded), sorted(fetched))
+
+                with patch.object(
+                        pithos.PithosClient, '_hash_local_blocks',
+                        side_effect=hash_local_blocks,
+                        autospec=True) as HLB:
+                    self.client.download_object(
+                        obj, tmpFile, resume=True, journal=True)
+                    #  Recorded blocks are not hashed again
+                    self.assertEqual(
+                        set(HLB.mock_calls[0][1][2]) & set(recorded), set())
+                    tmpFile.seek(0)
+                    self.assertEqual(tmpFile.read(), content)
+                    self.assertFalse(path.exists(jpath))
+
+                    #  Verify them all
+                    calls[:] = [None] * 5
+                    self.client.download_object(
+                        obj, tmpFile, resume=True, journal=True, verify=True)
+                    self.assertEqual(
+                        HLB.mock_calls[-1][1][2], range(num_of_blocks))
+                    self.assertEqual(len(calls), 5)
+                    tmpFile.seek(0)
+                    self.assertEqual(tmpFile.read(), content)
+
+    @patch('%s.perform_async' % pithos_pkg)
+    @patch('%s.container_get' % pithos_pkg)
+    @patch('%s.object_get' % pithos_pkg, return_value=SFR('d4t4'))
+    @patch('%s.container_post' % pithos_pkg)
+    def test_async_operations(self, POST, GET, CG, PA):
+        listing, block_hashes = FR(), FR()
+        listing.json, block_hashes.json = ['o1', 'o2'], ['h4sh']
+        CG.return_value, POST.return_value = listing, block_hashes
+        PA.side_effect = fake_perform_async
+        jobs = [
+            self.client.get_block_async(obj, 4, 7, version='v1'),
+            self.client.put_block_async('d4t4', 'h4sh'),
+            self.client.list_objects_async(prefix='o')]
+        self.assertEqual(
+            [job.result() for job in jobs], ['d4t4', None, ['o1', 'o2']])
+        GET.assert_called_once_with(
+            obj, version='v1', data_range='bytes=4-7', success=None)
+        POST.assert_called_once_with(
+            update=True, content_type='application/octet-stream',
+            content_length=4, data='d4t4', format='json', idempotent=True,
+            success=None)
+        CG.assert_called_once_with(prefix='o', success=None)
+        self.assertEqual([c[2]['nbytes'] for c in PA.mock_calls[:2]], [4, 4])
+        self.assertEqual(
+            [c[2]['success'] for c in PA.mock_calls],
+            [(200, 206), 202, (200, 204, 304, 404)])
+
+        self.assertRaises(
+            AssertionError,
+            self.client.put_block_async('d4t4', 'other').result)
+        listing.status_code = 404
+        self.assertRaises(
+            ClientError, self.client.list_objects_async().result)
+        listing.status_code = 200
+
+    def test_iter_objects(self):
+        names = ['o%02d' % i for i in range(25)]
+        pages = []
+
+        def container_get(limit=None, marker=None, **kwargs):
+            pages.append((limit, marker))
+            start = names.index(marker) + 1 if marker else 0
+            r = FR()
+            r.json = [dict(name=n) for n in names[start:start + limit]]
+            return r
+
+        with patch.object(
+                pithos.PithosClient, 'container_get',
+                side_effect=container_get) as CG:
+            for prefetch in (True, False):
+                pages[:] = []
+                r = self.client.iter_objects(
+                    prefix='o', page_size=10, prefetch=prefetch)
+                self.assertEqual([o['name'] for o in r], names)
+                self.assertEqual(
+                    pages, [(10, None), (10, 'o09'), (10, 'o19')])
+            self.assertEqual(CG.mock_calls[-1][2]['prefix'], 'o')
+
+            #  A full last page is followed by an empty one
+            pages[:] = []
+            self.client.LISTING_LIMIT = 10
+            try:
+                r = self.client.iter_objects(marker='o04', prefetch=False)
+                self.assertEqual([o['name'] for o in r], names[5:])
+            finally:
+                del self.client.LISTING_LIMIT
+            self.assertEqual(
+                pages, [(10, 'o04'), (10, 'o14'), (10, 'o24')])
+
+            #  Closing the iterator early, stops the listing
+            pages[:] = []
+            r = self.client.iter_objects(page_size=10)
+            self.assertEqual(r.next()['name'], 'o00')
+            r.close()
+            self.assertTrue(len(pages) <= 2)
+
+    def test_iter_containers(self):
+        FR.json = [dict(name='c1'), dict(name='c2')]
+        with patch.object(
+                pithos.PithosClient, 'account_get', return_value=FR()) as AG:
+            r = list(self.client.iter_containers(page_size=3, public=True))
+            self.assertEqual(r, FR.json)
+            AG.assert_called_once_with(
+                limit=3, marker=None, show_only_shared=False, public=True,
+                until=None, if_modified_since=None, if_unmodified_since=None,
+                success=(200, 204, 304))
+
+    def test_iter_object_blocks(self):
+        from time import sleep
+        blocksize, num_of_blocks = 16, 9
+        blocks = [urandom(blocksize) for i in range(num_of_blocks)]
+        blocks[-1] = blocks[-1][:7]
+        content = ''.join(blocks)
+        hashmap = dict(
+            block_hash='sha256', block_size=blocksize, bytes=len(content),
+            hashes=['h%s' % i for i in range(num_of_blocks)])
+
+        def get_range(obj, success, data_range, **kwargs):
+            sleep(randint(0, 5) / 1000.0)
+            start, end = data_range.split('=')[1].split('-')
+            return SFR(content[int(start):int(end) + 1])
+
+        self.client.MAX_THREADS = 2
+        with patch.object(
+                pithos.PithosClient, 'get_object_hashmap',
+                return_value=hashmap):
+            with patch.object(
+                    pithos.PithosClient, 'object_get',
+                    side_effect=get_range) as GET:
+                for span in (1, 4):
+                    self.client.MAX_RANGE_BLOCKS = span
+                    self.assertEqual(
+                        list(self.client.iter_object_blocks(obj)), blocks)
+                self.assertEqual(
+                    ''.join(self.client.iter_object_blocks(
+                        obj, range_str='20-40')), content[20:41])
+
+                #  Closing early does not fetch the whole object
+                GET.reset_mock()
+                self.client.MAX_RANGE_BLOCKS = 1
+                gen = self.client.iter_object_blocks(obj)
+                self.assertEqual(gen.next(), blocks[0])
+                gen.close()
+                self.assertTrue(len(GET.mock_calls) <= 1 + 4)
+                self.assertEqual(self.client.download_to_string(obj), content)
+                self.assertEqual(
+                    self.client.download_to_string(obj, range_str='-10'),
+                    content[-10:])
+
+    @patch('%s.get_container_info' % pithos_pkg, return_value=container_info)
+    def test_get_file_hashmap(self, GCI):
+        from hashlib import sha256
+        tmpFile = self._create_temp_file(2)
+        data, bs = tmpFile.read(), 4 * 1024 * 1024
+        tmpFile.seek(0)
+        r = self.client.get_file_hashmap(tmpFile)
+        hashes = [sha256(data[:bs]), sha256(data[bs:])]
+        self.assertEqual(r, dict(
+            block_size=bs, block_hash='sha256', bytes=2 * bs,
+            hashes=[h.hexdigest() for h in hashes],
+            hash=sha256(''.join(h.digest() for h in hashes)).hexdigest()))
+
+        #  Cached hashes are used
+        from tempfile import mkdtemp
+        from shutil import rmtree
+        from kamaki.clients.utils.cache import FileCache
+        cache_dir = mkdtemp()
+        try:
+            hash_cache = FileCache(cache_dir)
+            tmpFile.seek(0)
+            self.assertEqual(self.client.get_file_hashmap(
+                tmpFile, hash_cache=hash_cache), r)
+            tmpFile.seek(0)
+            with patch.object(
+                    pithos.PithosClient,
+                    '_calculate_blocks_for_upload') as CBFU:
+                self.assertEqual(self.client.get_file_hashmap(
+                    tmpFile, hash_cache=hash_cache), r)
+                self.assertFalse(CBFU.called)
+        finally:
+            rmtree(cache_dir)
+
     def test_get_object_hashmap(self):
         FR.json = object_hashmap
         for empty in (304, 412):
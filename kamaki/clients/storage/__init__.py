@@ -38,6 +38,8 @@ from kamaki.clients.utils import filter_in, filter_out, path4url
 class StorageClient(Client):
     """OpenStack Object Storage API 1.0 client"""
 
+    LISTING_STATUSES = (200, 204, 304, 404)
+
     def __init__(self, endpoint_url, token, account=None, container=None):
         super(StorageClient, self).__init__(endpoint_url, token)
         self.account = account
@@ -329,7 +331,14 @@ class StorageClient(Client):
             self.set_param('prefix', prefix, iff=prefix)
             self.set_param('delimiter', delimiter, iff=delimiter)
 
-        r = self.get(restpath, success=(200, 204, 304, 404), )
+        r = self.get(restpath, success=self.LISTING_STATUSES)
+        return self._listed_objects(r)
+
+    def _listed_objects(self, r):
+        """:returns: (list) the objects in a listing response r
+
+        :raises ClientError: 404 Invalid account
+        """
         if r.status_code == 404:
             raise ClientError(
                 "Invalid account (%s) for that container" % self.account,
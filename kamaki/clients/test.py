@@ -31,14 +31,18 @@
 # interpreted as representing official policies, either expressed
 # or implied, of GRNET S.A.
 
-from mock import patch, call
+from mock import patch, call, Mock
 from unittest import makeSuite, TestSuite, TextTestRunner, TestCase
 from time import sleep
 from inspect import getmembers, isclass
 from itertools import product
 from random import randint
+from tempfile import mkdtemp
+from shutil import rmtree
 
-from kamaki.clients.utils.test import Utils
+from kamaki.clients.utils.cache import FileCache
+from kamaki.clients.utils.test import (
+    Utils, Cache, Stats, Limiter, Flights, Transfers)
 from kamaki.clients.astakos.test import (
     AstakosClient, LoggedAstakosClient, CachedAstakosClient)
 from kamaki.clients.compute.test import ComputeClient, ComputeRestClient
@@ -127,15 +131,101 @@ class RequestManager(TestCase):
             self.assertEqual(req.headers, headers)
         self.assertRaises(AssertionError, self.RM, 'GOT', '', '', '', {}, {})
 
+    def test__connection_info(self):
+        from urlparse import urlparse
+        for url, path, params in product(
+                (
+                    'http://example.com', 'https://example.com:8443/v1/',
+                    'http://example.com/v1;p', 'http://example.com/?q=1'),
+                (
+                    '/c/o', 'c/o', '', u'/c/\u03c7', '/c/a;b', '/c/a?b',
+                    '/c/a#b'),
+                (dict(), dict(format='json', update=None, limit=0))):
+            req = self.RM('GET', url, path, params=params)
+            parsed = urlparse(req.url)
+            expected = (parsed.path or '/') + (
+                '?%s' % parsed.query if parsed.query else '')
+            self.assertEqual(req.path, expected)
+            self.assertEqual(
+                (req.scheme, req.netloc), (parsed.scheme, parsed.netloc))
+        req = self.RM('GET', 'http://example.com/v1', '/c', params=dict(
+            format='json', update=None))
+        self.assertTrue(req.url in (
+            'http://example.com/v1/c?format=json&update',
+            'http://example.com/v1/c?update&format=json'))
+
+    def test__encode_headers(self):
+        req = self.RM('POST', 'http://example.com', '/', headers={
+            'X-Object-Meta-Tag': u'\u03c7 y', 'X-Copy-From': '/c/a b',
+            'Content-Length': 42, 'X-Other': 'a b', 'X-None': None})
+        req.headers_to_quote = ['X-Copy-From']
+        req.header_prefices = ['x-object-meta-']
+        for i in range(2):
+            encoded = self.RM('POST', 'http://example.com', '/')
+            encoded.headers = dict(req.headers)
+            encoded.headers_to_quote = req.headers_to_quote
+            encoded.header_prefices = req.header_prefices
+            encoded._encode_headers()
+            self.assertEqual(encoded.headers, {
+                'X-Object-Meta-Tag': '%CF%87%20y', 'X-Copy-From': '/c/a%20b',
+                'Content-Length': '42', 'X-Other': 'a b', 'X-None': ''})
+
     @patch('httplib.HTTPConnection.getresponse')
     @patch('httplib.HTTPConnection.request')
-    def test_perform(self, request, getresponse):
+    @patch('httplib.HTTPConnection.connect')
+    def test_perform(self, connect, request, getresponse):
         from httplib import HTTPConnection
-        self.RM('GET', 'http://example.com', '/').perform(
-            HTTPConnection('http', 'example.com'))
+        from socket import timeout
+        from kamaki.clients import ClientError
+        conn = HTTPConnection('http', 'example.com')
+
+        def _connect():
+            conn.sock = Mock()
+        connect.side_effect = _connect
+
+        self.RM('GET', 'http://example.com', '/').perform(conn, 5.0, 30.0)
         expected = dict(body=None, headers={}, url='/', method='GET')
         request.assert_called_once_with(**expected)
         getresponse.assert_called_once_with()
+        connect.assert_called_once_with()
+        self.assertEqual(conn.timeout, 5.0)
+        conn.sock.settimeout.assert_called_once_with(30.0)
+
+        #  A connected conn is reused, with the new read timeout
+        self.RM('GET', 'http://example.com', '/').perform(conn, 1.0, None)
+        self.assertEqual(len(connect.mock_calls), 1)
+        self.assertEqual(conn.sock.settimeout.mock_calls[-1], call(None))
+
+        #  Timeouts are left to the retry policy
+        getresponse.side_effect = timeout('timed out')
+        req = self.RM('GET', 'http://example.com', '/')
+        self.assertRaises(timeout, req.perform, conn)
+        self.assertTrue(req.sent)
+        request.side_effect = timeout('timed out')
+        req = self.RM('POST', 'http://example.com', '/')
+        self.assertRaises(timeout, req.perform, conn)
+        self.assertFalse(req.sent)
+
+    @patch('kamaki.clients.utils.escape_ctrl_chars', return_value='data')
+    @patch('kamaki.clients.sendlog')
+    def test_dump_log(self, sendlog, escape_ctrl_chars):
+        rm = self.RM(
+            'PUT', 'http://example.com', '/', data='some data',
+            headers={'X-Auth-Token': 's3cr3t', 'Content-Type': 'text/plain'})
+        rm.LOG_DATA = True
+        sendlog.isEnabledFor.return_value = False
+        rm.dump_log()
+        self.assertEqual(sendlog.info.mock_calls, [])
+        self.assertEqual(escape_ctrl_chars.mock_calls, [])
+
+        sendlog.isEnabledFor.return_value = True
+        rm.dump_log()
+        self.assertEqual(sendlog.info.mock_calls[0], call(
+            '%s %s://%s%s%s', 'PUT', 'http', 'example.com', '/', ''))
+        self.assertTrue(
+            call('  %s: %s%s', 'X-Auth-Token', '...', '') in (
+                sendlog.info.mock_calls))
+        escape_ctrl_chars.assert_called_once_with('some data')
 
 
 class FakeResp(object):
@@ -152,6 +242,74 @@ class FakeResp(object):
     def getheaders(self):
         return self.HEADERS.items()
 
+    def getheader(self, name, default=None):
+        return self.HEADERS.get(name.lower(), default)
+
+
+class FakeStreamResp(FakeResp):
+
+    def __init__(self):
+        self.pos = 0
+
+    def read(self, amt=None):
+        end = len(self.READ) if amt is None else self.pos + amt
+        chunk, self.pos = self.READ[self.pos:end], min(end, len(self.READ))
+        return chunk
+
+    def isclosed(self):
+        return self.pos >= len(self.READ)
+
+
+class RetryPolicy(TestCase):
+
+    def setUp(self):
+        from kamaki.clients import RetryPolicy
+        self.policy = RetryPolicy(retries=2, base_delay=1.0, max_delay=3.0)
+
+    def test_retry_status(self):
+        retry = self.policy.retry_status
+        for method, status, attempt, idempotent, expected in (
+                ('GET', 503, 0, None, True),
+                ('get', 502, 1, None, True),
+                ('GET', 502, 2, None, False),
+                ('GET', 500, 0, None, False),
+                ('GET', 404, 0, None, False),
+                ('POST', 429, 0, None, True),
+                ('POST', 503, 0, None, True),
+                ('POST', 502, 0, None, False),
+                ('POST', 504, 0, True, True),
+                ('PUT', 504, 0, False, False)):
+            self.assertEqual(
+                retry(method, status, attempt, idempotent), expected)
+
+    def test_retry_error(self):
+        from httplib import BadStatusLine
+        from socket import error, gaierror, timeout
+        retry = self.policy.retry_error
+        self.assertTrue(retry('GET', error('reset'), 0))
+        self.assertTrue(retry('GET', timeout('timed out'), 1))
+        self.assertFalse(retry('POST', BadStatusLine(''), 1))
+        self.assertFalse(retry('POST', error('reset'), 0))
+        self.assertTrue(retry('POST', error('reset'), 0, sent=False))
+        self.assertTrue(retry('POST', error('reset'), 0, idempotent=True))
+        self.assertFalse(retry('GET', error('reset'), 2))
+        self.assertFalse(retry('GET', ValueError('bug'), 0))
+        self.assertFalse(retry('GET', gaierror(-2, 'Name unknown'), 0))
+
+    def test_delay(self):
+        from time import time
+        from email.utils import formatdate
+        for attempt, limit in ((0, 1.0), (1, 2.0), (2, 3.0), (5, 3.0)):
+            for i in range(32):
+                self.assertTrue(0 <= self.policy.delay(attempt) <= limit)
+        self.assertEqual(self.policy.delay(0, '2'), 2.0)
+        self.assertEqual(self.policy.delay(0, '120'), 3.0)
+        wait = self.policy.delay(0, formatdate(time() + 2, usegmt=True))
+        self.assertTrue(0 < wait <= 2.0)
+        self.assertEqual(
+            self.policy.delay(0, formatdate(time() - 60, usegmt=True)), 0.0)
+        self.assertTrue(0 <= self.policy.delay(0, 'garbage') <= 1.0)
+
 
 class ResponseManager(TestCase):
 
@@ -179,6 +337,55 @@ class ResponseManager(TestCase):
         self.assertEqual(self.RM.status, FakeResp.reason)
         self.assertTrue(isinstance(perform.call_args[0][0], self.HTTPC))
 
+    @patch('kamaki.clients.RequestManager.perform')
+    def test_response_cache(self, perform):
+        from kamaki.clients import ResponseManager, RequestManager
+        cache_dir = mkdtemp()
+        try:
+            cache = FileCache(cache_dir)
+
+            def get(token='t', **kwargs):
+                rm = ResponseManager(
+                    RequestManager('GET', 'http://ok', '/list', **kwargs),
+                    response_cache=cache)
+                rm._token = token
+                return rm, (rm.status_code, rm.headers, rm.content)
+
+            ok = FakeResp()
+            ok.status, ok.HEADERS = 200, dict(etag='"v1"', k='v')
+            perform.return_value = ok
+            rm, expected = get()
+            self.assertEqual(expected, (200, ok.HEADERS, FakeResp.READ))
+            self.assertFalse('If-None-Match' in rm.request.headers)
+
+            not_modified = FakeResp()
+            not_modified.status, not_modified.READ = 304, ''
+            perform.return_value = not_modified
+            rm, response = get()
+            self.assertEqual(response, expected)
+            self.assertEqual(rm.request.headers['If-None-Match'], '"v1"')
+
+            #  Other tokens, conditional requests and streams are not cached
+            for kwargs in (
+                    dict(token='other'),
+                    dict(headers={'Range': 'bytes=0-1'})):
+                rm, response = get(**kwargs)
+                self.assertEqual(response[0], 304)
+            perform.return_value = ok
+            rm = ResponseManager(
+                RequestManager('GET', 'http://ok', '/list'),
+                response_cache=cache, stream=True)
+            self.assertEqual(rm._cache_key(), None)
+
+            #  Responses without validators are not stored
+            unvalidated = FakeResp()
+            unvalidated.status, unvalidated.HEADERS = 200, dict(k='v')
+            perform.return_value = unvalidated
+            rm, response = get(token='other')
+            self.assertEqual(cache.get(rm._cache_key()), None)
+        finally:
+            rmtree(cache_dir)
+
     @patch('kamaki.clients.RequestManager.perform', return_value=FakeResp())
     def test_status_code(self, perform):
         self.assertEqual(self.RM.status_code, FakeResp.status)
@@ -214,6 +421,208 @@ class ResponseManager(TestCase):
         self.assertEqual(self.RM.headers, FakeResp.HEADERS)
         perform.assert_called_only_once
 
+    @patch('kamaki.clients.RequestManager.perform')
+    def test_iter_content(self, perform):
+        from kamaki.clients import ResponseManager, RequestManager
+        perform.return_value = FakeResp()
+        self.assertEqual(
+            list(self.RM.iter_content(5)),
+            ['somet', 'hing ', 'to re', 'ad'])
+
+        perform.return_value = FakeStreamResp()
+        rm = ResponseManager(
+            RequestManager('GET', 'http://ok', '/'), stream=True)
+        self.assertEqual(rm.status_code, FakeResp.status)
+        self.assertTrue(rm._pooled_connection)
+        with patch('objpool.http.PooledHTTPConnection.release') as release:
+            self.assertEqual(
+                ''.join(rm.iter_content(3)), FakeResp.READ)
+            release.assert_called_once_with()
+        self.assertEqual(rm._pooled_connection, None)
+
+        #  An abandoned stream closes its connection
+        perform.return_value = FakeStreamResp()
+        rm = ResponseManager(
+            RequestManager('GET', 'http://ok', '/'), stream=True)
+        chunks = rm.iter_content(3)
+        self.assertEqual(chunks.next(), 'som')
+        with patch('httplib.HTTPConnection.close') as close:
+            chunks.close()
+            close.assert_called_once_with()
+        self.assertEqual(rm._pooled_connection, None)
+
+        perform.return_value = FakeStreamResp()
+        rm = ResponseManager(
+            RequestManager('GET', 'http://ok', '/'), stream=True)
+        self.assertEqual(rm.content, FakeResp.READ)
+        self.assertEqual(rm._pooled_connection, None)
+
+    @patch('kamaki.clients.sleep')
+    @patch('kamaki.clients.RequestManager.perform')
+    def test_retries(self, perform, sleep):
+        from kamaki.clients import ResponseManager, RequestManager
+        from kamaki.clients import RetryPolicy
+
+        class Busy(FakeResp):
+            status, reason = 503, 'Service Unavailable'
+            HEADERS = {'retry-after': '1'}
+
+        policy = RetryPolicy(retries=2)
+        for method, responses, performed, status in (
+                ('GET', [Busy(), FakeResp()], 2, FakeResp.status),
+                ('GET', [Busy(), Busy(), Busy()], 3, 503),
+                ('POST', [Busy(), FakeResp()], 2, FakeResp.status)):
+            perform.reset_mock()
+            sleep.reset_mock()
+            perform.side_effect = responses
+            rm = ResponseManager(
+                RequestManager(method, 'http://ok', '/'), retry_policy=policy)
+            self.assertEqual(rm.status_code, status)
+            self.assertEqual(len(perform.mock_calls), performed)
+            self.assertEqual(sleep.mock_calls, [call(1.0)] * (performed - 1))
+
+        #  Without a retry policy, only connection errors are retried
+        from httplib import BadStatusLine
+        perform.reset_mock()
+        perform.side_effect = [BadStatusLine(''), Busy()]
+        rm = ResponseManager(
+            RequestManager('GET', 'http://ok', '/'), connection_retry_limit=1)
+        self.assertEqual(rm.status_code, 503)
+        self.assertEqual(len(perform.mock_calls), 2)
+
+        perform.reset_mock()
+        perform.side_effect = [BadStatusLine(''), BadStatusLine('')]
+        rm = ResponseManager(
+            RequestManager('GET', 'http://ok', '/'), connection_retry_limit=1)
+        self.assertRaises(self.client_error, rm._get_response)
+
+        #  Timeouts are retried, and reported as a ClientError at last
+        from socket import timeout
+        perform.reset_mock()
+        perform.side_effect = [timeout('timed out'), FakeResp()]
+        rm = ResponseManager(
+            RequestManager('GET', 'http://ok', '/'), retry_policy=policy)
+        self.assertEqual(rm.status_code, FakeResp.status)
+        perform.reset_mock()
+        perform.side_effect = [timeout('timed out')] * 3
+        rm = ResponseManager(
+            RequestManager('GET', 'http://ok', '/'), retry_policy=policy)
+        self.assertRaises(self.client_error, rm._get_response)
+        self.assertEqual(len(perform.mock_calls), 3)
+
+        #  So are other connection errors, but unknown hosts are not retried
+        from socket import error, gaierror
+        for err, performed in (
+                (error(104, 'reset'), 3), (gaierror(-2, 'Name unknown'), 1)):
+            perform.reset_mock()
+            perform.side_effect = [err] * 3
+            rm = ResponseManager(
+                RequestManager('GET', 'http://ok', '/'), retry_policy=policy)
+            self.assertRaises(self.client_error, rm._get_response)
+            self.assertEqual(len(perform.mock_calls), performed)
+
+        #  A POST is retried only if it failed before it was sent
+        for sent, performed in ((True, 1), (False, 2)):
+            def fail_once(*args):
+                if len(perform.mock_calls) > 1:
+                    return FakeResp()
+                rm.request.sent = sent
+                raise BadStatusLine('')
+            perform.reset_mock()
+            perform.side_effect = fail_once
+            rm = ResponseManager(
+                RequestManager('POST', 'http://ok', '/'), retry_policy=policy)
+            if sent:
+                self.assertRaises(self.client_error, rm._get_response)
+            else:
+                self.assertEqual(rm.status_code, FakeResp.status)
+            self.assertEqual(len(perform.mock_calls), performed)
+
+    @patch('kamaki.clients.sleep')
+    @patch('kamaki.clients.RequestManager.perform')
+    def test_resume(self, perform, sleep):
+        from kamaki.clients import ResponseManager, RequestManager
+        from kamaki.clients import RetryPolicy
+        from socket import error
+
+        class Broken(FakeStreamResp):
+            HEADERS = dict(etag='"e"')
+            status = 200
+
+            def read(self, amt=None):
+                if self.pos:
+                    raise error('reset')
+                return super(Broken, self).read(amt)
+
+        class Rest(FakeStreamResp):
+            status = 206
+            READ = FakeStreamResp.READ[3:]
+
+        perform.side_effect = [Broken(), Rest()]
+        rm = ResponseManager(
+            RequestManager('GET', 'http://ok', '/', headers=dict(
+                Range='bytes=0-99')),
+            stream=True, retry_policy=RetryPolicy(retries=1))
+        self.assertEqual(''.join(rm.iter_content(3)), FakeResp.READ)
+        self.assertEqual(rm.request.headers['Range'], 'bytes=3-99')
+        self.assertEqual(rm.request.headers['If-Match'], '"e"')
+        self.assertEqual((rm.status_code, rm.headers), (200, Broken.HEADERS))
+
+        #  Out of retries, the error is reported as a ClientError
+        perform.side_effect = [Broken(), Broken()]
+        rm = ResponseManager(
+            RequestManager('GET', 'http://ok', '/'),
+            stream=True, retry_policy=RetryPolicy(retries=1))
+        self.assertRaises(self.client_error, ''.join, rm.iter_content(3))
+        self.assertEqual(rm.request.headers['Range'], 'bytes=3-')
+
+    @property
+    def client_error(self):
+        from kamaki.clients import ClientError
+        return ClientError
+
+    @patch('kamaki.clients.RequestManager.perform')
+    def test_stats(self, perform):
+        from kamaki.clients import ResponseManager, RequestManager
+        from kamaki.clients.utils import stats
+
+        class Collector(stats.StatsCollector):
+            collected = []
+
+            def collect(self, s):
+                self.collected.append(s)
+        collector = Collector()
+        stats.add_collector(collector)
+        try:
+            perform.return_value = FakeResp()
+            self.RM.service = 'srv'
+            self.RM.request.data = 'some data'
+            self.assertEqual(self.RM.content, FakeResp.READ)
+            s = collector.collected[-1]
+            self.assertEqual((s.method, s.service), ('GET', 'srv'))
+            self.assertEqual((s.status, s.retries), (FakeResp.status, 0))
+            self.assertEqual((s.sent, s.received), (9, len(FakeResp.READ)))
+            self.assertTrue(0 <= s.acquire_time <= s.first_byte_time)
+            self.assertTrue(s.first_byte_time <= s.latency)
+
+            #  Streamed responses are measured when released
+            perform.return_value = FakeStreamResp()
+            rm = ResponseManager(
+                RequestManager('GET', 'http://ok', '/'), stream=True)
+            rm.status_code
+            self.assertEqual(len(collector.collected), 1)
+            ''.join(rm.iter_content(5))
+            self.assertEqual(len(collector.collected), 2)
+            self.assertEqual(
+                collector.collected[-1].received, len(FakeResp.READ))
+
+            perform.side_effect = IOError('failed')
+            rm = ResponseManager(RequestManager('GET', 'http://ok', '/'))
+            self.assertRaises(IOError, rm._get_response)
+            self.assertEqual(collector.collected[-1].error, 'IOError')
+        finally:
+            stats.remove_collector(collector)
+
 
 class SilentEvent(TestCase):
 
@@ -269,6 +678,67 @@ class SilentEvent(TestCase):
                 self.assertFalse(t.exception)
 
 
+class WorkerPool(TestCase):
+
+    def setUp(self):
+        from kamaki.clients import WorkerPool
+        self.pool = WorkerPool(3)
+
+    def tearDown(self):
+        self.pool.shutdown()
+
+    def test_submit(self):
+        jobs = [self.pool.submit(lambda x: 2 * x, i) for i in range(20)]
+        for i, job in enumerate(jobs):
+            job.join()
+            self.assertFalse(job.isAlive())
+            self.assertFalse(job.exception)
+            self.assertEqual(job.value, 2 * i)
+        self.assertEqual(len(self.pool._workers), 3)
+
+    def test_exception(self):
+        def foo(x):
+            if x % 2:
+                raise ValueError('odd')
+            return x
+        jobs = [self.pool.submit(foo, x=i) for i in range(6)]
+        for i, job in enumerate(jobs):
+            job.join()
+            self.assertEqual(job.kwargs, dict(x=i))
+            if i % 2:
+                self.assertTrue(isinstance(job.exception, ValueError))
+            else:
+                self.assertEqual(job.value, i)
+
+    def test_cancel(self):
+        from threading import Event
+        from kamaki.clients import ClientError as CE
+        block = Event()
+        busy = [self.pool.submit(block.wait, 4) for i in range(3)]
+        pending = self.pool.submit(lambda: 42)
+        pending.cancel()
+        block.set()
+        for job in busy + [pending]:
+            job.join()
+        self.assertTrue(isinstance(pending.exception, CE))
+        self.assertEqual(pending.value, None)
+
+    def test_shutdown(self):
+        self.pool.shutdown(cancel=True)
+        self.assertTrue(self.pool.closed)
+        for worker in self.pool._workers:
+            self.assertFalse(worker.isAlive())
+        self.assertRaises(AssertionError, self.pool.submit, sleep, 0)
+
+    def test_get_worker_pool(self):
+        from kamaki.clients import get_worker_pool
+        pool = get_worker_pool(2)
+        self.assertEqual(pool, get_worker_pool(2))
+        self.assertNotEqual(pool, get_worker_pool(3))
+        pool.shutdown()
+        self.assertNotEqual(pool, get_worker_pool(2))
+
+
 class FR(object):
     json = None
     text = None
@@ -309,49 +779,57 @@ class Client(TestCase):
         DATE_FORMATS = ['%a %b %d %H:%M:%S %Y']
         self.assertEqual(self.client.DATE_FORMATS, DATE_FORMATS)
 
-    def test__init_thread_limit(self):
-        exp = 'Nothing set here'
-        for faulty in (-1, 0.5, 'a string', {}):
-            self.assertRaises(
-                AssertionError,
-                self.client._init_thread_limit,
-                faulty)
-            self.assertEqual(exp, getattr(self.client, '_thread_limit', exp))
-            self.assertEqual(exp, getattr(self.client, '_elapsed_old', exp))
-            self.assertEqual(exp, getattr(self.client, '_elapsed_new', exp))
-        self.client._init_thread_limit(42)
-        self.assertEqual(42, self.client._thread_limit)
-        self.assertEqual(0.0, self.client._elapsed_old)
-        self.assertEqual(0.0, self.client._elapsed_new)
-
-    def test__watch_thread_limit(self):
-        waits = (
-            dict(args=((0.1, 1), (0.1, 2), (0.2, 1), (0.7, 1), (0.3, 2))),
-            dict(args=((1.0 - (i / 10.0), (i + 1)) for i in range(7))),
-            dict(max=1, args=tuple([(randint(1, 10) / 3.0, 1), ] * 10)),
-            dict(
-                limit=5,
-                args=tuple([
-                    (1.0 + (i / 10.0), (5 - i - 1)) for i in range(4)] + [
-                    (2.0, 1), (1.9, 2), (2.0, 1), (2.0, 2)])),
-            dict(args=tuple(
-                [(1.0 - (i / 10.0), (i + 1)) for i in range(7)] + [
-                (0.1, 7), (0.2, 6), (0.4, 5), (0.3, 6), (0.2, 7), (0.1, 7)])),)
-        for wait_dict in waits:
-            if 'max' in wait_dict:
-                self.client.MAX_THREADS = wait_dict['max']
-            else:
-                self.client.MAX_THREADS = 7
-            if 'limit' in wait_dict:
-                self.client._init_thread_limit(wait_dict['limit'])
-            else:
-                self.client._init_thread_limit()
-                self.client._watch_thread_limit(list())
-                self.assertEqual(1, self.client._thread_limit)
-            for wait, exp_limit in wait_dict['args']:
-                self.client._elapsed_new = wait
-                self.client._watch_thread_limit(list())
-                self.assertEqual(exp_limit, self.client._thread_limit)
+    def test_concurrency_limiter(self):
+        from kamaki.clients import Client
+        limiter = self.client.concurrency_limiter
+        self.assertEqual(limiter.max_limit, self.client.MAX_THREADS)
+        self.assertTrue(
+            limiter is Client(self.endpoint_url, 't').concurrency_limiter)
+        self.assertFalse(
+            limiter is Client('http://other.com', 't').concurrency_limiter)
+        other = Client(self.endpoint_url, 't')
+        other.MAX_THREADS = self.client.MAX_THREADS + 4
+        self.assertTrue(limiter is other.concurrency_limiter)
+        self.assertEqual(limiter.max_limit, other.MAX_THREADS)
+
+    def test__limited_call(self):
+        self.client.MAX_THREADS = 3
+        limiter = self.client.concurrency_limiter
+        release = patch.object(limiter, 'release', wraps=limiter.release)
+        with release as release:
+            self.assertEqual(
+                self.client._limited_call(42, lambda x: x * 2, 21), 42)
+            self.assertEqual(release.mock_calls[-1][1][1:], (42, ))
+            from socket import timeout
+            timeout_error = self.CE('timed out')
+            timeout_error.errobject = timeout('timed out')
+            for err, overload in (
+                    (self.CE('busy', 503), True),
+                    (self.CE('missing', 404), False),
+                    (timeout_error, True),
+                    (ValueError('bug'), False)):
+                def fail():
+                    raise err
+                self.assertRaises(
+                    type(err), self.client._limited_call, 42, fail)
+                self.assertEqual(release.mock_calls[-1][2], dict(
+                    error=overload, measure=overload) if (
+                        isinstance(err, self.CE)) else dict(measure=False))
+        self.assertEqual(limiter.in_flight, 0)
+
+    def test_async_run(self):
+        self.client.MAX_THREADS = 4
+        self.assertEqual(self.client.worker_pool.size, 4)
+        r = self.client.async_run(
+            lambda x, y: x * y, [dict(x=i, y=i + 1) for i in range(10)])
+        self.assertEqual(r, [i * (i + 1) for i in range(10)])
+
+        def foo(x):
+            if x == 3:
+                raise self.CE('Failed %s' % x, 42)
+            return x
+        self.assertRaises(
+            self.CE, self.client.async_run, foo, [dict(x=i) for i in range(6)])
 
     @patch('kamaki.clients.Client.set_header')
     def test_set_header(self, SH):
@@ -376,7 +854,8 @@ class Client(TestCase):
     @patch('kamaki.clients.RequestManager', return_value=FR)
     @patch('kamaki.clients.ResponseManager', return_value=FakeResp())
     @patch('kamaki.clients.ResponseManager.__init__')
-    def test_request(self, Requ, RespInit, Resp):
+    @patch('kamaki.clients.Client._single_flight', side_effect=lambda r: r)
+    def test_request(self, single_flight, Requ, RespInit, Resp):
         for args in product(
                 ('get', '', dict(method='get')),
                 ('/some/path', None, ['some', 'path']),
@@ -398,7 +877,20 @@ class Client(TestCase):
             self.client.request(method, path, **kwargs)
             self.assertEqual(
                 RespInit.mock_calls[-1],
-                call(FR, connection_retry_limit=0, poolsize=None))
+                call(
+                    FR, connection_retry_limit=0, poolsize=None,
+                    stream=False, connection_timeout=10.0,
+                    read_timeout=60.0, retry_policy=self.client.RETRY_POLICY,
+                    idempotent=None, response_cache=None))
+        #  GETs are shared only on demand
+        self.assertEqual(single_flight.mock_calls, [])
+        FakeResp.status_code = 200
+        self.client.request('get', '/path', shared=True)
+        self.assertEqual(
+            single_flight.mock_calls, [call(RespInit.return_value)])
+        self.client.request('get', '/path', stream=True, shared=True)
+        self.client.request('post', '/path', shared=True)
+        self.assertEqual(len(single_flight.mock_calls), 1)
 
     @patch('kamaki.clients.Client.request', return_value='lala')
     def _test_foo(self, foo, request):
@@ -429,6 +921,168 @@ class Client(TestCase):
         self._test_foo('move')
 
 
+class AsyncClient(TestCase):
+    """Runs against a local HTTP stand-in server"""
+
+    def setUp(self):
+        from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+        from SocketServer import ThreadingMixIn
+        from threading import Thread, Event
+        from kamaki.clients import AsyncClient
+
+        hits, self.hits, self.gate = dict(), dict(), Event()
+        gate, self.ports = self.gate, set()
+        ports = self.ports
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                key = (self.path, self.headers.get('X-Auth-Token'))
+                hits[key] = hits.get(key, 0) + 1
+                ports.add(self.client_address[1])
+                if 'slow' in self.path:
+                    gate.wait()
+                if self.path.startswith('/missing'):
+                    self.send_response(404)
+                    body = 'not found'
+                elif self.path.startswith('/busy') and hits[key] == 1:
+                    self.send_response(503)
+                    self.send_header('Retry-After', '0')
+                    body = 'busy'
+                else:
+                    self.send_response(200)
+                    body = '%s %s %s' % (
+                        self.path,
+                        self.headers.get('X-Main', ''),
+                        self.headers.get('X-Job', ''))
+                self.send_header('Content-Length', '%s' % len(body))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                self.send_response(202)
+                self.send_header('Content-Length', '%s' % len(body))
+                self.end_headers()
+                self.wfile.write(body[::-1])
+
+            def log_message(self, *args):
+                pass
+
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        #  Keep-alive, so that pooled connections are reused
+        Handler.protocol_version = 'HTTP/1.1'
+        self.server = Server(('127.0.0.1', 0), Handler)
+        server_thread = Thread(target=self.server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        self.client = AsyncClient(
+            'http://127.0.0.1:%s' % self.server.server_port, 't0k3n')
+        self.client.MAX_THREADS = 4
+        self.hits = hits
+
+    def tearDown(self):
+        self.gate.set()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_request_async(self):
+        paths = ['/obj%s' % i for i in range(16)]
+        jobs = [self.client.get_async(
+            path, async_headers={'X-Job': path}) for path in paths]
+        for path, job in zip(paths, jobs):
+            self.assertEqual(job.result().text, '%s  %s' % (path, path))
+
+        self.assertRaises(
+            self.client_error, self.client.get_async('/missing').result)
+        #  Over keep-alive connections, as many as the concurrency limit
+        self.assertTrue(len(self.ports) <= self.client.MAX_THREADS)
+
+    def test_perform_async(self):
+        from kamaki.clients import RetryPolicy
+        self.client.RETRY_POLICY = RetryPolicy(retries=1, base_delay=0.0)
+        data = 'd4t4' * 100000
+        jobs = [
+            self.client.post_async('/post', data=data, success=202),
+            self.client.get_async('/busy'),
+            self.client.perform_async(
+                self.client.get('/then', success=None),
+                then=lambda r: r.text.upper())]
+        self.assertEqual(jobs[0].result().content, data[::-1])
+        self.assertEqual(jobs[1].result().status_code, 200)
+        self.assertEqual(self.hits[('/busy', 't0k3n')], 2)
+        self.assertEqual(jobs[2].result(), '/THEN  ')
+        self.assertRaises(
+            AssertionError, self.client.perform_async,
+            self.client.get('/stream', success=None, stream=True))
+
+    def test_spawn(self):
+        from kamaki.clients.utils.eventloop import Return
+
+        def chain(path):
+            r = yield self.client.get_async(path)
+            r = yield self.client.get_async(r.text.split()[0] + '/next')
+            raise Return(r.text)
+        tasks = [self.client.spawn(chain('/c%s' % i)) for i in range(3)]
+        self.assertEqual(
+            [task.result() for task in tasks],
+            ['/c%s/next  ' % i for i in range(3)])
+
+    def test_single_flight(self):
+        from threading import Thread
+        from kamaki.clients import AsyncClient, _single_flight
+        other = AsyncClient(self.client.endpoint_url, 'other')
+        calls = [(self.client, '/slow')] * 6 + [
+            (other, '/slow'), (self.client, '/slow/other'),
+            (self.client, '/missing/slow')] * 2
+        results = [None] * len(calls)
+
+        def get(i, client, path):
+            try:
+                results[i] = client.get(path, shared=True).text
+            except self.client_error as ce:
+                results[i] = ce.status
+        threads = [Thread(target=get, args=(i, client, path)) for (
+            i, (client, path)) in enumerate(calls)]
+        for t in threads:
+            t.start()
+        while sum(self.hits.values()) < 4 or sum(
+                _single_flight.waiters(k) for k in list(
+                    _single_flight._flights)) < len(calls) - 4:
+            sleep(0.01)
+        self.gate.set()
+        for t in threads:
+            t.join()
+        self.assertEqual(results, ['/slow  '] * 7 + [
+            '/slow/other  ', 404, '/slow  ', '/slow/other  ', 404])
+        self.assertEqual(self.hits, {
+            ('/slow', 't0k3n'): 1,
+            ('/slow', 'other'): 1,
+            ('/slow/other', 't0k3n'): 1,
+            ('/missing/slow', 't0k3n'): 1})
+
+        #  Finished requests are repeated
+        self.assertEqual(
+            self.client.get('/slow', shared=True).text, '/slow  ')
+        self.assertEqual(self.hits[('/slow', 't0k3n')], 2)
+
+    def test_headers_per_thread(self):
+        self.client.set_header('X-Main', 'main')
+        job = self.client.call_async(
+            self.client.get, '/a', async_headers={'X-Job': 'job'})
+        self.assertEqual(job.result().text, '/a  job')
+        #  Async requests are built in the calling thread
+        job = self.client.get_async('/b', async_headers={'X-Job': 'job'})
+        self.assertEqual(job.result().text, '/b main job')
+        self.assertEqual(self.client.headers, {})
+
+    @property
+    def client_error(self):
+        from kamaki.clients import ClientError
+        return ClientError
+
+
 #  TestCase auxiliary methods
 
 def runTestCase(cls, test_name, args=[], failure_collector=[]):
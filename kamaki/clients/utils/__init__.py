@@ -32,6 +32,9 @@
 # or implied, of GRNET S.A.
 
 import unicodedata
+from os import fstat
+from stat import S_ISREG
+from mmap import mmap, ACCESS_READ
 
 
 def _matches(val1, val2, exactMath=True):
@@ -109,6 +112,67 @@ def readall(openfile, size, retries=7):
     raise IOError('Failed to read %s bytes from file' % size)
 
 
+class BlockSource(object):
+    """Read blocks of an open file, without copying them when possible
+
+    Regular files are memory-mapped (read-only) and blocks are buffers over
+    the map, so they can be hashed and sent without intermediate strings.
+    Pipes and special files fall back to plain reads (readall).
+
+    :param fileobj: open file descriptor (rb)
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj, self._map = fileobj, None
+        try:
+            st = fstat(fileobj.fileno())
+            if S_ISREG(st.st_mode) and st.st_size:
+                self._map = mmap(fileobj.fileno(), 0, access=ACCESS_READ)
+        except (AttributeError, EnvironmentError, ValueError):
+            self._map = None
+
+    @property
+    def mapped(self):
+        """True if blocks are buffers over a memory map"""
+        return self._map is not None
+
+    def block(self, offset, size):
+        """:returns: (buffer or str) up to size bytes, starting at offset"""
+        if self._map is None:
+            self.fileobj.seek(offset)
+            return readall(self.fileobj, size)
+        size = max(0, min(size, len(self._map) - offset))
+        return buffer(self._map, offset, size)
+
+    def blocks(self, blocksize, size):
+        """Read size bytes from the current file position, in blocksize
+        chunks. Pipes are consumed as they are read, so they are not seeked
+
+        :returns: (generator) of buffers or str
+        """
+        if self._map is None:
+            read = 0
+            while read < size:
+                block = readall(self.fileobj, min(blocksize, size - read))
+                if not block:
+                    break
+                read += len(block)
+                yield block
+            return
+        start = self.fileobj.tell()
+        for offset in xrange(start, start + size, blocksize):
+            block = self.block(offset, min(blocksize, start + size - offset))
+            if not block:
+                break
+            yield block
+
+    def close(self):
+        """Release the map. It is unmapped when the last block is released,
+        so blocks that are still in use (e.g., by upload threads) are safe
+        """
+        self._map = None
+
+
 def escape_ctrl_chars(s):
     """Escape control characters from unicode and string objects."""
     if isinstance(s, unicode):
@@ -0,0 +1,165 @@
+# Copyright 2014 GRNET S.A. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following
+# conditions are met:
+#
+#   1. Redistributions of source code must retain the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer.
+#
+#   2. Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials
+#      provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY GRNET S.A. ``AS IS'' AND ANY EXPRESS
+# OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL GRNET S.A OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF
+# USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED
+# AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and
+# documentation are those of the authors and should not be
+# interpreted as representing official policies, either expressed
+# or implied, of GRNET S.A.
+
+import os
+from hashlib import sha1
+from threading import Lock
+from tempfile import mkstemp
+from logging import getLogger
+
+
+log = getLogger(__name__)
+
+
+class FileCache(object):
+    """A size-bounded, least-recently-used cache of strings, stored as files
+    under a local directory. It is safe to share among threads and, since
+    entries are written atomically, among processes.
+
+    :param path: (str) the cache directory, created if missing
+
+    :param limit: (int) the maximum total size of cached values in bytes.
+        When it is exceeded, the least recently used entries are evicted
+        until the size drops to LOW_WATER times the limit, so that the cache
+        directory is not scanned again on every following set
+    """
+
+    LOW_WATER = 0.8
+
+    def __init__(self, path, limit=64 * 1024 * 1024):
+        self.path = os.path.abspath(os.path.expanduser(path))
+        self.limit = int(limit)
+        self._lock = Lock()
+        self._size = None
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path, 0700)
+
+    def _path(self, key):
+        return os.path.join(self.path, sha1(key).hexdigest())
+
+    def _entries(self):
+        """:returns: (list) (mtime, size, path) for every entry, mtime being the
+            time of last access"""
+        entries = []
+        for name in os.listdir(self.path):
+            if name.startswith('.'):
+                continue
+            path = os.path.join(self.path, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    @property
+    def size(self):
+        """The total size of cached values in bytes"""
+        with self._lock:
+            if self._size is None:
+                self._size = sum(s for t, s, p in self._entries())
+            return self._size
+
+    def get(self, key, default=None):
+        """:returns: (str) the value cached under key, or default"""
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = f.read()
+            os.utime(path, None)
+        except (IOError, OSError):
+            return default
+        return value
+
+    def set(self, key, value):
+        """Cache value (str) under key, evicting older entries if needed"""
+        if len(value) > self.limit:
+            return
+        path, size = self._path(key), self.size
+        fd, tmp = mkstemp(prefix='.', dir=self.path)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(value)
+            old = os.path.getsize(path) if os.path.isfile(path) else 0
+            os.rename(tmp, path)
+        except (IOError, OSError) as e:
+            log.debug('Failed to cache %s: %s' % (key, e))
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return
+        with self._lock:
+            if self._size is None:
+                self._size = size
+            self._size += len(value) - old
+        if self._size > self.limit:
+            self._evict()
+
+    def delete(self, key):
+        """Remove key from cache, if it is there"""
+        path = self._path(key)
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except OSError:
+            return
+        with self._lock:
+            if self._size is not None:
+                self._size -= size
+
+    def clear(self):
+        """Remove all entries"""
+        with self._lock:
+            for t, s, path in self._entries():
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            self._size = 0
+
+    def _evict(self):
+        """Remove the least recently used entries, down to the low water mark
+        """
+        with self._lock:
+            entries = sorted(self._entries())
+            self._size = sum(s for t, s, p in entries)
+            if self._size <= self.limit:
+                return
+            low_water = self.limit * self.LOW_WATER
+            for mtime, size, path in entries:
+                if self._size <= low_water:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                self._size -= size
@@ -0,0 +1,964 @@
+# Copyright 2014 GRNET S.A. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following
+# conditions are met:
+#
+#   1. Redistributions of source code must retain the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer.
+#
+#   2. Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials
+#      provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY GRNET S.A. ``AS IS'' AND ANY EXPRESS
+# OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL GRNET S.A OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF
+# USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED
+# AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and
+# documentation are those of the authors and should not be
+# interpreted as representing official policies, either expressed
+# or implied, of GRNET S.A.
+import errno
+import os
+import select
+import socket
+import ssl
+from collections import deque
+from heapq import heappush, heappop, heapify
+from httplib import BadStatusLine, HTTPException, IncompleteRead
+from itertools import count
+from logging import getLogger
+from sys import exc_info
+from thread import get_ident
+from threading import Event, Lock, Thread
+from time import time
+from urlparse import urlsplit
+
+from objpool import http as objpool_http
+
+from kamaki.clients.utils import https
+
+
+log = getLogger(__name__)
+
+#  What a non-blocking socket operation waits for, if it can't go on
+READ, WRITE = object(), object()
+_BLOCKING_ERRNOS = (
+    errno.EAGAIN, errno.EWOULDBLOCK, errno.EINPROGRESS, errno.EALREADY,
+    errno.EINTR)
+
+
+class CancelledError(Exception):
+    """The Future was canceled"""
+
+
+class TimeoutError(Exception):
+    """The Future is not done in time"""
+
+
+class Return(StopIteration):
+    """Raise Return(value) to return a value from a coroutine, since
+    Python 2 generators can not return values"""
+
+    def __init__(self, value=None):
+        StopIteration.__init__(self, value)
+        self.value = value
+
+
+class Future(object):
+    """The outcome of an operation in progress. It can be handled like a
+    WorkerJob (value, exception, isAlive, join, result, cancel).
+    Callbacks run in the thread which completes the Future, or at once, if
+    it is done already
+    """
+
+    JOIN_STEP = 0.01  # seconds
+
+    def __init__(self):
+        self._done, self._lock = Event(), Lock()
+        self._value, self._exc_info, self._callbacks = None, None, []
+
+    @property
+    def value(self):
+        return self._value
+
+    @property
+    def exception(self):
+        return self._exc_info[1] if self._exc_info else False
+
+    def done(self):
+        return self._done.is_set()
+
+    def isAlive(self):
+        return not self._done.is_set()
+
+    is_alive = isAlive
+
+    def cancelled(self):
+        return isinstance(self.exception, CancelledError)
+
+    def _complete(self, value, exc_info):
+        with self._lock:
+            if self._done.is_set():
+                return False
+            self._value, self._exc_info = value, exc_info
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            self._run_callback(callback)
+        return True
+
+    def _run_callback(self, callback):
+        try:
+            callback(self)
+        except Exception:
+            log.exception('Callback %s of %s failed', callback, self)
+
+    def set_result(self, value):
+        """:returns: (bool) False if the Future was done already"""
+        return self._complete(value, None)
+
+    def set_exception(self, error, traceback=None):
+        """:returns: (bool) False if the Future was done already"""
+        return self._complete(None, (type(error), error, traceback))
+
+    def cancel(self):
+        """Fail with CancelledError, if not done yet
+
+        :returns: (bool) False if the Future was done already
+        """
+        return self.set_exception(CancelledError('%s is canceled' % self))
+
+    def add_done_callback(self, callback):
+        """:param callback: (callable) future --> anything"""
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        self._run_callback(callback)
+
+    def join(self, timeout=None):
+        """Wait in short steps, so that KeyboardInterrupt is not blocked.
+        Longer Event waits poll with sleeps of up to 50ms in Python 2
+        """
+        deadline = None if timeout is None else time() + timeout
+        while not self._done.is_set():
+            step = self.JOIN_STEP
+            if deadline is not None:
+                step = min(step, deadline - time())
+                if step <= 0:
+                    return
+            self._done.wait(step)
+
+    def result(self, timeout=None):
+        """Wait for the Future to be done. Don't call it on the event loop
+
+        :returns: the value of the Future
+
+        :raises: the exception of the Future, if any, or TimeoutError
+        """
+        self.join(timeout)
+        if self.isAlive():
+            raise TimeoutError('%s is not done' % self)
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._value
+
+
+class Task(Future):
+    """Run a coroutine (a generator) on an event loop. The coroutine yields
+    Futures to wait for them: a yield returns the result of the Future, or
+    raises its exception. The value of the coroutine, given with
+    raise Return(value), is the result of the Task. Canceling the Task
+    closes the coroutine, and cancels the Future it waits for
+    """
+
+    def __init__(self, loop, coro):
+        super(Task, self).__init__()
+        self._loop, self._coro, self._waiting = loop, coro, None
+        loop.call_soon_threadsafe(self._step)
+
+    def _step(self, future=None):
+        if self.done():
+            return
+        self._waiting = None
+        try:
+            if future is None:
+                yielded = self._coro.send(None)
+            elif future._exc_info:
+                yielded = self._coro.throw(*future._exc_info)
+            else:
+                yielded = self._coro.send(future._value)
+        except Return as ret:
+            self.set_result(ret.value)
+        except StopIteration:
+            self.set_result(None)
+        except Exception as e:
+            self.set_exception(e, exc_info()[2])
+        else:
+            if not isinstance(yielded, Future):
+                error = TypeError('Coroutine yielded %r, not a Future' % (
+                    yielded, ))
+                yielded = Future()
+                yielded.set_exception(error)
+            self._waiting = yielded
+            yielded.add_done_callback(self._wakeup)
+
+    def _wakeup(self, future):
+        self._loop.call_soon_threadsafe(self._step, future)
+
+    def cancel(self):
+        if not super(Task, self).cancel():
+            return False
+        #  On the loop, close at once, so that the Futures the coroutine waits
+        #  for are canceled before it cleans up (e.g., closes a socket)
+        if self._loop.in_loop_thread():
+            self._close()
+        else:
+            self._loop.call_soon_threadsafe(self._close)
+        return True
+
+    def _close(self):
+        waiting, self._waiting = self._waiting, None
+        if waiting is not None:
+            waiting.cancel()
+        try:
+            self._coro.close()
+        except Exception:
+            log.exception('Failed to close the coroutine of %s', self)
+
+
+class _Timer(object):
+
+    def __init__(self, loop, callback, args):
+        self.loop, self.callback, self.args = loop, callback, args
+        self.canceled = False
+
+    def cancel(self):
+        with self.loop._timers_lock:
+            if not self.canceled:
+                self.canceled = True
+                self.loop._canceled_timers += 1
+
+
+def _socketpair():
+    try:
+        return socket.socketpair()
+    except (AttributeError, socket.error):
+        #  e.g., on Windows
+        listener = socket.socket()
+        try:
+            listener.bind(('127.0.0.1', 0))
+            listener.listen(1)
+            writer = socket.create_connection(listener.getsockname())
+            reader = listener.accept()[0]
+            return reader, writer
+        finally:
+            listener.close()
+
+
+class EventLoop(object):
+    """A select (or poll) loop, run by a daemon thread. Callbacks, timers and
+    socket handlers run in this thread, one at a time, so they must not
+    block. Other threads hand work over with call_soon_threadsafe,
+    call_later or spawn. Sockets are watched with add_reader and add_writer,
+    or with wait_io in coroutines
+    """
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self._ready, self._timers, self._seq = deque(), [], count()
+        self._timers_lock, self._canceled_timers = Lock(), 0
+        self._handlers = dict()
+        self._poller = select.poll() if hasattr(select, 'poll') else None
+        self._pools = dict()
+        self._wakeup_r, self._wakeup_w = _socketpair()
+        self._wakeup_r.setblocking(0)
+        self._wakeup_w.setblocking(0)
+        self.add_reader(self._wakeup_r.fileno(), self._drain_wakeup)
+        self._thread_id = None
+        self._started = Event()
+        thread = Thread(target=self.run_forever, name='kamaki-event-loop')
+        thread.daemon = True
+        thread.start()
+        self._started.wait()
+
+    def in_loop_thread(self):
+        return get_ident() == self._thread_id
+
+    def _wakeup(self):
+        if not self.in_loop_thread():
+            try:
+                self._wakeup_w.send('x')
+            except socket.error:
+                #  The loop is woken up already
+                pass
+
+    def _drain_wakeup(self):
+        try:
+            while self._wakeup_r.recv(4096):
+                pass
+        except socket.error:
+            pass
+
+    def call_soon(self, callback, *args):
+        """Run callback(*args) on the next iteration. Call it on the loop"""
+        self._ready.append((callback, args))
+
+    def call_soon_threadsafe(self, callback, *args):
+        """Run callback(*args) on the loop, as soon as possible"""
+        self._ready.append((callback, args))
+        self._wakeup()
+
+    def call_later(self, delay, callback, *args):
+        """Run callback(*args) on the loop, after delay seconds
+
+        :returns: (object) a timer, with a cancel method
+        """
+        timer = _Timer(self, callback, args)
+        with self._timers_lock:
+            #  Drop canceled timers, if they are most of them
+            if self._canceled_timers > 256 and (
+                    2 * self._canceled_timers > len(self._timers)):
+                self._timers = [t for t in self._timers if not t[2].canceled]
+                heapify(self._timers)
+                self._canceled_timers = 0
+            heappush(self._timers, (time() + delay, next(self._seq), timer))
+        self._wakeup()
+        return timer
+
+    def sleep(self, delay):
+        """:returns: (Future) done after delay seconds"""
+        future = Future()
+        self.call_later(delay, future.set_result, None)
+        return future
+
+    def spawn(self, coro):
+        """Run a coroutine on the loop (see Task)
+
+        :returns: (Task)
+        """
+        return Task(self, coro)
+
+    def _update(self, fd):
+        handlers = self._handlers.get(fd)
+        if handlers and not (handlers[0] or handlers[1]):
+            del self._handlers[fd]
+            handlers = None
+        if self._poller is None:
+            return
+        if handlers:
+            self._poller.register(fd, (select.POLLIN if handlers[0] else 0) | (
+                select.POLLOUT if handlers[1] else 0))
+        else:
+            try:
+                self._poller.unregister(fd)
+            except (KeyError, ValueError):
+                pass
+
+    def _set_handler(self, fd, i, handler):
+        if handler or fd in self._handlers:
+            self._handlers.setdefault(fd, [None, None])[i] = handler
+            self._update(fd)
+
+    def _remove_handler(self, fd, i, handler):
+        """Remove the handler, unless the fd is reused with another one"""
+        handlers = self._handlers.get(fd)
+        if handlers and handlers[i] is handler:
+            self._set_handler(fd, i, None)
+
+    def add_reader(self, fd, callback, *args):
+        """Run callback(*args) whenever fd is readable. Call it on the loop
+
+        :returns: (tuple) the handler
+        """
+        handler = (callback, args)
+        self._set_handler(fd, 0, handler)
+        return handler
+
+    def remove_reader(self, fd):
+        self._set_handler(fd, 0, None)
+
+    def add_writer(self, fd, callback, *args):
+        """Run callback(*args) whenever fd is writable. Call it on the loop
+
+        :returns: (tuple) the handler
+        """
+        handler = (callback, args)
+        self._set_handler(fd, 1, handler)
+        return handler
+
+    def remove_writer(self, fd):
+        self._set_handler(fd, 1, None)
+
+    def wait_io(self, sock, write=False, timeout=None):
+        """Call it on the loop
+
+        :param write: (bool) wait for sock to be writable, not readable
+
+        :param timeout: (float) seconds, None for no limit
+
+        :returns: (Future) done when sock is ready, or failed with
+            socket.timeout
+        """
+        future, fd = Future(), sock.fileno()
+
+        def ready():
+            future.set_result(None)
+
+        def expire():
+            future.set_exception(socket.timeout('timed out'))
+
+        def cleanup(future):
+            self._remove_handler(fd, int(write), handler)
+            if timer:
+                timer.cancel()
+
+        timer = None if timeout is None else self.call_later(timeout, expire)
+        handler = (self.add_writer if write else self.add_reader)(fd, ready)
+        future.add_done_callback(cleanup)
+        return future
+
+    def _poll(self, timeout):
+        """:returns: (list) of (fd, readable, writable)"""
+        try:
+            if self._poller is not None:
+                error = select.POLLERR | select.POLLHUP | select.POLLNVAL
+                return [(fd, bool(mask & (select.POLLIN | error)), bool(
+                    mask & (select.POLLOUT | error))) for fd, mask in (
+                        self._poller.poll(
+                            None if timeout is None else timeout * 1000))]
+            readers = [fd for fd, h in self._handlers.items() if h[0]]
+            writers = [fd for fd, h in self._handlers.items() if h[1]]
+            r, w, x = select.select(readers, writers, writers, timeout)
+            w = set(w + x)
+            return [(fd, fd in r, fd in w) for fd in set(r).union(w)]
+        except (select.error, IOError, OSError) as e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+
+    def _run(self, handler):
+        callback, args = handler
+        try:
+            callback(*args)
+        except Exception:
+            log.exception('Callback %s of the event loop failed', callback)
+
+    def _run_once(self):
+        timeout = None
+        if self._ready:
+            timeout = 0
+        elif self._timers:
+            timeout = max(0.0, self._timers[0][0] - time())
+        for fd, readable, writable in self._poll(timeout):
+            handlers = self._handlers.get(fd)
+            if handlers is None:
+                if self._poller is not None:
+                    self._update(fd)
+                continue
+            if readable and handlers[0]:
+                self._run(handlers[0])
+            if writable and handlers[1]:
+                self._run(handlers[1])
+        now = time()
+        with self._timers_lock:
+            while self._timers and self._timers[0][0] <= now:
+                timer = heappop(self._timers)[2]
+                if timer.canceled:
+                    self._canceled_timers -= 1
+                else:
+                    self._ready.append((timer.callback, timer.args))
+        for i in xrange(len(self._ready)):
+            self._run(self._ready.popleft())
+
+    def run_forever(self):
+        self._thread_id = get_ident()
+        self._started.set()
+        while True:
+            try:
+                self._run_once()
+            except Exception:
+                log.exception('Event loop iteration failed')
+
+    def host_pool(self, scheme, netloc, size=None):
+        """Call it on the loop
+
+        :param size: (int) the maximum number of connections, by default the
+            size of the objpool connection pools
+
+        :returns: (HostPool) the connections to netloc
+        """
+        pool = self._pools.get((scheme, netloc))
+        if pool is None:
+            pool = self._pools[(scheme, netloc)] = HostPool(
+                self, scheme, netloc)
+        pool.resize(size or objpool_http.default_pool_size)
+        return pool
+
+    def fetch(
+            self, request,
+            connection_timeout=None, read_timeout=None, poolsize=None,
+            stats=None):
+        """Perform a request on a pooled connection
+
+        :param request: (RequestManager) with encoded headers. Its sent flag
+            is set when the whole request is sent
+
+        :param connection_timeout: (float) seconds to wait for a connection
+
+        :param read_timeout: (float) seconds to wait on each send or receive
+
+        :param poolsize: (int) the maximum connections to the host
+
+        :param stats: (RequestStats) if given, it is notified when a
+            connection is acquired and when the response starts
+
+        :returns: (Task) its result is the HTTPResponse
+        """
+        return self.spawn(self._fetch(
+            request, connection_timeout, read_timeout, poolsize, stats))
+
+    def _fetch(
+            self, request,
+            connection_timeout, read_timeout, poolsize, stats):
+        pool = self.host_pool(request.scheme, request.netloc, poolsize)
+        conn = yield pool.acquire()
+        try:
+            if stats:
+                stats.acquired()
+            if conn.sock is None:
+                yield self.spawn(conn.connect(connection_timeout))
+            response = yield self.spawn(conn.request(
+                request, read_timeout, stats))
+        finally:
+            pool.release(conn)
+        raise Return(response)
+
+
+class HostPool(object):
+    """Keep-alive connections to a host, up to size at a time. An idle
+    connection is closed as soon as it is readable, i.e., when the server
+    closes it. Call its methods on the loop
+    """
+
+    def __init__(self, loop, scheme, netloc, size=1):
+        self.loop, self.scheme, self.netloc = loop, scheme, netloc
+        self.size, self.busy, self.idle = size, 0, []
+        self._waiters = deque()
+
+    def resize(self, size):
+        if size != self.size:
+            self.size = size
+            self._dispatch()
+
+    def acquire(self):
+        """:returns: (Future) an HTTPConnection, when there is a free one"""
+        future = Future()
+        self._waiters.append(future)
+        self._dispatch()
+        return future
+
+    def release(self, conn):
+        """Keep conn if it can be reused, close it otherwise"""
+        self.busy -= 1
+        if conn.reusable and conn.sock is not None:
+            self.idle.append(conn)
+            self.loop.add_reader(conn.sock.fileno(), self._drop, conn)
+        else:
+            conn.close()
+        self._dispatch()
+
+    def _drop(self, conn):
+        self.idle.remove(conn)
+        conn.close()
+
+    def _dispatch(self):
+        while self._waiters and (self.idle or self.busy < self.size):
+            future = self._waiters.popleft()
+            if future.done():
+                continue
+            if self.idle:
+                conn = self.idle.pop()
+                self.loop.remove_reader(conn.sock.fileno())
+            else:
+                conn = HTTPConnection(self.loop, self.scheme, self.netloc)
+            self.busy += 1
+            if not future.set_result(conn):
+                self.release(conn)
+
+
+_addresses, _addresses_lock = dict(), Lock()
+ADDRESS_TTL = 300.0  # seconds
+
+
+def _host_port(scheme, netloc):
+    parsed = urlsplit('//%s' % netloc)
+    return parsed.hostname, parsed.port or (443 if scheme == 'https' else 80)
+
+
+def resolve(scheme, netloc):
+    """Look up the addresses of a host. They are cached for ADDRESS_TTL
+    seconds, so that the event loop does not block on lookups: resolve in
+    advance in another thread, to fill the cache
+
+    :returns: (list) as returned by socket.getaddrinfo
+    """
+    host, port = _host_port(scheme, netloc)
+    with _addresses_lock:
+        expires, addresses = _addresses.get((host, port), (0, None))
+    if expires > time():
+        return addresses
+    addresses = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+    with _addresses_lock:
+        _addresses[(host, port)] = (time() + ADDRESS_TTL, addresses)
+    return addresses
+
+
+def _try_io(want, method, *args):
+    """:returns: the result of a non-blocking socket method, or READ (WRITE)
+        if the socket must be readable (writable) first
+    """
+    try:
+        return method(*args)
+    except ssl.SSLError as e:
+        if e.args[0] == ssl.SSL_ERROR_WANT_READ:
+            return READ
+        if e.args[0] == ssl.SSL_ERROR_WANT_WRITE:
+            return WRITE
+        raise
+    except socket.error as e:
+        if e.args[0] in _BLOCKING_ERRNOS:
+            return want
+        raise
+
+
+class HTTPConnection(object):
+    """A non-blocking HTTP/1.1 connection, for one exchange at a time. Its
+    coroutines run on the event loop
+    """
+
+    SEND_SIZE = RECV_SIZE = 256 * 1024
+    #  Bodies up to that size are sent along with the request line and
+    #  headers, to avoid a delayed ACK between them
+    PIGGYBACK_SIZE = 64 * 1024
+
+    def __init__(self, loop, scheme, netloc):
+        self.loop, self.scheme, self.netloc = loop, scheme, netloc
+        self.sock, self.reusable, self.requests = None, False, 0
+
+    def close(self):
+        if self.sock is not None:
+            self.loop.remove_reader(self.sock.fileno())
+            self.loop.remove_writer(self.sock.fileno())
+            self.sock.close()
+            self.sock = None
+        self.reusable = False
+
+    def connect(self, timeout=None):
+        """Coroutine: connect to the first address of the host which accepts
+        the connection. Certificates are checked as by
+        https.HTTPSClientAuthConnection
+        """
+        error = None
+        for family, socktype, proto, name, address in resolve(
+                self.scheme, self.netloc):
+            sock = socket.socket(family, socktype, proto)
+            sock.setblocking(0)
+            try:
+                err = sock.connect_ex(address)
+                if err in _BLOCKING_ERRNOS:
+                    yield self.loop.wait_io(sock, True, timeout)
+                    err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err:
+                    raise socket.error(err, os.strerror(err))
+            except socket.error as e:
+                sock.close()
+                error = e
+                continue
+            except BaseException:
+                sock.close()
+                raise
+            break
+        else:
+            raise error or socket.error('No address for %s' % self.netloc)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock = sock
+        if self.scheme == 'https':
+            conn = https.HTTPSClientAuthConnection
+            self.sock = ssl.wrap_socket(
+                sock, do_handshake_on_connect=False,
+                ca_certs=conn.ca_file if conn.raise_ssl_error else None,
+                cert_reqs=(
+                    ssl.CERT_REQUIRED if conn.raise_ssl_error else (
+                        ssl.CERT_NONE)))
+            while True:
+                want = _try_io(READ, self.sock.do_handshake)
+                if not (want is READ or want is WRITE):
+                    break
+                yield self.loop.wait_io(self.sock, want is WRITE, timeout)
+
+    def _head(self, request, body):
+        headers = dict((k.lower(), k) for k in request.headers)
+        lines = ['%s %s HTTP/1.1' % (request.method.upper(), request.path)]
+        if 'host' not in headers:
+            lines.append('Host: %s' % self.netloc)
+        if 'accept-encoding' not in headers:
+            lines.append('Accept-Encoding: identity')
+        if 'content-length' not in headers and (
+                body or request.method.upper() in ('POST', 'PUT')):
+            lines.append('Content-Length: %s' % len(body))
+        lines += ['%s: %s' % (k, v) for k, v in request.headers.items()]
+        head = '\r\n'.join(lines) + '\r\n\r\n'
+        return head.encode('utf-8') if isinstance(head, unicode) else head
+
+    def request(self, request, timeout=None, stats=None):
+        """Coroutine: send a request and receive the response. The sent flag
+        of the request is set when the whole request is sent
+
+        :param request: (RequestManager) with encoded headers
+
+        :param timeout: (float) seconds to wait on each send or receive
+
+        :param stats: (RequestStats) notified when the response starts
+
+        :returns: (HTTPResponse)
+        """
+        self.reusable = False
+        body = request.data or ''
+        if hasattr(body, 'read'):
+            body = body.read()
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+        head = self._head(request, body)
+        #  Other bodies (e.g., buffers of mapped files) are sent as they are
+        if isinstance(body, str) and len(body) <= self.PIGGYBACK_SIZE:
+            head, body = head + body, ''
+        for data in (head, body):
+            offset = 0
+            while offset < len(data):
+                sent = _try_io(WRITE, self.sock.send, buffer(
+                    data, offset, self.SEND_SIZE))
+                if sent is READ or sent is WRITE or sent == 0:
+                    #  SSL sockets return 0 if they would block
+                    yield self.loop.wait_io(self.sock, sent is not READ, (
+                        timeout))
+                    continue
+                offset += sent
+        request.sent = True
+
+        response, rest = HTTPResponse(request.method), ''
+        while not response.done:
+            data = _try_io(READ, self.sock.recv, self.RECV_SIZE)
+            if data is READ or data is WRITE:
+                yield self.loop.wait_io(self.sock, data is WRITE, timeout)
+                continue
+            if stats and not (response.received or data == ''):
+                stats.first_byte()
+            rest = response.feed(data)
+        #  Any data after the response is out of sync
+        self.reusable = not (response.will_close or rest)
+        self.requests += 1
+        raise Return(response)
+
+
+class HTTPResponse(object):
+    """A response, parsed while it is received. It can be handled like an
+    httplib.HTTPResponse (status, reason, getheaders, getheader, read), once
+    it is done. Header names are in lower case, as in httplib
+    """
+
+    MAX_HEAD_SIZE = 64 * 1024
+
+    def __init__(self, method):
+        self.method = method.upper()
+        self.version, self.status, self.reason = None, None, None
+        self.done, self.will_close, self.received = False, False, 0
+        self._headers, self._index = [], dict()
+        self._buffer, self._body = '', []
+        self._state, self._remaining = self._read_head, None
+
+    def feed(self, data):
+        """Parse the next part of the response
+
+        :param data: (str) received data, empty at the end of the stream
+
+        :returns: (str) any data after the end of the response
+
+        :raises HTTPException: if the response is malformed or incomplete
+        """
+        if not data:
+            self._end()
+            return ''
+        self.received += len(data)
+        if self._buffer:
+            data, self._buffer = self._buffer + data, ''
+        while data and not self.done:
+            data = self._state(data)
+        return data
+
+    def _end(self):
+        if self._state == self._read_until_close:
+            self._finish()
+        elif not self.done:
+            body = ''.join(self._body)
+            if self._state == self._read_head:
+                raise BadStatusLine(repr(self._buffer.split('\r\n', 1)[0]))
+            raise IncompleteRead(body, self._remaining)
+
+    def _finish(self):
+        self.done, self._state = True, None
+
+    def _read_head(self, data):
+        end = data.find('\r\n\r\n')
+        if end < 0:
+            if len(data) > self.MAX_HEAD_SIZE:
+                raise HTTPException('Response head over %s bytes' % (
+                    self.MAX_HEAD_SIZE))
+            self._buffer = data
+            return ''
+        lines = data[:end].split('\r\n')
+        version, sep, status = lines[0].partition(' ')
+        status, sep, self.reason = status.strip().partition(' ')
+        if not (version.startswith('HTTP/') and status.isdigit()):
+            raise BadStatusLine(lines[0])
+        self.version, self.status = version, int(status)
+        self._headers, self._index = [], dict()
+        name = None
+        for line in lines[1:]:
+            if line[:1] in (' ', '\t') and name:
+                self._add_header(name, line.strip(), ' ')
+                continue
+            name, sep, value = line.partition(':')
+            name = name.strip().lower()
+            if sep and name:
+                self._add_header(name, value.strip())
+            else:
+                name = None
+        self.reason = self.reason.strip()
+        if self.status < 200:
+            #  An interim response (e.g., 100 Continue)
+            return data[end + 4:]
+
+        tokens = [t.strip() for t in self.getheader(
+            'connection', '').lower().split(',')]
+        self.will_close = 'close' in tokens or (
+            version == 'HTTP/1.0' and 'keep-alive' not in tokens)
+        length = self.getheader('content-length', '')
+        if self.method == 'HEAD' or self.status in (204, 304):
+            self._finish()
+        elif 'chunked' in self.getheader('transfer-encoding', '').lower():
+            self._state = self._read_chunk_size
+        elif length.strip().isdigit():
+            self._remaining = int(length)
+            self._state = self._read_length
+            if not self._remaining:
+                self._finish()
+        else:
+            self.will_close = True
+            self._state = self._read_until_close
+        return data[end + 4:]
+
+    def _add_header(self, name, value, sep=', '):
+        if name in self._index:
+            i = self._index[name]
+            self._headers[i] = (name, self._headers[i][1] + sep + value)
+        else:
+            self._index[name] = len(self._headers)
+            self._headers.append((name, value))
+
+    def _read_length(self, data):
+        part = data[:self._remaining]
+        self._body.append(part)
+        self._remaining -= len(part)
+        if not self._remaining:
+            self._finish()
+        return data[len(part):]
+
+    def _read_line(self, data):
+        """:returns: (tuple) the next line and the rest of data, or None"""
+        end = data.find('\r\n')
+        if end < 0:
+            if len(data) > self.MAX_HEAD_SIZE:
+                raise HTTPException('Chunk line over %s bytes' % (
+                    self.MAX_HEAD_SIZE))
+            self._buffer = data
+            return None
+        return data[:end], data[end + 2:]
+
+    def _read_chunk_size(self, data):
+        line = self._read_line(data)
+        if line is None:
+            return ''
+        size, data = line[0].split(';', 1)[0].strip(), line[1]
+        try:
+            self._remaining = int(size, 16)
+        except ValueError:
+            raise IncompleteRead(''.join(self._body))
+        self._state = self._read_chunk if (
+            self._remaining) else self._read_trailer
+        return data
+
+    def _read_chunk(self, data):
+        part = data[:self._remaining]
+        self._body.append(part)
+        self._remaining -= len(part)
+        if not self._remaining:
+            self._state = self._after_chunk
+        return data[len(part):]
+
+    def _after_chunk(self, data):
+        line = self._read_line(data)
+        if line is None:
+            return ''
+        self._state = self._read_chunk_size
+        return line[1]
+
+    def _read_trailer(self, data):
+        line = self._read_line(data)
+        if line is None:
+            return ''
+        if not line[0]:
+            self._finish()
+        return line[1]
+
+    def _read_until_close(self, data):
+        self._body.append(data)
+        return ''
+
+    def getheaders(self):
+        return list(self._headers)
+
+    def getheader(self, name, default=None):
+        i = self._index.get(name.lower())
+        return default if i is None else self._headers[i][1]
+
+    def read(self):
+        """:returns: (str) the body"""
+        if len(self._body) != 1:
+            self._body = [''.join(self._body)]
+        return self._body[0]
+
+
+_loop, _loop_lock = None, Lock()
+
+
+def get_event_loop():
+    """:returns: (EventLoop) the one of this process, started on first use"""
+    global _loop
+    with _loop_lock:
+        if _loop is None or _loop.pid != os.getpid():
+            _loop = EventLoop()
+        return _loop
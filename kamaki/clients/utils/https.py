@@ -40,10 +40,26 @@ from objpool import http
 log = logging.getLogger(__name__)
 
 
+class BufferedHTTPResponse(httplib.HTTPResponse):
+    """Read responses through a buffer. By default, httplib reads the status
+    line and the headers with a recv call per byte"""
+
+    def __init__(self, sock, *args, **kwargs):
+        kwargs['buffering'] = True
+        httplib.HTTPResponse.__init__(self, sock, *args, **kwargs)
+
+
+class HTTPConnection(httplib.HTTPConnection):
+    """HTTP connection, with buffered responses"""
+
+    response_class = BufferedHTTPResponse
+
+
 class HTTPSClientAuthConnection(httplib.HTTPSConnection):
     """HTTPS connection, with full client-based SSL Authentication support"""
 
     ca_file, raise_ssl_error = None, True
+    response_class = BufferedHTTPResponse
 
     def __init__(
             self, host,
@@ -105,6 +121,7 @@ class HTTPSClientAuthConnection(httplib.HTTPSConnection):
                 ssl.CERT_REQUIRED if self.raise_ssl_error else ssl.CERT_NONE))
 
 
+http.HTTPConnectionPool._scheme_to_class['http'] = HTTPConnection
 http.HTTPConnectionPool._scheme_to_class['https'] = HTTPSClientAuthConnection
 PooledHTTPConnection = http.PooledHTTPConnection
 
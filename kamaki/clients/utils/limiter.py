@@ -0,0 +1,182 @@
+# Copyright 2014 GRNET S.A. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following
+# conditions are met:
+#
+#   1. Redistributions of source code must retain the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer.
+#
+#   2. Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials
+#      provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY GRNET S.A. ``AS IS'' AND ANY EXPRESS
+# OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL GRNET S.A OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF
+# USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED
+# AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and
+# documentation are those of the authors and should not be
+# interpreted as representing official policies, either expressed
+# or implied, of GRNET S.A.
+
+from threading import Condition, Lock
+from time import time
+
+
+class ConcurrencyLimiter(object):
+    """An adaptive limit of requests in flight (e.g., to a host), between
+    min_limit and max_limit, adjusted on each finished request:
+    - an overload error (e.g., a 503) halves the limit, at most once per
+      round trip, so that a burst of errors counts as one
+    - a latency higher than TOLERANCE times the lowest one seen (per byte,
+      for transfers) shrinks the limit in proportion
+    - any other success grows the limit by 1 / limit, i.e., by about one
+      for every limit requests
+    Moving averages of the throughput (bytes/sec) and of the error rate are
+    kept as well. It is thread-safe.
+
+    :param clock: (callable) returns the time in seconds, e.g., a fake clock
+        for simulations
+    """
+
+    BACKOFF = 0.5
+    TOLERANCE = 2.0
+    DRIFT = 0.01  # the lowest latency drifts up by that much on each sample
+    SMOOTHING = 0.2  # weight of the new sample in the moving averages
+    PERIOD = 1.0  # seconds, for measuring the throughput
+
+    def __init__(self, max_limit, min_limit=1, clock=time):
+        assert 1 <= min_limit <= max_limit, 'Invalid limits'
+        self.min_limit, self.max_limit = min_limit, max_limit
+        self.clock = clock
+        self.in_flight = 0
+        self.throughput, self.error_rate = 0.0, 0.0
+        self._limit = float(min_limit)
+        self._min_cost = dict()
+        self._last_backoff, self._last_latency = None, 0.0
+        self._period_start, self._period_bytes = clock(), 0
+        self._cond = Condition(Lock())
+        self._wakeups = []
+
+    @property
+    def limit(self):
+        return int(self._limit)
+
+    def set_max_limit(self, max_limit):
+        """Change the upper bound of the limit, e.g., to the concurrency of a
+        new client of the same host. The limit shrinks to fit, if needed
+        """
+        assert max_limit >= 1, 'Invalid limits'
+        with self._cond:
+            self.max_limit = max_limit
+            self.min_limit = min(self.min_limit, max_limit)
+            self._limit = min(self._limit, float(max_limit))
+            self._cond.notify_all()
+        self._wake()
+
+    def try_acquire(self, wakeup=None):
+        """:param wakeup: (callable) if there is no free slot, it is called
+            once, in the releasing thread, when a slot may have been freed
+
+        :returns: (float) the start time for release, or None if there is
+            no free slot
+        """
+        with self._cond:
+            if self.in_flight >= self.limit:
+                if wakeup:
+                    self._wakeups.append(wakeup)
+                return None
+            self.in_flight += 1
+            return self.clock()
+
+    def acquire(self):
+        """Wait for a free slot
+
+        :returns: (float) the start time, for release
+        """
+        with self._cond:
+            while self.in_flight >= self.limit:
+                self._cond.wait(0.1)
+            self.in_flight += 1
+            return self.clock()
+
+    def release(self, started, nbytes=0, error=False, measure=True):
+        """Free a slot and adapt the limit to the outcome of its request
+
+        :param started: (float) as returned by acquire
+
+        :param nbytes: (int) the bytes transfered by the request
+
+        :param error: (bool) the request failed due to overload
+
+        :param measure: (bool) False to just free the slot, e.g., if the
+            request failed for reasons unrelated to load
+        """
+        with self._cond:
+            self.in_flight -= 1
+            if measure:
+                self._update(self.clock() - started, nbytes, error)
+            self._cond.notify_all()
+        self._wake()
+
+    def _wake(self):
+        with self._cond:
+            wakeups, self._wakeups = self._wakeups, []
+        for wakeup in wakeups:
+            wakeup()
+
+    def _update(self, latency, nbytes, error):
+        now = self.clock()
+        self.error_rate += self.SMOOTHING * (float(error) - self.error_rate)
+        if error:
+            if self._last_backoff is None or (
+                    now - self._last_backoff >= self._last_latency):
+                self._limit = max(self.min_limit, self._limit * self.BACKOFF)
+                self._last_backoff = now
+            return
+        self._last_latency = latency
+
+        self._period_bytes += nbytes
+        if now - self._period_start >= self.PERIOD:
+            rate = self._period_bytes / (now - self._period_start)
+            self.throughput += self.SMOOTHING * (rate - self.throughput)
+            self._period_start, self._period_bytes = now, 0
+
+        #  Transfers and plain requests are compared to their own kind
+        cost = latency / nbytes if nbytes else latency
+        min_cost = self._min_cost.get(bool(nbytes), cost) * (1 + self.DRIFT)
+        min_cost = self._min_cost[bool(nbytes)] = min(min_cost, cost)
+        gradient = self.TOLERANCE * min_cost / cost if cost else 1.0
+        if gradient < 1.0:
+            self._limit = max(
+                self.min_limit, self._limit * max(self.BACKOFF, gradient))
+        else:
+            self._limit = min(self.max_limit, self._limit + 1.0 / self._limit)
+
+
+_limiters, _limiters_lock = dict(), Lock()
+
+
+def get_concurrency_limiter(host, max_limit):
+    """:returns: (ConcurrencyLimiter) shared by all requests to host in this
+        process. Its max_limit is updated to the one given
+    """
+    with _limiters_lock:
+        limiter = _limiters.get(host, None)
+        if limiter is None:
+            limiter = _limiters[host] = ConcurrencyLimiter(max_limit)
+        elif limiter.max_limit != max_limit:
+            limiter.set_max_limit(max_limit)
+        return limiter
@@ -0,0 +1,95 @@
+# Copyright 2014 GRNET S.A. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following
+# conditions are met:
+#
+#   1. Redistributions of source code must retain the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer.
+#
+#   2. Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials
+#      provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY GRNET S.A. ``AS IS'' AND ANY EXPRESS
+# OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL GRNET S.A OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF
+# USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED
+# AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and
+# documentation are those of the authors and should not be
+# interpreted as representing official policies, either expressed
+# or implied, of GRNET S.A.
+
+from sys import exc_info
+from threading import Event, Lock
+
+
+class _Flight(object):
+
+    def __init__(self):
+        self.done = Event()
+        self.result, self.exc_info = None, None
+        self.waiters = 0
+
+
+class SingleFlight(object):
+    """Collapse concurrent calls with the same key into a single call. The
+    first caller runs it, the others wait and get the same result, or the
+    same exception. Calls made after it is finished run again.
+    """
+
+    #  Followers wait in short steps, so that KeyboardInterrupt is not
+    #  blocked. Longer Event waits poll with sleeps of up to 50ms
+    WAIT_STEP = 0.01  # seconds
+
+    def __init__(self):
+        self._lock = Lock()
+        self._flights = dict()
+
+    def call(self, key, func, *args, **kwargs):
+        """:returns: (tuple) the result of func(*args, **kwargs) and whether
+            it was shared with other callers
+
+        :raises: whatever func raised
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+            else:
+                flight.waiters += 1
+        if leader:
+            try:
+                flight.result = func(*args, **kwargs)
+            except BaseException:
+                #  Followers must not get an empty result, even if the
+                #  leader is interrupted
+                flight.exc_info = exc_info()
+            finally:
+                with self._lock:
+                    self._flights.pop(key, None)
+                flight.done.set()
+        else:
+            while not flight.done.is_set():
+                flight.done.wait(self.WAIT_STEP)
+        if flight.exc_info:
+            raise flight.exc_info[0], flight.exc_info[1], flight.exc_info[2]
+        return flight.result, bool(flight.waiters)
+
+    def waiters(self, key):
+        """:returns: (int) how many callers wait for the call with this key"""
+        with self._lock:
+            flight = self._flights.get(key)
+            return flight.waiters if flight else 0
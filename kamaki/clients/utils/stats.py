@@ -0,0 +1,257 @@
+# Copyright 2014 GRNET S.A. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following
+# conditions are met:
+#
+#   1. Redistributions of source code must retain the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer.
+#
+#   2. Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials
+#      provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY GRNET S.A. ``AS IS'' AND ANY EXPRESS
+# OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL GRNET S.A OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF
+# USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED
+# AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and
+# documentation are those of the authors and should not be
+# interpreted as representing official policies, either expressed
+# or implied, of GRNET S.A.
+
+from json import dumps
+from math import ceil
+from random import random, randint
+from threading import Lock
+from time import time
+from logging import getLogger
+
+
+log = getLogger(__name__)
+
+_collectors, _collectors_lock = [], Lock()
+
+
+def add_collector(collector):
+    """Pass the RequestStats of each request from now on to collector
+
+    :param collector: (StatsCollector)
+    """
+    with _collectors_lock:
+        if collector not in _collectors:
+            _collectors.append(collector)
+
+
+def remove_collector(collector):
+    with _collectors_lock:
+        if collector in _collectors:
+            _collectors.remove(collector)
+
+
+def collecting():
+    """:returns: (bool) whether any collectors are registered"""
+    return bool(_collectors)
+
+
+class RequestStats(object):
+    """Measurements of a request. Times are in seconds from the start of the
+    request, sizes are in bytes
+
+    :ivar status: (int) the HTTP status, 0 if the request failed
+
+    :ivar error: (str) the type of the exception which failed the request
+
+    :ivar acquire_time: until a pooled connection is acquired
+
+    :ivar first_byte_time: until the response status and headers are read
+
+    :ivar latency: until the response body is read
+
+    :ivar retries: (int) connection retries
+    """
+
+    def __init__(self, method, url, service='', sent=0):
+        self.method, self.url, self.service = method, url, service
+        self.status, self.error = 0, ''
+        self.sent, self.received = sent, 0
+        self.acquire_time, self.first_byte_time, self.latency = 0.0, 0.0, 0.0
+        self.retries = 0
+        self.start = time()
+
+    def acquired(self):
+        self.acquire_time = time() - self.start
+
+    def first_byte(self):
+        self.first_byte_time = time() - self.start
+
+    def finish(self, error=None):
+        """Measure the latency and pass the stats to all collectors"""
+        self.latency = time() - self.start
+        if error is not None:
+            self.error = type(error).__name__
+        for collector in list(_collectors):
+            try:
+                collector.collect(self)
+            except Exception as e:
+                log.debug('Stats collector %s failed: %s' % (collector, e))
+
+
+class StatsCollector(object):
+    """Collectors get the RequestStats of each finished request. They must be
+    thread-safe, since requests may run in many threads
+    """
+
+    def collect(self, stats):
+        """Called once per finished request. Ignore it, by default
+
+        :param stats: (RequestStats)
+        """
+        pass
+
+
+def percentile(values, p):
+    """:returns: the p-th percentile of sorted values, by nearest rank"""
+    if not values:
+        return 0.0
+    return values[max(0, int(ceil(p / 100.0 * len(values))) - 1)]
+
+
+class _ServiceSummary(object):
+    """Running totals of the requests to a service, and a uniform random
+    sample of their times (reservoir sampling), for the percentiles
+    """
+
+    def __init__(self, sample_size):
+        self.sample_size = sample_size
+        self.requests, self.errors, self.retries = 0, 0, 0
+        self.sent, self.received = 0, 0
+        self.first_start, self.last_end = None, None
+        self.slowest, self.slowest_latency = '', -1.0
+        self.samples = []
+
+    def add(self, stats):
+        self.requests += 1
+        if stats.error or not stats.status or stats.status >= 400:
+            self.errors += 1
+        self.retries += stats.retries
+        self.sent, self.received = (
+            self.sent + stats.sent, self.received + stats.received)
+        end = stats.start + stats.latency
+        if self.first_start is None or stats.start < self.first_start:
+            self.first_start = stats.start
+        if self.last_end is None or end > self.last_end:
+            self.last_end = end
+        if stats.latency > self.slowest_latency:
+            self.slowest_latency = stats.latency
+            self.slowest = '%s %s' % (stats.method, stats.url)
+        times = (stats.acquire_time, stats.first_byte_time, stats.latency)
+        if len(self.samples) < self.sample_size:
+            self.samples.append(times)
+        else:
+            i = randint(0, self.requests - 1)
+            if i < self.sample_size:
+                self.samples[i] = times
+
+
+class SummaryCollector(StatsCollector):
+    """Aggregate request stats per service. Memory is bounded: totals are
+    counted as requests finish, and percentiles are estimated over a sample of
+    up to SAMPLE_SIZE requests per service
+    """
+
+    PERCENTILES = (50, 90, 99)
+    SAMPLE_SIZE = 1024
+
+    def __init__(self):
+        self._lock = Lock()
+        self._stats = dict()
+
+    def collect(self, stats):
+        service = stats.service or 'other'
+        with self._lock:
+            summary = self._stats.get(service, None)
+            if summary is None:
+                summary = self._stats[service] = _ServiceSummary(
+                    self.SAMPLE_SIZE)
+            summary.add(stats)
+
+    def summary(self):
+        """:returns: (dict) for each service, the number of requests, errors
+            and retries, the bytes sent and received, the throughput in
+            bytes/sec (over the time some requests were running), the url
+            of the slowest request and the acquire, first_byte and latency
+            percentiles, e.g., {'object-store': {..., 'latency': {'p50': ..}}}
+        """
+        result = dict()
+        with self._lock:
+            for service, s in self._stats.items():
+                elapsed = s.last_end - s.first_start
+                result[service] = dict(
+                    requests=s.requests,
+                    errors=s.errors,
+                    retries=s.retries,
+                    sent=s.sent,
+                    received=s.received,
+                    bytes_per_sec=(s.sent + s.received) / elapsed if (
+                        elapsed) else 0.0,
+                    slowest=s.slowest)
+                samples = list(s.samples)
+                for i, key in enumerate(('acquire', 'first_byte', 'latency')):
+                    values = sorted(times[i] for times in samples)
+                    result[service][key] = dict(
+                        ('p%s' % p, percentile(values, p)) for p in (
+                            self.PERCENTILES))
+        return result
+
+    def report(self):
+        """:returns: (str) the summary, in human readable form"""
+        lines = []
+        for service, s in sorted(self.summary().items()):
+            lines.append('%s: %s requests, %s errors, %s retries' % (
+                service, s['requests'], s['errors'], s['retries']))
+            lines.append('  sent %s B, received %s B, %.0f B/s' % (
+                s['sent'], s['received'], s['bytes_per_sec']))
+            for key in ('acquire', 'first_byte', 'latency'):
+                lines.append('  %s: %s' % (key, ', '.join([
+                    'p%s %.3fs' % (p, s[key]['p%s' % p]) for p in (
+                        self.PERCENTILES)])))
+            lines.append('  slowest: %s' % s['slowest'])
+        return '\n'.join(lines)
+
+
+class TraceCollector(StatsCollector):
+    """Log a sample of the requests as JSON lines, e.g.,
+    {"method": "PUT", "status": 201, "latency": 0.031, ...}
+    The url and sizes are logged, but not the headers or the data
+
+    :param logger: (logging.Logger) where to log, at INFO level
+
+    :param sample_rate: (float) the fraction of requests to log, 0.0 to 1.0
+    """
+
+    FIELDS = (
+        'method', 'url', 'service', 'status', 'error', 'sent', 'received',
+        'retries', 'start', 'acquire_time', 'first_byte_time', 'latency')
+
+    def __init__(self, logger=None, sample_rate=1.0):
+        self.logger = logger or getLogger('%s.trace' % __name__)
+        self.sample_rate = max(0.0, min(1.0, float(sample_rate)))
+
+    def collect(self, stats):
+        if self.sample_rate < 1.0 and random() >= self.sample_rate:
+            return
+        self.logger.info(dumps(
+            dict((k, getattr(stats, k)) for k in self.FIELDS),
+            sort_keys=True))
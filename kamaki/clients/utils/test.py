@@ -32,10 +32,24 @@
 # or implied, of GRNET S.A.
 
 from unittest import TestCase
-from tempfile import TemporaryFile
+from tempfile import TemporaryFile, mkdtemp
+from shutil import rmtree
+from os import listdir, utime, path, pipe, fdopen
 from itertools import product
+from heapq import heappush, heappop
+from json import loads
+from threading import Event, Thread
+from time import sleep
+
+from mock import patch, MagicMock
 
 from kamaki.clients import utils
+from kamaki.clients.utils.cache import FileCache
+from kamaki.clients.utils import stats
+from kamaki.clients.utils.limiter import ConcurrencyLimiter
+from kamaki.clients.utils.singleflight import SingleFlight
+from kamaki.clients.utils import eventloop
+from kamaki.clients.utils.transfer import TransferScheduler
 
 
 def _try(assertfoo, foo, *args):
@@ -139,6 +153,34 @@ class Utils(TestCase):
             self.assertEqual(utils.readall(f, 1), '')
             self.assertRaises(IOError, utils.readall, f, 1, 0)
 
+    def test_BlockSource(self):
+        tstr = '1234567890'
+        with TemporaryFile() as f:
+            f.write(tstr)
+            f.flush()
+            f.seek(0)
+            source = utils.BlockSource(f)
+            self.assertTrue(source.mapped)
+            self.assertEqual(str(source.block(2, 3)), tstr[2:5])
+            self.assertEqual(str(source.block(8, 4)), tstr[8:])
+            self.assertEqual(
+                [str(b) for b in source.blocks(4, 10)],
+                ['1234', '5678', '90'])
+            f.seek(3)
+            self.assertEqual(
+                [str(b) for b in source.blocks(4, 6)], ['4567', '89'])
+            source.close()
+            self.assertFalse(source.mapped)
+
+        r, w = pipe()
+        with fdopen(r, 'rb') as rf:
+            with fdopen(w, 'wb') as wf:
+                wf.write(tstr)
+            source = utils.BlockSource(rf)
+            self.assertFalse(source.mapped)
+            self.assertEqual(
+                list(source.blocks(4, 20)), ['1234', '5678', '90'])
+
     def test_escape_ctrl_chars(self):
         gr_synnefo = u'\u03c3\u03cd\u03bd\u03bd\u03b5\u03c6\u03bf'
         gr_kamaki = u'\u03ba\u03b1\u03bc\u03ac\u03ba\u03b9'
@@ -157,7 +199,547 @@ class Utils(TestCase):
                 esc_str = word1 + esc_char + word2
                 self.assertEqual(utils.escape_ctrl_chars(orig_str), esc_str)
 
+
+class Cache(TestCase):
+
+    def setUp(self):
+        self.path = mkdtemp()
+        self.cache = FileCache(self.path, limit=100)
+
+    def tearDown(self):
+        rmtree(self.path)
+
+    def test_get_set(self):
+        self.assertEqual(self.cache.get('k1'), None)
+        self.assertEqual(self.cache.get('k1', 'default'), 'default')
+        self.cache.set('k1', 'v' * 10)
+        self.assertEqual(self.cache.get('k1'), 'v' * 10)
+        self.cache.set('k1', 'w' * 20)
+        self.assertEqual(self.cache.get('k1'), 'w' * 20)
+        self.assertEqual(self.cache.size, 20)
+        self.assertEqual(FileCache(self.path).get('k1'), 'w' * 20)
+        self.cache.delete('k1')
+        self.assertEqual(self.cache.get('k1'), None)
+        self.assertEqual(self.cache.size, 0)
+        self.cache.set('k2', 'v' * 101)
+        self.assertEqual(self.cache.get('k2'), None)
+
+    def _set_atime(self, value, atime):
+        for name in listdir(self.path):
+            entry = path.join(self.path, name)
+            if open(entry).read() == value:
+                utime(entry, (atime, atime))
+
+    def test_eviction(self):
+        for i in range(4):
+            self.cache.set('k%s' % i, '%s' % i * 30)
+            self._set_atime('%s' % i * 30, 1000 + i)
+
+        #  Evicted down to the low water mark (80), not just under the limit
+        for k in ('k0', 'k1'):
+            self.assertEqual(self.cache.get(k), None)
+        self.assertEqual(self.cache.size, 60)
+        self._set_atime('2' * 30, 2000)
+        self._set_atime('3' * 30, 2001)
+
+        #  Under the limit, the cache directory is not scanned
+        with patch.object(
+                self.cache, '_entries', wraps=self.cache._entries) as scan:
+            self.cache.set('k4', '4' * 30)
+            self.assertEqual(scan.mock_calls, [])
+        self._set_atime('4' * 30, 3000)
+
+        #  k2 becomes the most recently used, so k3 and k4 go away
+        self.assertEqual(self.cache.get('k2'), '2' * 30)
+        self.cache.set('k5', '5' * 30)
+        for k in ('k3', 'k4'):
+            self.assertEqual(self.cache.get(k), None)
+        for k in ('k2', 'k5'):
+            self.assertEqual(self.cache.get(k), k[1] * 30)
+        self.assertEqual(self.cache.size, 60)
+
+    def test_clear(self):
+        self.cache.set('k1', 'v1')
+        self.cache.set('k2', 'v2')
+        self.cache.clear()
+        self.assertEqual(listdir(self.path), [])
+        self.assertEqual(self.cache.size, 0)
+
+
+class Stats(TestCase):
+
+    def setUp(self):
+        self.collector = stats.SummaryCollector()
+        stats.add_collector(self.collector)
+
+    def tearDown(self):
+        stats.remove_collector(self.collector)
+
+    def _stats(self, service, latency, **kwargs):
+        s = stats.RequestStats('GET', 'http://ok/%s' % latency, service)
+        s.start = 1000.0
+        for k, v in kwargs.items():
+            setattr(s, k, v)
+        with patch('kamaki.clients.utils.stats.time', return_value=(
+                1000.0 + latency)):
+            s.finish()
+        return s
+
+    def test_percentile(self):
+        values = range(1, 101)
+        for p, expected in ((50, 50), (90, 90), (99, 99), (100, 100)):
+            self.assertEqual(stats.percentile(values, p), expected)
+        self.assertEqual(stats.percentile([3], 99), 3)
+        self.assertEqual(stats.percentile([], 50), 0.0)
+
+    def test_collectors(self):
+        self.assertTrue(stats.collecting())
+        s = stats.RequestStats('GET', 'http://ok', 'srv')
+        s.finish(error=IOError('failed'))
+        self.assertEqual(s.error, 'IOError')
+        self.assertEqual(self.collector.summary()['srv']['errors'], 1)
+
+        #  A failing collector does not affect the others
+        class Broken(stats.StatsCollector):
+            def collect(self, stats):
+                raise IOError('broken')
+        broken = Broken()
+        stats.add_collector(broken)
+        stats.RequestStats('GET', 'http://ok', 'srv').finish()
+        stats.remove_collector(broken)
+        self.assertEqual(self.collector.summary()['srv']['requests'], 2)
+        stats.StatsCollector().collect(s)
+
+    def test_summary(self):
+        for i in range(1, 11):
+            self._stats(
+                'store', i / 10.0, status=200, sent=10, received=90,
+                first_byte_time=i / 100.0, retries=i % 2)
+        self._stats('compute', 2.0, status=404)
+        summary = self.collector.summary()
+        self.assertEqual(sorted(summary), ['compute', 'store'])
+        store = summary['store']
+        self.assertEqual(store['requests'], 10)
+        self.assertEqual(store['errors'], 0)
+        self.assertEqual(store['retries'], 5)
+        self.assertEqual((store['sent'], store['received']), (100, 900))
+        self.assertEqual(store['bytes_per_sec'], 1000)
+        self.assertEqual(store['latency']['p50'], 0.5)
+        self.assertEqual(store['latency']['p99'], 1.0)
+        self.assertEqual(store['first_byte']['p90'], 0.09)
+        self.assertEqual(store['slowest'], 'GET http://ok/1.0')
+        self.assertEqual(summary['compute']['errors'], 1)
+        report = self.collector.report()
+        self.assertTrue(report.startswith('compute: 1 requests, 1 errors'))
+        self.assertTrue('latency: p50 0.500s, p90 0.900s' in report)
+
+    def test_sample_size(self):
+        self.collector.SAMPLE_SIZE = 10
+        for i in range(100):
+            self._stats('store', 1.0, status=200, sent=1)
+        self._stats('store', 5.0, status=200, sent=1)
+        store = self.collector._stats['store']
+        self.assertEqual(len(store.samples), 10)
+        summary = self.collector.summary()['store']
+        self.assertEqual((summary['requests'], summary['sent']), (101, 101))
+        self.assertEqual(summary['slowest'], 'GET http://ok/5.0')
+
+    @patch('kamaki.clients.utils.stats.random', side_effect=[0.3, 0.7])
+    def test_trace(self, random):
+        logger = MagicMock()
+        tracer = stats.TraceCollector(logger, sample_rate=0.5)
+        stats.add_collector(tracer)
+        try:
+            for i in range(2):
+                self._stats('store', 0.25, status=201, sent=4, error='')
+        finally:
+            stats.remove_collector(tracer)
+        self.assertEqual(len(logger.info.mock_calls), 1)
+        trace = loads(logger.info.mock_calls[0][1][0])
+        self.assertEqual(sorted(trace), sorted(tracer.FIELDS))
+        self.assertEqual(
+            (trace['method'], trace['status'], trace['sent']),
+            ('GET', 201, 4))
+        self.assertEqual(stats.TraceCollector(sample_rate=7).sample_rate, 1)
+
+
+class Limiter(TestCase):
+
+    def setUp(self):
+        self.now = 0.0
+        self.limiter = ConcurrencyLimiter(16, clock=lambda: self.now)
+
+    def test_slots(self):
+        limiter = self.limiter
+        started = limiter.try_acquire()
+        self.assertEqual(started, 0.0)
+        woken = []
+        self.assertEqual(limiter.try_acquire(lambda: woken.append(1)), None)
+        self.now = 1.0
+        limiter.release(started, 100)
+        self.assertEqual(woken, [1])
+        self.assertEqual((limiter.limit, limiter.in_flight), (2, 0))
+        first, second = limiter.acquire(), limiter.acquire()
+        self.assertEqual(limiter.try_acquire(), None)
+
+        #  A burst of errors within a round trip backs off once
+        limiter.release(first, error=True)
+        limiter.release(second, error=True)
+        self.assertEqual(limiter.limit, 1)
+        self.assertTrue(limiter.error_rate > 0)
+        limiter.release(limiter.acquire(), measure=False)
+        self.assertEqual((limiter.limit, limiter.in_flight), (1, 0))
+
+    def test_set_max_limit(self):
+        limiter = self.limiter
+        limiter._limit = 10.0
+        limiter.set_max_limit(4)
+        self.assertEqual((limiter.max_limit, limiter.limit), (4, 4))
+        limiter.set_max_limit(32)
+        self.assertEqual((limiter.max_limit, limiter.limit), (32, 4))
+
+    def _simulate(self, capacity, requests):
+        """A server which serves capacity requests at a time in 1 sec. More
+        requests are queued, and over 2 * capacity requests are rejected
+        :returns: (list) the limit after each request
+        """
+        limiter, events, history = self.limiter, [], []
+        for i in range(requests):
+            started = limiter.try_acquire()
+            while started is not None:
+                load = limiter.in_flight
+                if load > 2 * capacity:
+                    finish, nbytes = self.now + 0.1, None
+                else:
+                    finish = self.now + max(1.0, float(load) / capacity)
+                    nbytes = 1000
+                heappush(events, (finish, len(history), i, started, nbytes))
+                started = limiter.try_acquire()
+            finish, x, y, started, nbytes = heappop(events)
+            self.now = finish
+            limiter.release(started, nbytes or 0, error=nbytes is None)
+            history.append(limiter.limit)
+        while events:
+            finish, x, y, started, nbytes = heappop(events)
+            self.now = finish
+            limiter.release(started, nbytes or 0, error=nbytes is None)
+        return history
+
+    def test_simulation(self):
+        history = self._simulate(4, 2000)
+        self.assertTrue(max(history) <= 16)
+        #  Up to twice the latency is tolerated, so up to 2 * capacity
+        self.assertTrue(4 <= min(history[500:]) <= max(history[500:]) <= 9)
+        self.assertAlmostEqual(self.limiter.throughput, 4000, delta=40)
+
+        #  The server slows down
+        history = self._simulate(1, 300)
+        self.assertTrue(max(history[100:]) <= 3)
+        self.assertAlmostEqual(self.limiter.throughput, 1000, delta=10)
+        self.assertTrue(self.limiter.error_rate > 0.05)
+
+
+class Flights(TestCase):
+
+    def setUp(self):
+        self.flights = SingleFlight()
+        self.gate, self.calls = Event(), []
+
+    def _func(self, value):
+        self.calls.append(value)
+        self.gate.wait()
+        if isinstance(value, BaseException):
+            raise value
+        return value
+
+    def _run(self, key, value, n):
+        results = []
+
+        def call():
+            try:
+                results.append(self.flights.call(key, self._func, value))
+            except BaseException as e:
+                results.append(e)
+        threads = [Thread(target=call) for i in range(n)]
+        for t in threads:
+            t.start()
+        while self.flights.waiters(key) < n - 1:
+            sleep(0.01)
+        self.gate.set()
+        for t in threads:
+            t.join()
+        self.gate.clear()
+        return results
+
+    def test_call(self):
+        self.assertEqual(self._run('k', 42, 5), [(42, True)] * 5)
+        self.assertEqual(self.calls, [42])
+        self.assertEqual(self.flights.waiters('k'), 0)
+
+        err = ValueError('failed')
+        self.assertEqual(self._run('k', err, 3), [err] * 3)
+        self.assertEqual(self.calls, [42, err])
+
+        #  Followers fail too, if the leader is interrupted
+        interrupt = KeyboardInterrupt()
+        self.assertEqual(self._run('k', interrupt, 3), [interrupt] * 3)
+        self.assertEqual(self.calls, [42, err, interrupt])
+
+        #  Finished calls are not shared
+        self.gate.set()
+        self.assertEqual(self.flights.call('k', self._func, 7), (7, False))
+        self.assertEqual(self.calls, [42, err, interrupt, 7])
+
+
+class _Request(object):
+    """A RequestManager stand-in for EventLoop.fetch"""
+
+    def __init__(self, port, method='GET', path='/', data=None):
+        self.scheme, self.netloc = 'http', '127.0.0.1:%s' % port
+        self.method, self.path, self.data = method, path, data
+        self.headers, self.sent = dict(), False
+
+
+class EventLoop(TestCase):
+
+    def setUp(self):
+        self.loop = eventloop.get_event_loop()
+
+    def _serve(self, *replies):
+        """Accept connections and reply to the requests on them, in order.
+        A reply is a response, or None to close the connection at once
+
+        :returns: (list) the number of requests per connection
+        """
+        import socket
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(4)
+        self.port, replies = listener.getsockname()[1], list(replies)
+        served = []
+
+        def serve():
+            while replies:
+                conn = listener.accept()[0]
+                served.append(0)
+                while replies:
+                    reply = replies.pop(0)
+                    if reply is None:
+                        break
+                    data = ''
+                    while '\r\n\r\n' not in data:
+                        data += conn.recv(4096)
+                    conn.sendall(reply)
+                    served[-1] += 1
+                conn.close()
+            listener.close()
+        thread = Thread(target=serve)
+        thread.daemon = True
+        thread.start()
+        return served
+
+    def test_future(self):
+        future, done = eventloop.Future(), []
+        future.add_done_callback(done.append)
+        self.assertTrue(future.isAlive())
+        self.assertRaises(eventloop.TimeoutError, future.result, 0.01)
+        self.assertTrue(future.set_result(42))
+        self.assertFalse(future.set_exception(ValueError()))
+        self.assertEqual((future.result(), done), (42, [future]))
+        future.add_done_callback(done.append)
+        self.assertEqual(done, [future, future])
+
+        future = eventloop.Future()
+        self.assertTrue(future.cancel())
+        self.assertFalse(future.cancel())
+        self.assertTrue(future.cancelled())
+        self.assertRaises(eventloop.CancelledError, future.result)
+
+    def test_task(self):
+        steps = []
+
+        def coro(fail):
+            steps.append(self.loop.in_loop_thread())
+            value = yield self.loop.sleep(0.01)
+            try:
+                yield failing
+            except ValueError as e:
+                steps.append(e)
+            if fail:
+                raise KeyError('failed')
+            raise eventloop.Return(value or 42)
+        failing = eventloop.Future()
+        failing.set_exception(ValueError('v'))
+        self.assertEqual(self.loop.spawn(coro(False)).result(), 42)
+        self.assertEqual(steps[0], True)
+        self.assertEqual(str(steps[1]), 'v')
+        self.assertRaises(KeyError, self.loop.spawn(coro(True)).result)
+
+        def endless():
+            try:
+                yield sleeping
+            finally:
+                steps.append('closed')
+        sleeping, steps[:] = eventloop.Future(), []
+        task = self.loop.spawn(endless())
+        while not sleeping._callbacks:
+            sleep(0.01)
+        self.assertTrue(task.cancel())
+        self.assertRaises(eventloop.CancelledError, task.result)
+        sleeping.join(1)
+        self.assertTrue(sleeping.cancelled())
+        self.assertEqual(steps, ['closed'])
+
+    def test_response(self):
+        def parse(method, *parts):
+            r = eventloop.HTTPResponse(method)
+            for part in parts:
+                rest = r.feed(part)
+            return r, rest
+
+        r, rest = parse(
+            'GET', 'HTTP/1.1 100 Continue\r\n\r\nHTTP/1.1 200 OK\r\n',
+            'Content-Length: 5\r\nX-A: 1\r\nx-a: 2\r\n\r\nab', 'cdeHTTP')
+        self.assertEqual((r.done, r.status, r.reason), (True, 200, 'OK'))
+        self.assertEqual(r.getheaders(), [('content-length', '5'), (
+            'x-a', '1, 2')])
+        self.assertEqual((r.read(), rest, r.will_close), ('abcde', 'HTTP', (
+            False)))
+
+        r, rest = parse(
+            'GET', 'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n',
+            '3;ext=1\r\nabc\r', '\n10\r\n', '0123456789abcdef\r\n0\r\n',
+            'Trailer: t\r\n\r\n')
+        self.assertEqual((r.done, r.read(), rest), (
+            True, 'abc0123456789abcdef', ''))
+
+        r, rest = parse('GET', 'HTTP/1.0 200 OK\r\n\r\nab', 'cd')
+        self.assertFalse(r.done)
+        r.feed('')
+        self.assertEqual((r.done, r.read(), r.will_close), (True, 'abcd', (
+            True)))
+
+        for method, status in (('HEAD', 200), ('GET', 204), ('GET', 304)):
+            r, rest = parse(method, 'HTTP/1.1 %s X\r\n%s\r\n\r\n' % (
+                status, 'Content-Length: 10'))
+            self.assertEqual((r.done, r.read()), (True, ''))
+
+        from httplib import BadStatusLine, IncompleteRead
+        r, rest = parse('GET', 'HTTP/1.1 200 OK\r\nContent-Length: 4\r\n')
+        self.assertRaises(BadStatusLine, r.feed, '')
+        r, rest = parse('GET', 'HTTP/1.1 200 OK\r\nContent-Length: 4\r\n\r\n')
+        self.assertRaises(IncompleteRead, r.feed, '')
+        self.assertRaises(BadStatusLine, parse, 'GET', 'HTP 200\r\n\r\n')
+
+    def test_fetch(self):
+        ok = 'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok'
+        served = self._serve(ok, ok, None, ok)
+        request = _Request(self.port, 'POST', data='x' * 100000)
+        self.assertEqual(self.loop.fetch(request).result().read(), 'ok')
+        self.assertTrue(request.sent)
+        self.assertEqual(
+            self.loop.fetch(_Request(self.port)).result().status, 200)
+        #  The server closes the idle connection, so the next one is new
+        pool = self.loop.host_pool('http', request.netloc)
+        while pool.idle:
+            sleep(0.01)
+        self.assertEqual(
+            self.loop.fetch(_Request(self.port)).result().read(), 'ok')
+        self.assertEqual(served, [2, 1])
+
+    def test_errors(self):
+        import socket
+        from httplib import BadStatusLine
+        self._serve('HTTP/1.1 200 OK\r\n', None)
+        self.assertRaises(BadStatusLine, self.loop.fetch(
+            _Request(self.port)).result)
+
+        #  Connected (in the backlog), but never served
+        listener = socket.socket()
+        try:
+            listener.bind(('127.0.0.1', 0))
+            listener.listen(1)
+            request = _Request(listener.getsockname()[1])
+            self.assertRaises(socket.timeout, self.loop.fetch(
+                request, read_timeout=0.1).result)
+            self.assertTrue(request.sent)
+        finally:
+            listener.close()
+
+
+class Transfers(TestCase):
+
+    def setUp(self):
+        self.steps, self.done = [], []
+        self.running, self.max_running = 0, 0
+
+        def progress_cb(n):
+            self.steps.append(n)
+            for i in range(n + 1):
+                self.steps.append(i)
+                yield
+        self.scheduler = TransferScheduler(
+            3, progress_cb, lambda t: self.done.append(t.name))
+
+    def _transfer(self, progress_cb, units, fail=False):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        sleep(0.01)
+        gen = progress_cb(units)
+        gen.next()
+        for i in range(units // 2):
+            gen.next()
+        self.running -= 1
+        if fail:
+            raise ValueError('failed')
+        return units
+
+    def test_order(self):
+        for units in (5, 1, 9, 3, 7):
+            self.scheduler.add('t%s' % units, units, self._transfer, units)
+        self.assertEqual(
+            [t.units for t in self.scheduler._order()], [9, 1, 7, 3, 5])
+        self.assertEqual(self.scheduler.units, 25)
+
+    def test_run(self):
+        transfers = [self.scheduler.add(
+            't%s' % i, i, self._transfer, i, fail=(i == 4)) for i in range(
+                10)]
+        failed = self.scheduler.run()
+        self.assertEqual(failed, [transfers[4]])
+        self.assertEqual(str(failed[0].exception), 'failed')
+        self.assertEqual([t.value for t in transfers[5:]], range(5, 10))
+        self.assertEqual(sorted(self.done), sorted(t.name for t in transfers))
+        self.assertTrue(1 < self.max_running <= 3)
+        #  The aggregate progress is complete, whatever each transfer reports
+        self.assertEqual(self.steps[0], 45)
+        self.assertEqual(self.steps[-1], 45)
+        self.assertEqual(self.scheduler.run(), [])
+
+    def test_progress_cb(self):
+        advanced = []
+        self.scheduler._advance = advanced.append
+        transfer = self.scheduler.add('t', 10, self._transfer, 3)
+        gen = transfer.progress_cb(3)
+        gen.next()
+        for i in range(3):
+            gen.next()
+        #  3 steps (e.g., blocks) are spread over 10 units (e.g., bytes)
+        self.assertEqual(advanced, [3, 3, 4])
+        self.assertEqual(transfer.done, 10)
+        gen = transfer.progress_cb(3)
+        gen.next()
+        gen.next()
+        self.assertEqual(advanced, [3, 3, 4])
+
+
 if __name__ == '__main__':
     from sys import argv
     from kamaki.clients.test import runTestCase
     runTestCase(Utils, 'clients.utils methods', argv[1:])
+    runTestCase(Cache, 'clients.utils.cache methods', argv[1:])
+    runTestCase(Stats, 'clients.utils.stats methods', argv[1:])
+    runTestCase(Limiter, 'clients.utils.limiter methods', argv[1:])
+    runTestCase(Flights, 'clients.utils.singleflight methods', argv[1:])
+    runTestCase(EventLoop, 'clients.utils.eventloop methods', argv[1:])
+    runTestCase(Transfers, 'clients.utils.transfer methods', argv[1:])
@@ -0,0 +1,182 @@
+# Copyright 2014 GRNET S.A. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following
+# conditions are met:
+#
+#   1. Redistributions of source code must retain the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer.
+#
+#   2. Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials
+#      provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY GRNET S.A. ``AS IS'' AND ANY EXPRESS
+# OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL GRNET S.A OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF
+# USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED
+# AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and
+# documentation are those of the authors and should not be
+# interpreted as representing official policies, either expressed
+# or implied, of GRNET S.A.
+
+from threading import Lock
+from logging import getLogger
+
+from kamaki.clients import WorkerPool
+
+
+log = getLogger(__name__)
+
+
+class Transfer(object):
+    """A scheduled method call which transfers a number of units (e.g.,
+    blocks). Its progress counts towards the progress of the scheduler
+
+    :ivar exception: the exception of the call, if it failed
+    """
+
+    def __init__(self, scheduler, name, units, method, args, kwargs):
+        self.scheduler, self.name, self.units = scheduler, name, units
+        self.method, self.args, self.kwargs = method, args, kwargs
+        self.done, self.value, self.exception = 0, None, None
+
+    def progress_cb(self, n):
+        """A progress callback in the format of kamaki progress bars: the
+        first next() starts, every other next() advances by one of n steps.
+        The n steps are spread over the units of the transfer, e.g., a
+        transfer of 1000 units and a callback of 10 steps (blocks) advances
+        by 100 units per step
+        """
+        yield
+        for i in xrange(1, n + 1):
+            step = min(
+                i * self.units // n - (i - 1) * self.units // n,
+                self.units - self.done)
+            if step > 0:
+                self.done += step
+                self.scheduler._advance(step)
+            yield
+
+    def __call__(self):
+        try:
+            self.value = self.method(self.progress_cb, *self.args, **(
+                self.kwargs))
+        except Exception as e:
+            log.debug('Transfer %s failed: %s' % (self.name, e))
+            self.exception = e
+        finally:
+            #  Units which were not transfered (e.g., already there) are done
+            self.scheduler._advance(self.units - self.done)
+            self.done = self.units
+            self.scheduler._finished(self)
+
+
+class TransferScheduler(object):
+    """Run many transfers (e.g., file uploads) at once, in a pool of its own.
+    The requests of each transfer still go through the worker pool and the
+    concurrency limiter of the client, so the thread and connection budget
+    is shared among all transfers.
+    Transfers are started in an order which alternates between the largest
+    and the smallest ones, so that long transfers start early and short ones
+    fill the gaps. A failed transfer does not stop the others.
+
+    :param transfers: (int) how many transfers to run at once
+
+    :param progress_cb: a progress bar generator for the total units, as in
+        the upload_cb argument of PithosClient.upload_object. Units may be
+        finer than the steps of each transfer (e.g., bytes instead of blocks)
+
+    :param done_cb: a method called with each finished Transfer, one at a
+        time
+    """
+
+    def __init__(self, transfers=5, progress_cb=None, done_cb=None):
+        self.transfers = max(1, int(transfers))
+        self.progress_cb, self.done_cb = progress_cb, done_cb
+        self._scheduled, self._lock = [], Lock()
+        self._progress = None
+
+    def add(self, name, units, method, *args, **kwargs):
+        """Schedule method(progress_cb, *args, **kwargs), where progress_cb
+        is a progress callback for this transfer
+
+        :param name: (str) e.g., the file path
+
+        :param units: (int) the size of the transfer, in progress units
+
+        :returns: (Transfer)
+        """
+        transfer = Transfer(self, name, units, method, args, kwargs)
+        self._scheduled.append(transfer)
+        return transfer
+
+    @property
+    def units(self):
+        return sum(t.units for t in self._scheduled)
+
+    def _order(self):
+        """:returns: (list) transfers, alternating largest and smallest"""
+        by_size = sorted(self._scheduled, key=lambda t: t.units)
+        order = []
+        while by_size:
+            order.append(by_size.pop())
+            if by_size:
+                order.append(by_size.pop(0))
+        return order
+
+    def _advance(self, n):
+        if not (self._progress and n > 0):
+            return
+        with self._lock:
+            try:
+                for i in xrange(n):
+                    self._progress.next()
+            except Exception:
+                log.debug('Progress bar failure')
+                self._progress = None
+
+    def _finished(self, transfer):
+        if self.done_cb:
+            with self._lock:
+                try:
+                    self.done_cb(transfer)
+                except Exception as e:
+                    log.debug('Transfer callback failed: %s' % e)
+
+    def run(self):
+        """Run all scheduled transfers and wait for them
+
+        :returns: (list) the Transfers which failed
+        """
+        if self.progress_cb:
+            try:
+                self._progress = self.progress_cb(self.units)
+                self._progress.next()
+            except Exception:
+                self._progress = None
+        pool, jobs = WorkerPool(self.transfers), []
+        try:
+            for transfer in self._order():
+                jobs.append(pool.submit(transfer))
+            for job in jobs:
+                job.join()
+        except (Exception, KeyboardInterrupt):
+            for job in jobs:
+                job.cancel()
+            pool.shutdown(wait=False, cancel=True)
+            raise
+        pool.shutdown()
+        scheduled, self._scheduled = self._scheduled, []
+        return [t for t in scheduled if t.exception]